@@ -0,0 +1,6 @@
+from .types import EMPTY_HASH, HASH_SIZE, Hash, Leaf, parent_hash
+from .batchproof import BatchProof
+from .forestdata import DiskForestData, RamForestData
+from .posindex import PositionIndex
+from .forest import Forest, UndoRecord
+from .pollard import Pollard
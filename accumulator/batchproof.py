@@ -0,0 +1,168 @@
+import struct
+from dataclasses import dataclass, field
+from typing import BinaryIO, Dict, List, Optional, Sequence, Tuple
+
+from .positions import proof_positions, root_position, targets_by_row, tree_rows
+from .types import HASH_SIZE, Hash, parent_hash
+
+# Upper bounds on the counts in a serialized proof, so a corrupt header
+# can't make us allocate gigabytes before noticing the data is short
+MAX_TARGETS = 1 << 24
+MAX_PROOF_HASHES = 1 << 26
+
+
+@dataclass
+class BatchProof:
+    """
+    BatchProof proves a set of leaves (targets, by position) against the
+    accumulator roots. proof holds the sibling hashes that can't be computed
+    from the targets, in ascending position order. In a partial proof,
+    hashes the receiver's Pollard already holds are None.
+    """
+
+    targets: List[int] = field(default_factory=list)  # uint64 positions
+    proof: List[Optional[Hash]] = field(default_factory=list)
+
+    def serialize(self, w: BinaryIO) -> None:
+        """
+        Serialize to a binary stream.
+        Format:
+        - num targets (4 bytes)
+        - num proof hashes (4 bytes)
+        - targets (8 bytes each)
+        - proof hashes (32 bytes each)
+        """
+        buf = bytearray(self.serialize_size())
+        self.serialize_into(buf, 0)
+        w.write(buf)
+
+    def serialize_into(self, buf: bytearray, offset: int) -> int:
+        """
+        Serialize into a preallocated buffer at offset. Returns the offset
+        just past the written bytes.
+        """
+        num_targets = len(self.targets)
+        struct.pack_into(f">II{num_targets}Q", buf, offset,
+                         num_targets, len(self.proof), *self.targets)
+        offset += 8 + 8 * num_targets
+
+        for h in self.proof:
+            if h is None:
+                raise ValueError("partial proofs can't be serialized in this format")
+            buf[offset:offset + HASH_SIZE] = h
+            offset += HASH_SIZE
+
+        return offset
+
+    def serialize_size(self) -> int:
+        """Calculate serialized size in bytes"""
+        return 8 + 8 * len(self.targets) + HASH_SIZE * len(self.proof)
+
+    def deserialize(self, r: BinaryIO) -> None:
+        """Read a BatchProof from a binary stream"""
+        try:
+            header = r.read(8)
+            if len(header) != 8:
+                raise ValueError("unexpected end of stream")
+            num_targets, num_hashes = struct.unpack(">II", header)
+            _check_counts(num_targets, num_hashes)
+
+            body = r.read(8 * num_targets + HASH_SIZE * num_hashes)
+            proof, _ = BatchProof.from_buffer(header + body, 0)
+        except Exception as e:
+            raise ValueError(f"BatchProof deserialize error: {str(e)}")
+
+        self.targets = proof.targets
+        self.proof = proof.proof
+
+    @staticmethod
+    def from_buffer(buf, offset: int = 0) -> Tuple["BatchProof", int]:
+        """
+        Decode a BatchProof from a buffer at offset without going through a
+        stream. Returns the proof and the offset just past it.
+        """
+        num_targets, num_hashes = struct.unpack_from(">II", buf, offset)
+        _check_counts(num_targets, num_hashes)
+        offset += 8
+
+        end = offset + 8 * num_targets + HASH_SIZE * num_hashes
+        if end > len(buf):
+            raise ValueError(
+                f"{num_targets} targets and {num_hashes} hashes but only "
+                f"{len(buf) - offset} bytes"
+            )
+
+        targets = list(struct.unpack_from(f">{num_targets}Q", buf, offset))
+        offset += 8 * num_targets
+
+        proof = []
+        for _ in range(num_hashes):
+            proof.append(Hash(bytes(buf[offset:offset + HASH_SIZE])))
+            offset += HASH_SIZE
+
+        return BatchProof(targets=targets, proof=proof), offset
+
+    def calculate_roots(self, target_hashes: Sequence[bytes],
+                        num_leaves: int) -> Dict[int, bytes]:
+        """
+        Hash the targets up with the proof in a forest of num_leaves leaves.
+        Returns the computed roots by position; compare them against the
+        accumulator's roots to verify the proof.
+        """
+        return self.compute_nodes(target_hashes, num_leaves)[1]
+
+    def compute_nodes(self, target_hashes: Sequence[bytes],
+                      num_leaves: int) -> Tuple[Dict[int, bytes], Dict[int, bytes]]:
+        """
+        Like calculate_roots, but also returns the hash of every position
+        the proof covers: targets, proof hashes and everything computed.
+        """
+        if len(target_hashes) != len(self.targets):
+            raise ValueError(
+                f"{len(self.targets)} targets but {len(target_hashes)} hashes"
+            )
+
+        forest_rows = tree_rows(num_leaves)
+        by_row = targets_by_row(self.targets, num_leaves, forest_rows)
+        needed = proof_positions(self.targets, num_leaves, forest_rows)
+        if len(needed) != len(self.proof):
+            raise ValueError(
+                f"proof has {len(self.proof)} hashes, targets need {len(needed)}"
+            )
+
+        known = dict(zip(needed, self.proof))
+        known.update(zip(self.targets, target_hashes))
+
+        # Same row-at-a-time walk as proof_positions, hashing each parent
+        # once from whichever of its children is reached first
+        roots = {}
+        nodes: List[int] = []
+        top = 1 << forest_rows
+        for row in range(forest_rows + 1):
+            if by_row[row]:
+                nodes = sorted(set(nodes).union(by_row[row])) if nodes else by_row[row]
+            if not nodes:
+                continue
+
+            if (num_leaves >> row) & 1 and nodes[-1] == root_position(num_leaves, row, forest_rows):
+                roots[nodes[-1]] = known[nodes[-1]]
+                nodes.pop()
+
+            parents = []
+            for pos in nodes:
+                up = (pos >> 1) | top
+                if parents and parents[-1] == up:
+                    continue
+                left = pos & ~1
+                known[up] = parent_hash(known[left], known[left | 1])
+                parents.append(up)
+            nodes = parents
+
+        return known, roots
+
+
+def _check_counts(num_targets: int, num_hashes: int) -> None:
+    if num_targets > MAX_TARGETS:
+        raise ValueError(f"{num_targets} targets exceeds maximum {MAX_TARGETS}")
+    if num_hashes > MAX_PROOF_HASHES:
+        raise ValueError(f"{num_hashes} proof hashes exceeds maximum {MAX_PROOF_HASHES}")
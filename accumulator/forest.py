@@ -0,0 +1,385 @@
+import os
+import struct
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Tuple
+
+from .batchproof import BatchProof
+from .forestdata import DEFAULT_HOT_ROWS, RANGE_CHUNK, DiskForestData, RamForestData
+from .posindex import PositionIndex
+from .positions import (
+    detect_row, is_root_position, left_child, num_positions, parent,
+    proof_positions, root_positions, row_offset, tree_rows,
+)
+from .types import EMPTY_HASH, Hash, Leaf, parent_hash
+
+
+@dataclass
+class UndoRecord:
+    """
+    What Forest.undo needs to reverse one modify: the deleted leaves as
+    (hash, position) in the order they were deleted, the number of leaves
+    added, the roots just before the adds, and the row count before it all
+    """
+    deleted: List[Tuple[bytes, int]] = field(default_factory=list)
+    num_adds: int = 0
+    roots: List[bytes] = field(default_factory=list)
+    rows: int = 0
+
+
+class Forest:
+    """
+    Forest is the bridge's full accumulator. Every node hash lives in one
+    position-indexed buffer (see forestdata), and positions (a
+    PositionIndex) maps each leaf hash to its position so spent leaves can
+    be proven.
+
+    Deletion is swapless: deleting a leaf moves its sibling's subtree up
+    into their parent, and a deleted root leaves an empty root that the
+    next add climbs straight past. Empty positions hold EMPTY_HASH.
+
+    A forest opened with Forest.open keeps its nodes in a memory-mapped file
+    instead of memory; see flush() for when that file is consistent.
+    """
+
+    # num_leaves, rows
+    META = struct.Struct(">QB")
+
+    def __init__(self, data=None):
+        self.data = data if data is not None else RamForestData()
+        self.path: Optional[str] = None
+        self.num_leaves = 0
+        self.rows = 0
+        self.positions = PositionIndex(self.data)
+        if self.data.size() < num_positions(self.rows):
+            self.data.resize(num_positions(self.rows))
+
+    @classmethod
+    def open(cls, path: str, hot_rows: int = DEFAULT_HOT_ROWS) -> "Forest":
+        """
+        Open a disk-backed forest at path, creating it if it doesn't exist.
+        The leaf count is read from path + ".meta" and the position index
+        from path + ".idx", both written by flush().
+        """
+        meta_path = path + ".meta"
+        if os.path.exists(path) and not os.path.exists(meta_path):
+            raise ValueError(f"{path} exists without {meta_path}")
+
+        forest = cls(DiskForestData(path, hot_rows))
+        forest.path = path
+        if os.path.exists(meta_path):
+            with open(meta_path, "rb") as f:
+                meta = f.read()
+            if len(meta) != cls.META.size:
+                raise ValueError(f"{meta_path}: expected {cls.META.size} bytes, got {len(meta)}")
+
+            forest.num_leaves, forest.rows = cls.META.unpack(meta)
+            if forest.data.size() != num_positions(forest.rows):
+                raise ValueError(
+                    f"{path} holds {forest.data.size()} positions, "
+                    f"{forest.rows} rows need {num_positions(forest.rows)}"
+                )
+            if os.path.exists(path + ".idx"):
+                forest.positions = PositionIndex.load(path + ".idx", forest.data)
+            else:
+                forest._rebuild_positions()
+
+        return forest
+
+    def flush(self) -> None:
+        """
+        Flush a disk-backed forest and record its leaf count. The files are
+        consistent with each other only after a flush, so call this between
+        blocks; after an unclean shutdown the node file may hold changes
+        from past the last flush.
+        """
+        self.data.flush()
+        if self.path is None:
+            return
+
+        self._save_index(self.path)
+
+    def save(self, path: str) -> None:
+        """
+        Write a copy of the forest to path, in the files Forest.open reads,
+        as a checkpoint. The .meta file is written last, so a checkpoint
+        cut short has none and won't open.
+        """
+        self.data.flush()
+        size = self.data.size()
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            for pos in range(0, size, RANGE_CHUNK):
+                f.write(self.data.read_range(pos, min(RANGE_CHUNK, size - pos)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self._save_index(path)
+
+    def _save_index(self, path: str) -> None:
+        """Write the position index, then the leaf count, for the nodes at path"""
+        self.positions.save(path + ".idx.tmp")
+        os.replace(path + ".idx.tmp", path + ".idx")
+
+        tmp = path + ".meta.tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.META.pack(self.num_leaves, self.rows))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path + ".meta")
+
+    def close(self) -> None:
+        self.flush()
+        self.data.close()
+
+    def _rebuild_positions(self) -> None:
+        """Rebuild the leaf position map by walking every tree"""
+        rows = self.rows
+        leaves = []
+        for root in root_positions(self.num_leaves, rows):
+            if self.data.is_empty(root):
+                continue
+            stack = [(root, detect_row(root, rows))]
+            while stack:
+                pos, row = stack.pop()
+                if row and not self.data.is_empty(left_child(pos, rows)):
+                    lc = left_child(pos, rows)
+                    stack.append((lc, row - 1))
+                    stack.append((lc | 1, row - 1))
+                else:
+                    leaves.append((self.data.read(pos), pos))
+
+        self.positions = PositionIndex(self.data, 2 * len(leaves))
+        self.positions.insert_many(leaves)
+
+    def modify(self, adds: Sequence[Leaf], dels: Sequence[int]) -> UndoRecord:
+        """
+        Delete the leaves at positions dels, then add adds. Deletions are
+        applied one at a time by leaf hash, so their order doesn't matter.
+        Returns the record undo needs to reverse it.
+        """
+        del_hashes = []
+        for pos in dels:
+            h = self.data.read(pos) if pos < self.data.size() else EMPTY_HASH
+            if h == EMPTY_HASH or h not in self.positions:
+                raise ValueError(f"can't delete position {pos}: not a leaf")
+            del_hashes.append(h)
+        if len(set(del_hashes)) != len(del_hashes):
+            raise ValueError("duplicate deletion")
+
+        for leaf in adds:
+            if bytes(leaf.hash) in self.positions:
+                raise ValueError(f"leaf {bytes(leaf.hash).hex()} already in forest")
+
+        undo = UndoRecord(num_adds=len(adds), rows=self.rows)
+        new_rows = tree_rows(self.num_leaves + len(adds))
+        if new_rows > self.rows:
+            self._remap(new_rows)
+
+        for h in del_hashes:
+            pos = self.positions.pop(h)
+            self._delete(pos)
+            undo.deleted.append((h, pos))
+
+        undo.roots = [bytes(root) for root in self.get_roots()]
+        for leaf in adds:
+            self._add(bytes(leaf.hash))
+        return undo
+
+    def undo(self, record: UndoRecord) -> None:
+        """
+        Reverse the modify that returned record. Modifies must be undone
+        last first.
+        """
+        num_leaves = self.num_leaves - record.num_adds
+        rows = self.rows
+        if num_leaves < 0 or record.rows > rows:
+            raise ValueError(f"can't undo {record.num_adds} adds from {self.stats()}")
+
+        # The adds joined the old roots into trees with the new leaves,
+        # moving them up past any empty roots above. Clear those trees down
+        # to the old roots, found by hash, then move each back into place.
+        old_roots = {
+            h: pos for pos, h in zip(root_positions(num_leaves, rows), record.roots)
+            if h != EMPTY_HASH
+        }
+        moves = []
+        for root in root_positions(self.num_leaves, rows):
+            stack = [(root, detect_row(root, rows))]
+            while stack:
+                pos, row = stack.pop()
+                if self.data.is_empty(pos):
+                    continue
+                h = self.data.read(pos)
+                if h in old_roots:
+                    if pos != old_roots[h]:
+                        moves.append((pos, old_roots[h]))
+                    continue
+                if row and not self.data.is_empty(left_child(pos, rows)):
+                    lc = left_child(pos, rows)
+                    stack.append((lc, row - 1))
+                    stack.append((lc | 1, row - 1))
+                else:
+                    self.positions.pop(h)
+                self.data.write(pos, EMPTY_HASH)
+        self._move_subtrees(moves)
+        self.num_leaves = num_leaves
+
+        # Each deletion moved its sibling's subtree up into their parent;
+        # move it back down and put the leaf beside it
+        for h, pos in reversed(record.deleted):
+            root = is_root_position(pos, num_leaves, rows)
+            if not root:
+                self._move_subtrees([(parent(pos, rows), pos ^ 1)])
+            self.data.write(pos, h)
+            self.positions.insert(h, pos)
+            if not root:
+                self._rehash_up(pos)
+
+        if record.rows < rows:
+            self._unmap(record.rows)
+
+    def _add(self, h: bytes) -> None:
+        rows = self.rows
+        pos = self.num_leaves
+        self.data.write(pos, h)
+        self.positions.insert(h, pos)
+
+        # Join with the root to the left for each set bit of num_leaves
+        row = 0
+        while (self.num_leaves >> row) & 1:
+            root = pos ^ 1
+            up = parent(pos, rows)
+            if self.data.is_empty(root):
+                self._move_subtree(pos, up)
+            else:
+                self.data.write(up, parent_hash(self.data.read(root), self.data.read(pos)))
+            pos = up
+            row += 1
+
+        self.num_leaves += 1
+
+    def _delete(self, pos: int) -> None:
+        rows = self.rows
+        self.data.write(pos, EMPTY_HASH)
+        if is_root_position(pos, self.num_leaves, rows):
+            return
+
+        up = parent(pos, rows)
+        self._move_subtree(pos ^ 1, up)
+        self._rehash_up(up)
+
+    def _rehash_up(self, pos: int) -> None:
+        """Recompute the hashes above pos, up to its root"""
+        rows = self.rows
+        while not is_root_position(pos, self.num_leaves, rows):
+            left = pos & ~1
+            nxt = parent(pos, rows)
+            self.data.write(nxt, parent_hash(self.data.read(left), self.data.read(left | 1)))
+            pos = nxt
+
+    def _move_subtree(self, src: int, dst: int) -> None:
+        """
+        Move the subtree at src up one row so it's rooted at dst, its parent.
+        Only live nodes are walked, so the cost is the size of the subtree
+        rather than the number of positions under it.
+        """
+        self._move_subtrees([(src, dst)])
+
+    def _move_subtrees(self, pairs: Sequence[Tuple[int, int]]) -> None:
+        """
+        Move the subtree at each src so it's rooted at its dst, any number
+        of rows up or down. All are read before any is written, so a
+        destination may overlap where another subtree was.
+        """
+        rows = self.rows
+        moves = []  # (old position, new position, is leaf)
+        for src, dst in pairs:
+            row = detect_row(src, rows)
+            level = [(src, dst)]
+            while level:
+                nxt = []
+                for old, new in level:
+                    if row == 0 or self.data.is_empty(left_child(old, rows)):
+                        moves.append((old, new, True))
+                        continue
+                    moves.append((old, new, False))
+                    lc, new_lc = left_child(old, rows), left_child(new, rows)
+                    nxt.append((lc, new_lc))
+                    nxt.append((lc | 1, new_lc | 1))
+                level = nxt
+                row -= 1
+
+        hashes = [self.data.read(old) for old, _, _ in moves]
+        for old, _, _ in moves:
+            self.data.write(old, EMPTY_HASH)
+        for (old, new, is_leaf), h in zip(moves, hashes):
+            self.data.write(new, h)
+            if is_leaf:
+                self.positions.move(h, old, new)
+
+    def _remap(self, new_rows: int) -> None:
+        """
+        Grow the forest to new_rows rows. Rows are moved to their new offsets
+        top-down in place, so nothing is overwritten before it's copied.
+        """
+        old_rows = self.rows
+        self.data.resize(num_positions(new_rows))
+
+        for row in range(old_rows, -1, -1):
+            old_width = 1 << (old_rows - row)
+            new_width = 1 << (new_rows - row)
+            start = row_offset(row, new_rows)
+            if row:
+                self.data.copy_range(row_offset(row, old_rows), start, old_width)
+            self.data.clear_range(start + old_width, new_width - old_width)
+
+        self.positions.remap(old_rows, new_rows)
+
+        self.rows = new_rows
+
+    def _unmap(self, new_rows: int) -> None:
+        """
+        Shrink the forest to new_rows rows, the reverse of _remap. Rows are
+        moved bottom-up, each to a lower offset than any row above it.
+        """
+        old_rows = self.rows
+        for row in range(1, new_rows + 1):
+            self.data.copy_range(row_offset(row, old_rows), row_offset(row, new_rows),
+                                 1 << (new_rows - row))
+        self.data.resize(num_positions(new_rows))
+
+        self.positions.remap(old_rows, new_rows)
+
+        self.rows = new_rows
+
+    def prove_batch(self, hashes: Sequence[bytes]) -> BatchProof:
+        """Build a BatchProof for the leaves with the given hashes"""
+        targets = self.positions.get_many(hashes)
+        for h, pos in zip(hashes, targets):
+            if pos is None:
+                raise ValueError(f"hash {bytes(h).hex()} not found")
+
+        needed = proof_positions(targets, self.num_leaves, self.rows)
+        return BatchProof(
+            targets=targets,
+            proof=[Hash(self.data.read(pos)) for pos in needed],
+        )
+
+    def verify_batch_proof(self, hashes: Sequence[bytes], proof: BatchProof) -> bool:
+        """Whether proof proves hashes against the current roots"""
+        roots = proof.calculate_roots(hashes, self.num_leaves)
+        return all(self.data.read(pos) == h for pos, h in roots.items())
+
+    def get_roots(self) -> List[Hash]:
+        """Root hashes, tallest first. Deleted roots are EMPTY_HASH."""
+        return [
+            Hash(self.data.read(pos))
+            for pos in root_positions(self.num_leaves, self.rows)
+        ]
+
+    def stats(self) -> str:
+        return (
+            f"numleaves: {self.num_leaves} rows: {self.rows} "
+            f"positions: {self.data.size()} bytes: {self.data.nbytes()} "
+            f"posmap: {len(self.positions)} posmap bytes: {self.positions.nbytes()}"
+        )
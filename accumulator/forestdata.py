@@ -0,0 +1,207 @@
+import mmap
+import os
+
+from .types import EMPTY_HASH, HASH_SIZE
+
+# Top rows of a disk forest kept in memory. Every add and delete walks up
+# to a root, so these rows are touched on every block.
+DEFAULT_HOT_ROWS = 18
+
+# Positions moved per step by range operations on a disk forest, so a
+# copy or clear of a whole row never needs the row in memory at once
+RANGE_CHUNK = 1 << 16
+
+
+class RamForestData:
+    """
+    Node hashes of a forest in one contiguous buffer, 32 bytes per position.
+    An all-zero hash marks a position with no node in it.
+    """
+
+    def __init__(self, num_positions: int = 0):
+        self.buf = bytearray(num_positions * HASH_SIZE)
+
+    def size(self) -> int:
+        """Number of positions the buffer holds"""
+        return len(self.buf) // HASH_SIZE
+
+    def resize(self, num_positions: int) -> None:
+        """Grow or shrink to num_positions; new positions are empty"""
+        new_len = num_positions * HASH_SIZE
+        if new_len > len(self.buf):
+            self.buf.extend(bytes(new_len - len(self.buf)))
+        else:
+            del self.buf[new_len:]
+
+    def read(self, pos: int) -> bytes:
+        start = pos * HASH_SIZE
+        return bytes(self.buf[start:start + HASH_SIZE])
+
+    def write(self, pos: int, h: bytes) -> None:
+        start = pos * HASH_SIZE
+        self.buf[start:start + HASH_SIZE] = h
+
+    def read_range(self, pos: int, count: int) -> bytes:
+        """Hashes of count consecutive positions, concatenated"""
+        start = pos * HASH_SIZE
+        return bytes(self.buf[start:start + count * HASH_SIZE])
+
+    def write_range(self, pos: int, data) -> None:
+        """Write consecutive hashes starting at pos"""
+        start = pos * HASH_SIZE
+        self.buf[start:start + len(data)] = data
+
+    def copy_range(self, src: int, dst: int, count: int) -> None:
+        """Copy count positions from src to dst; the ranges may overlap"""
+        s = src * HASH_SIZE
+        d = dst * HASH_SIZE
+        n = count * HASH_SIZE
+        self.buf[d:d + n] = self.buf[s:s + n]
+
+    def clear_range(self, pos: int, count: int) -> None:
+        """Mark count positions from pos empty"""
+        start = pos * HASH_SIZE
+        self.buf[start:start + count * HASH_SIZE] = bytes(count * HASH_SIZE)
+
+    def is_empty(self, pos: int) -> bool:
+        start = pos * HASH_SIZE
+        return self.buf[start:start + HASH_SIZE] == EMPTY_HASH
+
+    def nbytes(self) -> int:
+        return len(self.buf)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class DiskForestData:
+    """
+    Node hashes in a memory-mapped file, in the same row-major layout as
+    RamForestData, so the forest's size isn't bounded by memory. Writes go
+    through the OS page cache; flush() is the point at which the file is
+    known to match memory.
+
+    The top hot_rows rows, the last positions of the file, are kept in a
+    resident buffer and written back to the file on flush and resize.
+    """
+
+    def __init__(self, path: str, hot_rows: int = DEFAULT_HOT_ROWS):
+        self.path = path
+        self.hot_rows = hot_rows
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        self.mm = None
+        self._map()
+
+    def _map(self) -> None:
+        length = os.fstat(self.file.fileno()).st_size
+        if length % HASH_SIZE:
+            raise ValueError(f"{self.path}: size {length} not a multiple of {HASH_SIZE}")
+
+        self.num_positions = length // HASH_SIZE
+        self.mm = mmap.mmap(self.file.fileno(), length) if length else None
+
+        hot_count = min(self.num_positions, (1 << self.hot_rows) - 1)
+        self.hot_start = self.num_positions - hot_count
+        self.hot = bytearray(self.mm[self.hot_start * HASH_SIZE:]) if hot_count else bytearray()
+
+    def _write_back(self) -> None:
+        if self.hot:
+            start = self.hot_start * HASH_SIZE
+            self.mm[start:start + len(self.hot)] = self.hot
+
+    def _segments(self, pos: int, count: int):
+        """
+        Split a range into its mapped and resident parts. Yields
+        (buffer, start byte, byte count, byte offset into the range).
+        """
+        end = pos + count
+        if pos < self.hot_start:
+            cold_end = min(end, self.hot_start)
+            yield self.mm, pos * HASH_SIZE, (cold_end - pos) * HASH_SIZE, 0
+        if end > self.hot_start:
+            first = max(pos, self.hot_start)
+            yield (self.hot, (first - self.hot_start) * HASH_SIZE,
+                   (end - first) * HASH_SIZE, (first - pos) * HASH_SIZE)
+
+    def size(self) -> int:
+        return self.num_positions
+
+    def resize(self, num_positions: int) -> None:
+        """Grow or shrink the file to num_positions; new positions are empty"""
+        self._write_back()
+        if self.mm is not None:
+            self.mm.close()
+        self.file.truncate(num_positions * HASH_SIZE)
+        self._map()
+
+    def read(self, pos: int) -> bytes:
+        if pos >= self.hot_start:
+            start = (pos - self.hot_start) * HASH_SIZE
+            return bytes(self.hot[start:start + HASH_SIZE])
+        start = pos * HASH_SIZE
+        return self.mm[start:start + HASH_SIZE]
+
+    def write(self, pos: int, h: bytes) -> None:
+        if pos >= self.hot_start:
+            start = (pos - self.hot_start) * HASH_SIZE
+            self.hot[start:start + HASH_SIZE] = h
+            return
+        start = pos * HASH_SIZE
+        self.mm[start:start + HASH_SIZE] = h
+
+    def is_empty(self, pos: int) -> bool:
+        return self.read(pos) == EMPTY_HASH
+
+    def read_range(self, pos: int, count: int) -> bytes:
+        out = bytearray(count * HASH_SIZE)
+        for buf, start, n, at in self._segments(pos, count):
+            out[at:at + n] = buf[start:start + n]
+        return bytes(out)
+
+    def write_range(self, pos: int, data) -> None:
+        for buf, start, n, at in self._segments(pos, len(data) // HASH_SIZE):
+            buf[start:start + n] = data[at:at + n]
+
+    def copy_range(self, src: int, dst: int, count: int) -> None:
+        """Copy count positions from src to dst; the ranges may overlap"""
+        if max(src, dst) + count <= self.hot_start:
+            self.mm.move(dst * HASH_SIZE, src * HASH_SIZE, count * HASH_SIZE)
+            return
+
+        # Copy in chunks, back to front when moving up so an overlapping
+        # source isn't overwritten before it's read
+        starts = range(0, count, RANGE_CHUNK)
+        if dst > src:
+            starts = reversed(starts)
+        for i in starts:
+            n = min(RANGE_CHUNK, count - i)
+            self.write_range(dst + i, self.read_range(src + i, n))
+
+    def clear_range(self, pos: int, count: int) -> None:
+        zeros = bytes(min(count, RANGE_CHUNK) * HASH_SIZE)
+        for i in range(0, count, RANGE_CHUNK):
+            n = min(RANGE_CHUNK, count - i)
+            self.write_range(pos + i, zeros[:n * HASH_SIZE])
+
+    def nbytes(self) -> int:
+        return self.num_positions * HASH_SIZE
+
+    def resident_bytes(self) -> int:
+        """Bytes of the hot rows held in memory"""
+        return len(self.hot)
+
+    def flush(self) -> None:
+        """Write the hot rows back and flush the mapping to disk"""
+        if self.mm is not None:
+            self._write_back()
+            self.mm.flush()
+
+    def close(self) -> None:
+        self.flush()
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        self.file.close()
@@ -0,0 +1,457 @@
+import heapq
+import struct
+from array import array
+from typing import BinaryIO, Dict, List, Optional, Sequence, Tuple
+
+from .batchproof import BatchProof
+from .positions import (
+    detect_row, is_root_position, left_child, parent, proof_positions, tree_rows,
+)
+from .types import EMPTY_HASH, HASH_SIZE, Hash, Leaf, parent_hash
+
+NIL = -1
+
+# Node flags
+REMEMBER = 0x01
+
+# Serialized node flags
+NODE_PRESENT = 0x01
+NODE_CHILDREN = 0x02
+NODE_REMEMBER = 0x04
+
+INITIAL_CAPACITY = 1024
+
+# Expiry of a cached leaf whose spend height isn't known; evicted first
+UNKNOWN_EXPIRY = 0x7fffffff
+
+# An eviction queue entry: a list slot and a two-digit int
+QUEUE_ENTRY_BYTES = 8 + 36
+# Arena bytes per node (three links, an expiry, flags, a hash, a free-list
+# slot) plus a queue entry, for turning a memory budget into a node count
+NODE_BYTES = 3 * 4 + 4 + 1 + HASH_SIZE + 4 + QUEUE_ENTRY_BYTES
+
+
+class Pollard:
+    """
+    Pollard is the CSN's sparse accumulator: the roots, plus the paths to
+    leaves it has been asked to remember, so those need no proof when
+    they're spent.
+
+    Nodes live in an arena of parallel arrays indexed by node number (child
+    and parent links, flags) and one flat hash buffer, so a node costs about
+    45 bytes instead of a Python object per node. Freed nodes go on a
+    free-list and are reused before the arena grows.
+
+    Deletion is swapless, matching Forest: a deleted leaf's sibling takes
+    its parent's place, and a deleted root leaves an empty root (NIL).
+
+    With max_nodes set, the pollard holds at most that many nodes after
+    each modify, evicting the cached leaves spent furthest in the future
+    first. Eviction only depends on the blocks applied, so a bridge
+    shadowing the pollard (CacheSimulator) evicts the same leaves.
+    """
+
+    def __init__(self):
+        self.num_leaves = 0
+        self.roots: List[int] = []  # tallest first, NIL for an empty root
+        self.lookahead = 0
+        self.max_nodes = 0  # 0 for no limit
+        self.blocks = 0  # modify calls, the clock cached leaves expire by
+        # Cached leaves, latest expiry first; see _queue_key
+        self.evict_queue: List[int] = []
+
+        self.left = array("i")
+        self.right = array("i")
+        self.up = array("i")
+        self.expiry = array("i")
+        self.flags = bytearray()
+        self.hashes = bytearray()
+        self.free = array("i")
+        self._grow(INITIAL_CAPACITY)
+
+    @classmethod
+    def from_roots(cls, num_leaves: int, roots: Sequence[bytes]) -> "Pollard":
+        """A pollard holding only the given roots; EMPTY_HASH is an empty root"""
+        if len(roots) != bin(num_leaves).count("1"):
+            raise ValueError(f"{num_leaves} leaves need {bin(num_leaves).count('1')} roots, got {len(roots)}")
+
+        pollard = cls()
+        pollard.num_leaves = num_leaves
+        pollard.roots = [
+            NIL if bytes(h) == EMPTY_HASH else pollard._alloc(bytes(h)) for h in roots
+        ]
+        return pollard
+
+    @staticmethod
+    def nodes_for_bytes(max_bytes: int) -> int:
+        """The max_nodes that keeps a pollard within about max_bytes"""
+        return max(1, max_bytes // NODE_BYTES)
+
+    def forget_all(self) -> None:
+        """Drop every cached leaf, keeping only the roots"""
+        lookahead, max_nodes = self.lookahead, self.max_nodes
+        self.__dict__.update(Pollard.from_roots(self.num_leaves, self.get_roots()).__dict__)
+        self.lookahead, self.max_nodes = lookahead, max_nodes
+
+    def _grow(self, capacity: int) -> None:
+        old = len(self.left)
+        extra = capacity - old
+        self.left.extend(array("i", [NIL]) * extra)
+        self.right.extend(array("i", [NIL]) * extra)
+        self.up.extend(array("i", [NIL]) * extra)
+        self.expiry.extend(array("i", [UNKNOWN_EXPIRY]) * extra)
+        self.flags.extend(bytes(extra))
+        self.hashes.extend(bytes(extra * HASH_SIZE))
+        # hand out low node numbers first
+        self.free.extend(range(capacity - 1, old - 1, -1))
+
+    def _alloc(self, h: bytes, flags: int = 0) -> int:
+        if not self.free:
+            capacity = len(self.left)
+            if capacity < self.max_nodes:
+                # Don't double far past the budget
+                self._grow(min(2 * capacity, self.max_nodes + INITIAL_CAPACITY))
+            else:
+                self._grow(2 * capacity)
+        n = self.free.pop()
+        self.left[n] = NIL
+        self.right[n] = NIL
+        self.up[n] = NIL
+        self.flags[n] = flags
+        self.hashes[n * HASH_SIZE:(n + 1) * HASH_SIZE] = h
+        return n
+
+    def _release(self, n: int) -> None:
+        self.flags[n] = 0
+        self.free.append(n)
+
+    def _hash(self, n: int) -> bytes:
+        return bytes(self.hashes[n * HASH_SIZE:(n + 1) * HASH_SIZE])
+
+    def _live(self, n: int) -> bool:
+        """Whether n or something under it has to stay in the pollard"""
+        return bool(self.flags[n] & REMEMBER) or self.left[n] != NIL
+
+    def _prune(self, n: int) -> None:
+        """Drop n's children if nothing under them needs keeping"""
+        lc, rc = self.left[n], self.right[n]
+        if lc == NIL or self._live(lc) or self._live(rc):
+            return
+        self._release(lc)
+        self._release(rc)
+        self.left[n] = NIL
+        self.right[n] = NIL
+
+    def _set_children(self, n: int, lc: int, rc: int) -> None:
+        self.left[n] = lc
+        self.right[n] = rc
+        self.up[lc] = n
+        self.up[rc] = n
+
+    def _root_index(self, row: int) -> int:
+        """Index into roots of the root at row"""
+        return bin(self.num_leaves >> (row + 1)).count("1")
+
+    def _path(self, pos: int) -> Tuple[int, List[int], int]:
+        """
+        Root row and the left/right turns (1 for right) from that root down
+        to pos, for the current number of leaves.
+        """
+        rows = tree_rows(self.num_leaves)
+        turns = []
+        row = detect_row(pos, rows)
+        while not is_root_position(pos, self.num_leaves, rows):
+            if row >= rows:
+                raise ValueError(f"position {pos} is not in the pollard")
+            turns.append(pos & 1)
+            pos = parent(pos, rows)
+            row += 1
+        turns.reverse()
+        return row, turns, pos
+
+    def _node_at(self, pos: int) -> int:
+        """Node at pos, or NIL if it isn't held"""
+        row, turns, _ = self._path(pos)
+        n = self.roots[self._root_index(row)]
+        for turn in turns:
+            if n == NIL:
+                return NIL
+            n = self.right[n] if turn else self.left[n]
+        return n
+
+    def read_position(self, pos: int) -> Optional[bytes]:
+        """Hash at pos, or None if the pollard doesn't hold it"""
+        n = self._node_at(pos)
+        return None if n == NIL else self._hash(n)
+
+    def fill_proof(self, proof: BatchProof) -> None:
+        """
+        Fill in proof hashes left out (None) by a bridge that knows this
+        pollard already holds them
+        """
+        if all(h is not None for h in proof.proof):
+            return
+
+        needed = proof_positions(proof.targets, self.num_leaves, tree_rows(self.num_leaves))
+        if len(needed) != len(proof.proof):
+            raise ValueError(
+                f"proof has {len(proof.proof)} hashes, targets need {len(needed)}"
+            )
+        for i, h in enumerate(proof.proof):
+            if h is None:
+                cached = self.read_position(needed[i])
+                if cached is None:
+                    raise ValueError(f"proof omits position {needed[i]}, which isn't cached")
+                proof.proof[i] = Hash(cached)
+
+    def verify_batch_proof(self, target_hashes: Sequence[bytes], proof: BatchProof) -> Dict[int, bytes]:
+        """
+        Check proof against the roots, first filling in any hashes it left
+        out from the cache. Returns the hash of every position the proof
+        covers; raises ValueError if it doesn't match.
+        """
+        self.fill_proof(proof)
+        known, roots = proof.compute_nodes(target_hashes, self.num_leaves)
+        rows = tree_rows(self.num_leaves)
+        for pos, h in roots.items():
+            row = detect_row(pos, rows)
+            root = self.roots[self._root_index(row)]
+            if root == NIL or self._hash(root) != h:
+                raise ValueError(f"proof doesn't match root at position {pos}")
+        return known
+
+    def ingest_batch_proof(self, target_hashes: Sequence[bytes], proof: BatchProof) -> None:
+        """
+        Verify proof and fill in the nodes it covers, so its targets can be
+        deleted by the next modify. Nodes not needed afterwards are pruned
+        as the targets are deleted.
+        """
+        known = self.verify_batch_proof(target_hashes, proof)
+        rows = tree_rows(self.num_leaves)
+        for target in proof.targets:
+            row, turns, pos = self._path(target)
+            n = self.roots[self._root_index(row)]
+            for turn in turns:
+                if self.left[n] == NIL:
+                    lpos = left_child(pos, rows)
+                    self._set_children(
+                        n, self._alloc(known[lpos]), self._alloc(known[lpos | 1])
+                    )
+                pos = left_child(pos, rows) | turn
+                n = self.right[n] if turn else self.left[n]
+
+    def modify(self, adds: Sequence[Leaf], dels: Sequence[int]) -> None:
+        """
+        Delete the leaves at positions dels, which must have been ingested
+        or remembered, then add adds.
+        """
+        targets = []
+        for pos in dels:
+            n = self._node_at(pos)
+            if n == NIL:
+                raise ValueError(f"can't delete position {pos}: not in pollard")
+            targets.append(n)
+
+        # Pending targets mustn't be pruned while earlier ones are deleted
+        for n in targets:
+            self.flags[n] |= REMEMBER
+        for n in targets:
+            self._delete(n)
+
+        self.blocks += 1
+        for leaf in adds:
+            n = self._add(bytes(leaf.hash), leaf.remember)
+            if leaf.remember:
+                expiry = self.blocks + leaf.ttl if leaf.ttl > 0 else UNKNOWN_EXPIRY
+                self._cache(n, min(expiry, UNKNOWN_EXPIRY))
+
+        if self.max_nodes:
+            self._evict()
+
+    def _queue_key(self, n: int) -> int:
+        """
+        Eviction queue entry for cached leaf n: the latest expiry sorts
+        first, ties broken by node number. The expiry is kept in the entry
+        so one left behind by an evicted or deleted leaf can be told apart
+        from the node's current one.
+        """
+        return ((UNKNOWN_EXPIRY - self.expiry[n]) << 32) | n
+
+    def _cache(self, n: int, expiry: int) -> None:
+        self.expiry[n] = expiry
+        heapq.heappush(self.evict_queue, self._queue_key(n))
+        if len(self.evict_queue) > 2 * len(self.left):
+            # Mostly stale entries by now
+            self.evict_queue = [key for key in self.evict_queue if self._queued(key)]
+            heapq.heapify(self.evict_queue)
+
+    def _queued(self, key: int) -> bool:
+        """Whether key is still the entry of a cached leaf"""
+        n = key & 0xFFFFFFFF
+        return bool(self.flags[n] & REMEMBER) and self._queue_key(n) == key
+
+    def _evict(self) -> None:
+        """Forget cached leaves, latest expiry first, until within max_nodes"""
+        queue = self.evict_queue
+        while self.node_count() > self.max_nodes and queue:
+            key = heapq.heappop(queue)
+            if self._queued(key):
+                self._forget(key & 0xFFFFFFFF)
+
+    def _forget(self, n: int) -> None:
+        """Stop caching leaf n, pruning the path nothing else needs"""
+        self.flags[n] &= ~REMEMBER
+        par = self.up[n]
+        while par != NIL:
+            self._prune(par)
+            if self.left[par] != NIL:
+                break
+            par = self.up[par]
+
+    def _delete(self, n: int) -> None:
+        par = self.up[n]
+        self._release(n)
+        if par == NIL:
+            self.roots[self.roots.index(n)] = NIL
+            return
+
+        sib = self.right[par] if self.left[par] == n else self.left[par]
+        gp = self.up[par]
+        self.up[sib] = gp
+        self._release(par)
+        if gp == NIL:
+            self.roots[self.roots.index(par)] = sib
+            self._prune(sib)
+            return
+
+        if self.left[gp] == par:
+            self.left[gp] = sib
+        else:
+            self.right[gp] = sib
+
+        # Rehash up to the root, dropping what's no longer needed on the way
+        while gp != NIL:
+            self.hashes[gp * HASH_SIZE:(gp + 1) * HASH_SIZE] = parent_hash(
+                self._hash(self.left[gp]), self._hash(self.right[gp])
+            )
+            self._prune(gp)
+            gp = self.up[gp]
+
+    def _add(self, h: bytes, remember: bool) -> int:
+        """Add a leaf, returning its node"""
+        n = self._alloc(h, REMEMBER if remember else 0)
+        leaf = n
+        row = 0
+        while (self.num_leaves >> row) & 1:
+            root = self.roots.pop()
+            if root != NIL:
+                p = self._alloc(parent_hash(self._hash(root), self._hash(n)))
+                self._set_children(p, root, n)
+                self._prune(p)
+                n = p
+            row += 1
+        self.roots.append(n)
+        self.num_leaves += 1
+        return leaf
+
+    def get_roots(self) -> List[Hash]:
+        """Root hashes, tallest first. Deleted roots are EMPTY_HASH."""
+        return [Hash(EMPTY_HASH if n == NIL else self._hash(n)) for n in self.roots]
+
+    def reconstruct_stats(self) -> Tuple[int, int]:
+        """Number of leaves and rows"""
+        return self.num_leaves, tree_rows(self.num_leaves)
+
+    def node_count(self) -> int:
+        return len(self.left) - len(self.free)
+
+    def nbytes(self) -> int:
+        """Bytes held by the arena, including free slots, and eviction queue"""
+        capacity = len(self.left)
+        return (
+            capacity * (4 * self.left.itemsize + 1 + HASH_SIZE)
+            + len(self.free) * self.free.itemsize
+            + len(self.evict_queue) * QUEUE_ENTRY_BYTES
+        )
+
+    def stats(self) -> str:
+        limit = f"/{self.max_nodes}" if self.max_nodes else ""
+        return (
+            f"nl {self.num_leaves} rows {tree_rows(self.num_leaves)} "
+            f"nodes {self.node_count()}{limit} free {len(self.free)} "
+            f"bytes {self.nbytes()}"
+        )
+
+    def write_pollard(self, w: BinaryIO) -> None:
+        """
+        Write the pollard to a stream: the leaf count, then each root's
+        held nodes in preorder as a flags byte and a hash.
+        """
+        out = bytearray(struct.pack(">Q", self.num_leaves))
+        for root in self.roots:
+            stack = [root]
+            while stack:
+                n = stack.pop()
+                if n == NIL:
+                    out.append(0)
+                    continue
+                flags = NODE_PRESENT
+                if self.flags[n] & REMEMBER:
+                    flags |= NODE_REMEMBER
+                if self.left[n] != NIL:
+                    flags |= NODE_CHILDREN
+                    stack.append(self.right[n])
+                    stack.append(self.left[n])
+                out.append(flags)
+                out += self.hashes[n * HASH_SIZE:(n + 1) * HASH_SIZE]
+        w.write(out)
+
+    def restore_pollard(self, r: BinaryIO) -> None:
+        """Read a pollard written by write_pollard, replacing this one"""
+        data = r.read(8)
+        if len(data) != 8:
+            raise ValueError("unexpected end of pollard data")
+        num_leaves = struct.unpack(">Q", data)[0]
+
+        lookahead, max_nodes = self.lookahead, self.max_nodes
+        self.__init__()
+        self.lookahead, self.max_nodes = lookahead, max_nodes
+        self.num_leaves = num_leaves
+        for _ in range(bin(num_leaves).count("1")):
+            self.roots.append(self._read_tree(r))
+
+    def _read_tree(self, r: BinaryIO) -> int:
+        root = NIL
+        # (parent, is left child) for each node still to be read
+        stack = [(NIL, False)]
+        while stack:
+            par, is_left = stack.pop()
+            flags = r.read(1)
+            if len(flags) != 1:
+                raise ValueError("unexpected end of pollard data")
+            flags = flags[0]
+
+            n = NIL
+            if flags & NODE_PRESENT:
+                h = r.read(HASH_SIZE)
+                if len(h) != HASH_SIZE:
+                    raise ValueError("unexpected end of pollard data")
+                n = self._alloc(h, REMEMBER if flags & NODE_REMEMBER else 0)
+                if flags & NODE_REMEMBER:
+                    # Spend heights aren't saved
+                    self._cache(n, UNKNOWN_EXPIRY)
+                if flags & NODE_CHILDREN:
+                    stack.append((n, False))
+                    stack.append((n, True))
+            elif par != NIL:
+                raise ValueError("empty node below a root")
+
+            if par == NIL:
+                root = n
+            elif is_left:
+                self.left[par] = n
+                self.up[n] = par
+            else:
+                self.right[par] = n
+                self.up[n] = par
+        return root
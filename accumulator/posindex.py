@@ -0,0 +1,217 @@
+import struct
+import sys
+from array import array
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from .positions import remap_position
+
+# Slot values that aren't positions
+EMPTY_SLOT = 0xFFFFFFFFFFFFFFFF
+TOMBSTONE = EMPTY_SLOT - 1
+
+MIN_CAPACITY = 1024
+# Grow once live entries plus tombstones fill this share of the slots
+MAX_LOAD = 0.5
+
+INDEX_MAGIC = b"UPIX"
+INDEX_HEADER = struct.Struct(">4sQQ")  # magic, capacity, count
+
+
+def _prefix(h: bytes) -> int:
+    return int.from_bytes(h[:8], "little")
+
+
+def _array_from_le(data) -> array:
+    out = array("Q")
+    out.frombytes(data)
+    if sys.byteorder == "big":
+        out.byteswap()
+    return out
+
+
+def _array_to_le(a: array) -> bytes:
+    if sys.byteorder == "big":
+        a = array("Q", a)
+        a.byteswap()
+    return a.tobytes()
+
+
+class PositionIndex:
+    """
+    PositionIndex maps leaf hashes to forest positions. It's an open
+    addressing table with linear probing over two flat arrays: the first
+    8 bytes of each hash, and its position. Only the prefix is stored, so a
+    prefix match is confirmed by reading the full hash at the candidate
+    position from the forest storage. That's 16 bytes per slot, where a
+    dict of 32-byte keys costs well over 100 bytes per entry.
+    """
+
+    def __init__(self, data, capacity: int = MIN_CAPACITY):
+        self.data = data
+        self._alloc(max(MIN_CAPACITY, 1 << (capacity - 1).bit_length()))
+
+    def _alloc(self, capacity: int) -> None:
+        self.mask = capacity - 1
+        self.keys = array("Q", bytes(8 * capacity))
+        self.vals = array("Q", [EMPTY_SLOT]) * capacity
+        self.count = 0
+        self.used = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def capacity(self) -> int:
+        return self.mask + 1
+
+    def nbytes(self) -> int:
+        return 16 * self.capacity()
+
+    def _find(self, h: bytes) -> int:
+        """Slot holding h, or -1"""
+        key = _prefix(h)
+        keys, vals, mask = self.keys, self.vals, self.mask
+        slot = key & mask
+        while True:
+            val = vals[slot]
+            if val == EMPTY_SLOT:
+                return -1
+            if val != TOMBSTONE and keys[slot] == key and self.data.read(val) == h:
+                return slot
+            slot = (slot + 1) & mask
+
+    def _find_position(self, h: bytes, pos: int) -> int:
+        """Slot holding h at pos, found without reading the storage"""
+        key = _prefix(h)
+        keys, vals, mask = self.keys, self.vals, self.mask
+        slot = key & mask
+        while True:
+            val = vals[slot]
+            if val == EMPTY_SLOT:
+                raise KeyError(f"{h.hex()} not indexed at {pos}")
+            if val == pos and keys[slot] == key:
+                return slot
+            slot = (slot + 1) & mask
+
+    def __contains__(self, h: bytes) -> bool:
+        return self._find(bytes(h)) >= 0
+
+    def get(self, h: bytes) -> Optional[int]:
+        slot = self._find(bytes(h))
+        return None if slot < 0 else self.vals[slot]
+
+    def get_many(self, hashes: Iterable[bytes]) -> List[Optional[int]]:
+        """Positions of a block's hashes, None for those not indexed"""
+        return [self.get(h) for h in hashes]
+
+    def insert(self, h: bytes, pos: int) -> None:
+        """
+        Index h at pos. The hash must already be written at pos in the
+        storage, and mustn't be indexed already.
+        """
+        if (self.used + 1) > MAX_LOAD * self.capacity():
+            self._rehash(self.capacity() * (2 if self.count * 2 >= self.used else 1))
+
+        key = _prefix(h)
+        keys, vals, mask = self.keys, self.vals, self.mask
+        slot = key & mask
+        while vals[slot] != EMPTY_SLOT and vals[slot] != TOMBSTONE:
+            slot = (slot + 1) & mask
+        if vals[slot] == EMPTY_SLOT:
+            self.used += 1
+        keys[slot] = key
+        vals[slot] = pos
+        self.count += 1
+
+    def insert_many(self, items: Iterable[Tuple[bytes, int]]) -> None:
+        items = list(items)
+        needed = self.used + len(items)
+        if needed > MAX_LOAD * self.capacity():
+            capacity = self.capacity()
+            while needed > MAX_LOAD * capacity:
+                capacity *= 2
+            self._rehash(capacity)
+        for h, pos in items:
+            self.insert(h, pos)
+
+    def pop(self, h: bytes) -> int:
+        """Remove h and return its position. Raises KeyError if missing."""
+        slot = self._find(bytes(h))
+        if slot < 0:
+            raise KeyError(f"{bytes(h).hex()} not indexed")
+        pos = self.vals[slot]
+        self.vals[slot] = TOMBSTONE
+        self.count -= 1
+        return pos
+
+    def pop_many(self, hashes: Iterable[bytes]) -> List[int]:
+        return [self.pop(h) for h in hashes]
+
+    def move(self, h: bytes, old: int, new: int) -> None:
+        """
+        Point h, indexed at old, at new. The entry is found by position, so
+        this works after the storage at old has already been overwritten.
+        """
+        self.vals[self._find_position(h, old)] = new
+
+    def remap(self, old_rows: int, new_rows: int) -> None:
+        """Update every position for the forest growing or shrinking to new_rows rows"""
+        first_moved = 1 << old_rows
+        vals = self.vals
+        for slot, val in enumerate(vals):
+            if first_moved <= val < TOMBSTONE:
+                vals[slot] = remap_position(val, old_rows, new_rows)
+
+    def _rehash(self, capacity: int) -> None:
+        keys, vals = self.keys, self.vals
+        self._alloc(capacity)
+        mask = self.mask
+        for key, val in zip(keys, vals):
+            if val >= TOMBSTONE:
+                continue
+            slot = key & mask
+            while self.vals[slot] != EMPTY_SLOT:
+                slot = (slot + 1) & mask
+            self.keys[slot] = key
+            self.vals[slot] = val
+            self.count += 1
+        self.used = self.count
+
+    def items(self) -> Iterator[Tuple[bytes, int]]:
+        """(hash, position) pairs, with hashes read from the storage"""
+        for val in self.vals:
+            if val < TOMBSTONE:
+                yield self.data.read(val), val
+
+    def save(self, path: str) -> None:
+        """Write the index to path"""
+        with open(path, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, self.capacity(), self.count))
+            f.write(_array_to_le(self.keys))
+            f.write(_array_to_le(self.vals))
+
+    @classmethod
+    def load(cls, path: str, data) -> "PositionIndex":
+        """Read an index written by save, confirming against data"""
+        with open(path, "rb") as f:
+            header = f.read(INDEX_HEADER.size)
+            if len(header) != INDEX_HEADER.size:
+                raise ValueError(f"{path}: truncated header")
+            magic, capacity, count = INDEX_HEADER.unpack(header)
+            if magic != INDEX_MAGIC:
+                raise ValueError(f"{path}: not a position index")
+            if capacity < MIN_CAPACITY or capacity & (capacity - 1):
+                raise ValueError(f"{path}: bad capacity {capacity}")
+
+            keys = f.read(8 * capacity)
+            vals = f.read(8 * capacity)
+            if len(keys) != 8 * capacity or len(vals) != 8 * capacity:
+                raise ValueError(f"{path}: expected {capacity} slots")
+
+        index = cls.__new__(cls)
+        index.data = data
+        index.mask = capacity - 1
+        index.keys = _array_from_le(keys)
+        index.vals = _array_from_le(vals)
+        index.count = count
+        index.used = capacity - index.vals.count(EMPTY_SLOT)
+        return index
@@ -0,0 +1,134 @@
+"""
+Position arithmetic for the utreexo forest.
+
+Every node in a forest of forest_rows rows has a position. Row 0 holds
+positions 0 .. 2**forest_rows - 1, row 1 the next 2**(forest_rows - 1)
+positions, and so on up to the single position in the top row, so
+positions are row-major and sorting them sorts by row first.
+"""
+from typing import Iterable, List
+
+
+def tree_rows(num_leaves: int) -> int:
+    """Number of rows needed to hold num_leaves leaves"""
+    if num_leaves == 0:
+        return 0
+    return (num_leaves - 1).bit_length()
+
+
+def num_positions(forest_rows: int) -> int:
+    """Number of positions in a forest of forest_rows rows"""
+    return (2 << forest_rows) - 1
+
+
+def row_offset(row: int, forest_rows: int) -> int:
+    """First position of a row"""
+    return (2 << forest_rows) - (2 << (forest_rows - row))
+
+
+def detect_row(pos: int, forest_rows: int) -> int:
+    """Row a position is in"""
+    marker = 1 << forest_rows
+    row = 0
+    while pos & marker:
+        marker >>= 1
+        row += 1
+    return row
+
+
+def parent(pos: int, forest_rows: int) -> int:
+    """Position of the parent of pos"""
+    return (pos >> 1) | (1 << forest_rows)
+
+
+def left_child(pos: int, forest_rows: int) -> int:
+    """Position of the left child of pos; the right child is one more"""
+    return (pos << 1) & ((2 << forest_rows) - 1)
+
+
+def left_descendant(pos: int, depth: int, forest_rows: int) -> int:
+    """Leftmost descendant of pos depth rows below it"""
+    for _ in range(depth):
+        pos = left_child(pos, forest_rows)
+    return pos
+
+
+def root_position(num_leaves: int, row: int, forest_rows: int) -> int:
+    """Position of the root at row, if num_leaves has one there"""
+    mask = (2 << forest_rows) - 1
+    before = num_leaves & (mask << (row + 1))
+    shifted = (before >> row) | (mask << (forest_rows + 1 - row))
+    return shifted & mask
+
+
+def is_root_position(pos: int, num_leaves: int, forest_rows: int) -> bool:
+    """Whether pos is the position of one of the roots"""
+    row = detect_row(pos, forest_rows)
+    return bool((num_leaves >> row) & 1) and \
+        root_position(num_leaves, row, forest_rows) == pos
+
+
+def root_positions(num_leaves: int, forest_rows: int) -> List[int]:
+    """Positions of all roots, tallest first"""
+    return [
+        root_position(num_leaves, row, forest_rows)
+        for row in range(forest_rows, -1, -1)
+        if (num_leaves >> row) & 1
+    ]
+
+
+def remap_position(pos: int, old_rows: int, new_rows: int) -> int:
+    """Position of the same node after the forest grows to new_rows rows"""
+    row = detect_row(pos, old_rows)
+    return pos - row_offset(row, old_rows) + row_offset(row, new_rows)
+
+
+def targets_by_row(targets: Iterable[int], num_leaves: int, forest_rows: int) -> List[List[int]]:
+    """
+    Split targets into sorted, deduplicated lists per row, checking that
+    each is a position inside one of the trees.
+    """
+    by_row = [[] for _ in range(forest_rows + 1)]
+    row = 0
+    row_end = 1 << forest_rows
+    for pos in sorted(set(targets)):
+        while pos >= row_end:
+            row += 1
+            if row > forest_rows:
+                raise ValueError(f"position {pos} is not in the forest")
+            row_end += 1 << (forest_rows - row)
+        if pos - row_offset(row, forest_rows) >= num_leaves >> row:
+            raise ValueError(f"position {pos} is not in the forest")
+        by_row[row].append(pos)
+    return by_row
+
+
+def proof_positions(targets: Iterable[int], num_leaves: int, forest_rows: int) -> List[int]:
+    """
+    Positions whose hashes are needed to prove targets, in ascending order.
+
+    All targets are walked up together a row at a time: each row is the
+    sorted union of that row's targets and the parents of the row below,
+    so shared ancestors are only visited once, and a sibling that is
+    itself in the row is computed rather than needed.
+    """
+    by_row = targets_by_row(targets, num_leaves, forest_rows)
+    needed = []
+    nodes: List[int] = []
+    for row in range(forest_rows + 1):
+        if by_row[row]:
+            nodes = sorted(set(nodes).union(by_row[row])) if nodes else by_row[row]
+        if not nodes:
+            continue
+
+        if (num_leaves >> row) & 1 and nodes[-1] == root_position(num_leaves, row, forest_rows):
+            nodes.pop()
+
+        in_row = set(nodes)
+        needed.extend([pos ^ 1 for pos in nodes if pos ^ 1 not in in_row])
+
+        # nodes are sorted, so siblings' shared parent comes out twice in a row
+        top = 1 << forest_rows
+        nodes = list(dict.fromkeys([(pos >> 1) | top for pos in nodes]))
+
+    return needed
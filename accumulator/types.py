@@ -0,0 +1,35 @@
+import hashlib
+from dataclasses import dataclass
+
+HASH_SIZE = 32
+
+# Hash of a position with no node in it
+EMPTY_HASH = bytes(HASH_SIZE)
+
+
+class Hash(bytes):
+    """32-byte hash of a node in the accumulator"""
+    def __new__(cls, data):
+        if isinstance(data, (bytes, bytearray, memoryview)) and len(data) == HASH_SIZE:
+            return super().__new__(cls, data)
+        raise ValueError("Hash must be 32 bytes")
+
+    def __str__(self) -> str:
+        return self.hex()
+
+
+@dataclass
+class Leaf:
+    """
+    A leaf to add to the accumulator, whether a Pollard should cache it,
+    and how many blocks until it's spent (0 if unknown), which decides what
+    a Pollard over its memory budget evicts first
+    """
+    hash: bytes = EMPTY_HASH
+    remember: bool = False
+    ttl: int = 0
+
+
+def parent_hash(left: bytes, right: bytes) -> bytes:
+    """Hash of a parent node from its two children, using SHA512/256"""
+    return hashlib.sha512(left + right).digest()[:HASH_SIZE]
@@ -0,0 +1,224 @@
+import mmap
+import os
+import struct
+from typing import Iterator, Optional, Tuple
+
+from bridge.server import BlockStore
+from btcacc import UData
+from wire.umsgblock import FRAME_HEADER, UBlock
+
+# Index entry per height: frame offset in the data file, payload length,
+# and where the UData starts within the payload
+INDEX_ENTRY = struct.Struct(">QII")
+# A v1 UData starts with its height and TTL count, then the TTLs
+TTL_HEADER = struct.Struct(">iI")
+TTL = struct.Struct(">i")
+# Appends whose index entries are held back before a flush
+INDEX_BATCH = 1000
+
+
+class UBlockArchive(BlockStore):
+    """
+    UBlockArchive is the bridge's append-only store of UBlocks, one per
+    height from 0. The data file holds them as network frames back to
+    back, so a range can be sent to a CSN straight from the file, and the
+    index file holds a fixed-width entry per height pointing into it.
+
+    Records are v1 UBlocks, whose fixed-width TTLs can be filled in after
+    the block is written. Reads go through mmaps of both files; records
+    returned as memoryviews stay valid until the archive is closed.
+
+    Index entries are held in memory, and written to the index file only
+    once the data they point to is fsynced: on flush, which appends do
+    every INDEX_BATCH records. So an entry on disk never covers a record
+    that isn't, and a crash loses at most the records since the last
+    flush. Opening the archive drops any data past the index, and a torn
+    index entry from a crash mid-flush.
+    """
+
+    def __init__(self, path: str):
+        self.data_path = path + ".dat"
+        self.index_path = path + ".idx"
+        for p in (self.data_path, self.index_path):
+            if not os.path.exists(p):
+                open(p, "wb").close()
+
+        self.data = open(self.data_path, "r+b")
+        self.index = open(self.index_path, "r+b")
+        self._data_map: Optional[mmap.mmap] = None
+        self._index_map: Optional[mmap.mmap] = None
+        self.count = 0
+        # Records whose index entries are in the index file; the rest's
+        # are in pending
+        self.synced = 0
+        self.pending = bytearray()
+        self.data_size = 0
+        self.recover()
+
+    def recover(self) -> None:
+        """Cut the files back to the last complete record"""
+        data_size = os.fstat(self.data.fileno()).st_size
+        count = os.fstat(self.index.fileno()).st_size // INDEX_ENTRY.size
+        self.synced = count
+        self.pending.clear()
+
+        self.data_size = 0
+        while count:
+            offset, length, _ = self._read_entry(count - 1, direct=True)
+            end = offset + FRAME_HEADER.size + length
+            if end <= data_size:
+                self.data.seek(offset)
+                if self.data.read(FRAME_HEADER.size) == FRAME_HEADER.pack(length):
+                    self.data_size = end
+                    break
+            count -= 1
+
+        self.count = self.synced = count
+        self._unmap()
+        self.index.truncate(count * INDEX_ENTRY.size)
+        self.data.truncate(self.data_size)
+
+    def _read_entry(self, height: int, direct: bool = False) -> Tuple[int, int, int]:
+        if height >= self.synced:
+            return INDEX_ENTRY.unpack_from(self.pending, (height - self.synced) * INDEX_ENTRY.size)
+        if direct:
+            self.index.seek(height * INDEX_ENTRY.size)
+            return INDEX_ENTRY.unpack(self.index.read(INDEX_ENTRY.size))
+        return INDEX_ENTRY.unpack_from(self._map_index(), height * INDEX_ENTRY.size)
+
+    def _unmap(self) -> None:
+        # Not closed: records handed out may still point into them
+        self._data_map = None
+        self._index_map = None
+
+    def _map_data(self) -> mmap.mmap:
+        if self._data_map is None or len(self._data_map) < self.data_size:
+            self.data.flush()
+            self._data_map = mmap.mmap(self.data.fileno(), self.data_size, access=mmap.ACCESS_READ)
+        return self._data_map
+
+    def _map_index(self) -> mmap.mmap:
+        size = self.synced * INDEX_ENTRY.size
+        if self._index_map is None or len(self._index_map) < size:
+            self._index_map = mmap.mmap(self.index.fileno(), size, access=mmap.ACCESS_READ)
+        return self._index_map
+
+    def num_heights(self) -> int:
+        return self.count
+
+    def append(self, payload: bytes, udata_offset: int) -> int:
+        """
+        Append a serialized UBlock whose UData starts at udata_offset.
+        Returns its height.
+        """
+        if not 0 <= udata_offset <= len(payload):
+            raise ValueError(f"udata offset {udata_offset} outside {len(payload)} byte record")
+
+        self.data.seek(self.data_size)
+        self.data.write(FRAME_HEADER.pack(len(payload)) + payload)
+        self.pending += INDEX_ENTRY.pack(self.data_size, len(payload), udata_offset)
+
+        self.data_size += FRAME_HEADER.size + len(payload)
+        self.count += 1
+        if self.count - self.synced >= INDEX_BATCH:
+            self.flush()
+        return self.count - 1
+
+    def append_ublock(self, ub: UBlock) -> int:
+        """Append ub, which must be for the next height"""
+        if ub.utreexo_data.height != self.count:
+            raise ValueError(f"UBlock for height {ub.utreexo_data.height}, archive is at {self.count}")
+        frame = ub.serialize_frame()
+        return self.append(frame[FRAME_HEADER.size:], ub.block.msg_block.serialize_size())
+
+    def set_ttl(self, height: int, txo: int, ttl: int) -> None:
+        """Fill in the TTL of the txo'th output of the block at height"""
+        self._check_height(height)
+        offset, _, udata_offset = self._read_entry(height)
+        start = offset + FRAME_HEADER.size + udata_offset
+        _, count = TTL_HEADER.unpack_from(self._map_data(), start)
+        if not 0 <= txo < count:
+            raise ValueError(f"no output {txo} in block {height} of {count} outputs")
+
+        # Written in place, under any records handed out
+        self.data.flush()
+        os.pwrite(self.data.fileno(), TTL.pack(ttl), start + TTL_HEADER.size + TTL.size * txo)
+
+    def extend(self, other: "UBlockArchive") -> None:
+        """Append all of other's records, as they are"""
+        for height in range(other.num_heights()):
+            offset, length, udata_offset = other._read_entry(height)
+            start = offset + FRAME_HEADER.size
+            self.append(memoryview(other._map_data())[start:start + length], udata_offset)
+
+    def _check_height(self, height: int) -> None:
+        if not 0 <= height < self.count:
+            raise ValueError(f"height {height} not in archive of {self.count}")
+
+    def record(self, height: int) -> memoryview:
+        """The serialized UBlock at height"""
+        self._check_height(height)
+        offset, length, _ = self._read_entry(height)
+        start = offset + FRAME_HEADER.size
+        return memoryview(self._map_data())[start:start + length]
+
+    def udata_record(self, height: int) -> memoryview:
+        """The serialized UData at height"""
+        self._check_height(height)
+        offset, length, udata_offset = self._read_entry(height)
+        start = offset + FRAME_HEADER.size
+        return memoryview(self._map_data())[start + udata_offset:start + length]
+
+    def ublock(self, height: int) -> UBlock:
+        return UBlock.from_bytes(self.record(height))
+
+    def udata(self, height: int) -> UData:
+        return UData.from_buffer(self.udata_record(height))
+
+    def scan(self, start: int, end: int) -> Iterator[memoryview]:
+        """Records for heights start to end, in order"""
+        for height in range(start, end + 1):
+            yield self.record(height)
+
+    def span(self, start: int, end: int) -> Tuple[str, int, int]:
+        self._check_height(start)
+        self._check_height(end)
+        first, _, _ = self._read_entry(start)
+        last, length, _ = self._read_entry(end)
+        # The server reads the file itself
+        self.data.flush()
+        return self.data_path, first, last + FRAME_HEADER.size + length - first
+
+    def truncate(self, height: int) -> None:
+        """
+        Drop the records from height on, as for a reorg. Records already
+        handed out for those heights mustn't be used afterwards.
+        """
+        if not 0 <= height <= self.count:
+            raise ValueError(f"can't truncate archive of {self.count} to {height}")
+        if height == self.count:
+            return
+        self.flush()
+        self.data_size = self._read_entry(height)[0]
+        self.count = self.synced = height
+        self._unmap()
+        self.index.truncate(height * INDEX_ENTRY.size)
+        self.data.truncate(self.data_size)
+
+    def flush(self) -> None:
+        """Make the appended records durable, data before index"""
+        self.data.flush()
+        os.fsync(self.data.fileno())
+        if self.pending:
+            self.index.seek(self.synced * INDEX_ENTRY.size)
+            self.index.write(self.pending)
+            self.pending.clear()
+            self.synced = self.count
+        self.index.flush()
+        os.fsync(self.index.fileno())
+
+    def close(self) -> None:
+        self.flush()
+        self._unmap()
+        self.data.close()
+        self.index.close()
@@ -0,0 +1,67 @@
+from dataclasses import replace
+from typing import List, Sequence
+
+from accumulator import BatchProof, Leaf, Pollard
+from accumulator.positions import proof_positions, tree_rows
+from btcacc import UData, leaf_hashes
+from util import dedupe_block
+from wire.umsgblock import UBlock
+
+
+class CacheSimulator:
+    """
+    CacheSimulator runs a shadow of one CSN's Pollard for the length of a
+    session, so the bridge knows which proof hashes the CSN already holds.
+    It starts from the roots the CSN announced and applies each block the
+    same way the CSN's put_block_in_pollard does, so both stay identical.
+    """
+
+    def __init__(self, lookahead: int, num_leaves: int, roots: Sequence[bytes],
+                 max_nodes: int = 0):
+        self.pollard = Pollard.from_roots(num_leaves, roots)
+        self.pollard.lookahead = lookahead
+        self.pollard.max_nodes = max_nodes
+
+    @property
+    def lookahead(self) -> int:
+        return self.pollard.lookahead
+
+    def trim(self, proof: BatchProof) -> BatchProof:
+        """A copy of proof with the hashes the CSN holds left out (None)"""
+        num_leaves = self.pollard.num_leaves
+        needed = proof_positions(proof.targets, num_leaves, tree_rows(num_leaves))
+        if len(needed) != len(proof.proof):
+            raise ValueError(
+                f"proof has {len(proof.proof)} hashes, targets need {len(needed)}"
+            )
+
+        return BatchProof(
+            targets=list(proof.targets),
+            proof=[
+                None if self.pollard.read_position(pos) is not None else h
+                for pos, h in zip(needed, proof.proof)
+            ],
+        )
+
+    def process(self, udata: UData, adds: List[Leaf]) -> UData:
+        """
+        Trim udata's proof for the CSN, then apply the block to the shadow.
+        adds must be the block's new leaves with remember flags from
+        udata.remember_flags(self.lookahead) and TTLs from udata.txo_ttls,
+        as the CSN computes them.
+        Returns a copy of udata carrying the partial proof.
+        """
+        partial = self.trim(udata.acc_proof)
+        self.pollard.ingest_batch_proof(leaf_hashes(udata.stxos), udata.acc_proof)
+        self.pollard.modify(adds, udata.acc_proof.targets)
+        return replace(udata, acc_proof=partial)
+
+    def process_ublock(self, ub: UBlock) -> UBlock:
+        """process for a whole UBlock, working out its adds as the CSN does"""
+        udata = ub.utreexo_data
+        _, out_count, _, out_skip = dedupe_block(ub.block)
+        adds = UBlock.block_to_add_leaves(
+            ub.block, udata.remember_flags(self.lookahead), out_skip, udata.height,
+            out_count, udata.txo_ttls,
+        )
+        return UBlock(self.process(udata, adds), ub.block)
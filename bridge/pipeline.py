@@ -0,0 +1,283 @@
+import io
+import os
+import struct
+from array import array
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from queue import Queue
+from threading import Thread
+from typing import Any, Callable, Deque, Iterable, Iterator, List, Optional, Tuple
+
+from btcd.btcutil import Block
+from btcd.wire import MsgBlock
+
+from accumulator import HASH_SIZE, Forest, Leaf, UndoRecord
+from bridge.archive import UBlockArchive
+from bridge.reproof import ForestCheckpoints
+from bridge.ttlindex import TTLIndexer
+from bridge.utxostore import LeafDataStore
+from btcacc import LeafData, LeafDataTable, UData, leaf_hashes
+from util import block_to_del_ops, dedupe_block, outpoint_to_bytes
+from wire.umsgblock import UBlock
+
+# Bytes of an outpoint packed with outpoint_to_bytes
+OUTPOINT_SIZE = HASH_SIZE + 4
+
+# Items each stage may hold ahead of the next one
+PIPELINE_DEPTH = 64
+# Blocks the prover can roll back for a reorg
+UNDO_DEPTH = 100
+
+# Network magic and little-endian size ahead of each block in a blocks file
+BLOCK_RECORD = struct.Struct("<4sI")
+
+# Marks the end of the input, and of the writer's queue
+_END = object()
+
+
+class ProofPipeline:
+    """
+    ProofPipeline runs proof generation as three stages, so that only the
+    stage which has to be sequential is. prepare runs in an executor
+    (processes by default, so it must be a picklable top-level function)
+    for several items at once; prove runs on the calling thread, on each
+    prepared item in input order; and write runs on its own thread, on
+    each proved item in the same order.
+
+    Each stage holds at most depth items ahead of the next, so memory
+    stays bounded however far the input runs ahead. The first error from
+    any stage stops the pipeline and is raised from run.
+    """
+
+    def __init__(self, prepare: Callable[[Any], Any], prove: Callable[[Any], Any],
+                 write: Callable[[Any], Any], executor: Optional[Executor] = None,
+                 depth: int = PIPELINE_DEPTH):
+        if depth < 1:
+            raise ValueError(f"pipeline depth {depth} must be at least 1")
+        self.prepare = prepare
+        self.prove = prove
+        self.write = write
+        self.executor = executor
+        self.depth = depth
+
+    def run(self, items: Iterable[Any]) -> int:
+        """Push items through all three stages; returns the number written"""
+        executor = self.executor or ProcessPoolExecutor()
+        written = Queue(self.depth)
+        errors: List[BaseException] = []
+        writer = Thread(target=self._write_all, args=(written, errors), daemon=True)
+        writer.start()
+
+        pending: Deque[Future] = deque()
+        count = 0
+        try:
+            items = iter(items)
+            more = True
+            while True:
+                while more and len(pending) < self.depth:
+                    item = next(items, _END)
+                    if item is _END:
+                        more = False
+                    else:
+                        pending.append(executor.submit(self.prepare, item))
+                if not pending:
+                    break
+
+                result = self.prove(pending.popleft().result())
+                if errors:
+                    break
+                written.put(result)
+                count += 1
+        finally:
+            for future in pending:
+                future.cancel()
+            # The writer drains the queue even after an error, so this
+            # can't block for good
+            written.put(_END)
+            writer.join()
+            if self.executor is None:
+                executor.shutdown(cancel_futures=True)
+
+        if errors:
+            raise errors[0]
+        return count
+
+    def _write_all(self, written: Queue, errors: List[BaseException]) -> None:
+        while True:
+            item = written.get()
+            if item is _END:
+                return
+            if errors:
+                continue
+            try:
+                self.write(item)
+            except BaseException as e:
+                errors.append(e)
+
+
+@dataclass
+class PreparedBlock:
+    """
+    A block parsed and hashed by a worker. Everything in it is flat, so
+    it's cheap to send back from a worker process, and the block itself
+    stays serialized: the parent never parses it.
+    """
+    height: int
+    raw: bytes
+    leaf_datas: LeafDataTable
+    # 32 bytes per leaf_datas entry
+    leaf_hashes: bytes
+    # Spent outpoints, packed with outpoint_to_bytes
+    del_keys: bytes
+    out_count: int
+
+    def adds(self) -> List[Leaf]:
+        h = self.leaf_hashes
+        return [Leaf(hash=h[i:i + HASH_SIZE]) for i in range(0, len(h), HASH_SIZE)]
+
+    def spent_keys(self) -> List[bytes]:
+        k = self.del_keys
+        return [k[i:i + OUTPOINT_SIZE] for i in range(0, len(k), OUTPOINT_SIZE)]
+
+
+def prepare_block(item: Tuple[int, bytes]) -> PreparedBlock:
+    """
+    The parallel stage of the bridge's pipeline: parse a serialized block
+    at a height, dedupe it, and hash the leaves it adds
+    """
+    height, raw = item
+    msg_block = MsgBlock()
+    msg_block.deserialize(io.BytesIO(raw))
+    blk = Block(msg_block)
+
+    _, out_count, _, out_skip = dedupe_block(blk)
+    leaf_datas, _ = UBlock.block_leaf_datas(blk, out_skip, height)
+    table = LeafDataTable.from_leaves(leaf_datas)
+    del_keys = b"".join(outpoint_to_bytes(op.hash, op.index) for op in block_to_del_ops(blk))
+    return PreparedBlock(height, raw, table, b"".join(leaf_hashes(table)), del_keys, out_count)
+
+
+@dataclass
+class ProvedBlock:
+    """A block's UData, with the block still serialized"""
+    height: int
+    raw: bytes
+    udata: UData
+
+    def record(self) -> Tuple[bytearray, int]:
+        """The UBlock as an archive record, and where its UData starts"""
+        buf = bytearray(len(self.raw) + self.udata.serialize_size())
+        buf[:len(self.raw)] = self.raw
+        self.udata.serialize_into(buf, len(self.raw))
+        return buf, len(self.raw)
+
+
+@dataclass
+class BlockUndo:
+    """What the prover needs to roll a block back"""
+    height: int
+    forest: UndoRecord
+    spent: List[LeafData]
+    created: LeafDataTable
+
+
+class BlockProver:
+    """
+    The sequential stage of the bridge's pipeline: prove a prepared
+    block's spends against the forest, then apply the block to it and to
+    the store of unspent LeafData. With checkpoints, the forest is saved
+    there every so many blocks.
+
+    Undo data is kept for the last undo_depth blocks, so a reorg that
+    deep is handled by rollback rather than a rebuild from a checkpoint.
+    """
+
+    def __init__(self, forest: Forest, utxos: LeafDataStore,
+                 checkpoints: Optional[ForestCheckpoints] = None,
+                 undo_depth: int = UNDO_DEPTH):
+        self.forest = forest
+        self.utxos = utxos
+        self.checkpoints = checkpoints
+        self.undo: Deque[BlockUndo] = deque(maxlen=undo_depth)
+
+    def __call__(self, prepared: PreparedBlock) -> ProvedBlock:
+        del_leaves = self.utxos.spend_keys(prepared.spent_keys())
+        udata = UData.gen_udata(del_leaves, self.forest, prepared.height)
+        # Placeholders, filled in once the outputs are spent
+        udata.txo_ttls = array("i", bytes(4 * prepared.out_count))
+        undo = self.forest.modify(prepared.adds(), udata.acc_proof.targets)
+        self.utxos.add(prepared.leaf_datas)
+        self.utxos.end_block()
+        if self.undo.maxlen:
+            self.undo.append(BlockUndo(prepared.height, undo, del_leaves, prepared.leaf_datas))
+        if self.checkpoints is not None:
+            self.checkpoints.after_block(self.forest, prepared.height)
+        return ProvedBlock(prepared.height, prepared.raw, udata)
+
+    def rollback(self, height: int, archive: UBlockArchive,
+                 ttls: Optional[TTLIndexer] = None) -> None:
+        """
+        Undo the blocks from height on, for a reorg, and drop their now
+        stale UBlocks from archive first, along with the TTLs ttls indexed
+        for them. Not while the pipeline runs.
+        """
+        first = self.undo[0].height if self.undo else archive.num_heights()
+        if height < first:
+            raise ValueError(f"can't roll back to {height}: undo data starts at {first}")
+
+        if ttls is not None:
+            ttls.rollback(height)
+        archive.truncate(min(height, archive.num_heights()))
+        while self.undo and self.undo[-1].height >= height:
+            block = self.undo.pop()
+            self.forest.undo(block.forest)
+            self.utxos.remove(block.created)
+            self.utxos.add(block.spent)
+        if self.checkpoints is not None:
+            self.checkpoints.discard(height)
+
+
+def build_archive(forest: Forest, archive, blocks: Iterable[Tuple[int, bytes]],
+                  utxos: LeafDataStore, workers: Optional[int] = None,
+                  checkpoints: Optional[ForestCheckpoints] = None) -> int:
+    """
+    Prove (height, serialized block) pairs in order and append the
+    UBlocks to a UBlockArchive. Returns the number appended. The archive
+    is written from another thread, so it mustn't be served meanwhile.
+    """
+    def write(proved: ProvedBlock) -> None:
+        if archive.append(*proved.record()) != proved.height:
+            raise ValueError(f"block {proved.height} appended at {archive.num_heights() - 1}")
+
+    with ProcessPoolExecutor(workers) as executor:
+        pipeline = ProofPipeline(prepare_block, BlockProver(forest, utxos, checkpoints),
+                                 write, executor)
+        return pipeline.run(blocks)
+
+
+def read_block_file(path: str, start: int = 0) -> Iterator[Tuple[int, bytes]]:
+    """
+    (height, serialized block) pairs from start on, from a file of blocks
+    in height order, each after its network magic and size as in a
+    linearized bootstrap.dat. Earlier blocks are skipped by seeking. Ends
+    at the first incomplete or zeroed record.
+    """
+    with open(path, "rb") as f:
+        height = 0
+        while True:
+            header = f.read(BLOCK_RECORD.size)
+            if len(header) < BLOCK_RECORD.size:
+                return
+            magic, size = BLOCK_RECORD.unpack(header)
+            if magic == bytes(4):
+                return
+
+            if height < start:
+                f.seek(size, os.SEEK_CUR)
+            else:
+                raw = f.read(size)
+                if len(raw) < size:
+                    return
+                yield height, raw
+            height += 1
@@ -0,0 +1,170 @@
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from accumulator import DiskForestData, Forest, Hash
+from accumulator.positions import root_positions
+from bridge.archive import UBlockArchive
+from btcacc import UData
+from util import dedupe_block
+from wire.umsgblock import FRAME_HEADER, UBlock
+
+# Blocks between forest checkpoints
+CHECKPOINT_INTERVAL = 10000
+
+_CHECKPOINT_NAME = re.compile(r"forest-(\d+)\.meta$")
+
+
+class ForestCheckpoints:
+    """
+    ForestCheckpoints keeps copies of the bridge's Forest in a directory,
+    one every interval blocks, named by the number of blocks applied to
+    them. They're what lets proofs for the chain be regenerated in
+    parallel: each range between two checkpoints is independent.
+    """
+
+    def __init__(self, directory: str, interval: int = CHECKPOINT_INTERVAL):
+        if interval < 1:
+            raise ValueError(f"checkpoint interval {interval} must be at least 1")
+        self.directory = directory
+        self.interval = interval
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, height: int) -> str:
+        return os.path.join(self.directory, f"forest-{height}")
+
+    def after_block(self, forest: Forest, height: int) -> None:
+        """Save forest if it's due, once the block at height is applied"""
+        if (height + 1) % self.interval == 0:
+            forest.save(self.path(height + 1))
+
+    def discard(self, height: int) -> None:
+        """Remove the checkpoints past height, as after a reorg to it"""
+        for h in self.heights():
+            if h > height:
+                # .meta first, so a partly removed checkpoint isn't complete
+                for suffix in (".meta", "", ".idx"):
+                    if os.path.exists(self.path(h) + suffix):
+                        os.remove(self.path(h) + suffix)
+
+    def roots(self, height: int) -> List[Hash]:
+        """Root hashes of the checkpoint for height, read without its index"""
+        path = self.path(height)
+        with open(path + ".meta", "rb") as f:
+            num_leaves, rows = Forest.META.unpack(f.read())
+        data = DiskForestData(path, 0)
+        try:
+            return [Hash(data.read(pos)) for pos in root_positions(num_leaves, rows)]
+        finally:
+            data.close()
+
+    def heights(self) -> List[int]:
+        """Heights of the complete checkpoints, in order"""
+        return sorted(
+            int(m.group(1)) for m in map(_CHECKPOINT_NAME.match, os.listdir(self.directory)) if m
+        )
+
+
+def reproof_ranges(checkpoints: List[int], end: int) -> List[Tuple[int, int]]:
+    """
+    Split heights 0 to end - 1 into ranges that each start at a
+    checkpoint, or at 0 with an empty forest
+    """
+    starts = [0] + [h for h in checkpoints if 0 < h < end]
+    return [(start, stop) for start, stop in zip(starts, starts[1:] + [end]) if start < stop]
+
+
+def reproof_range(archive_path: str, checkpoint: Optional[str], start: int, end: int,
+                  out_path: str) -> List[Hash]:
+    """
+    Regenerate the UData for heights start to end - 1 of an archive into a
+    new archive at out_path, starting from a copy of the checkpoint for
+    start (None for an empty forest). The spent LeafData and TTLs are kept
+    from the old UData. Runs in a worker process; returns the forest's
+    roots after the range.
+    """
+    archive = UBlockArchive(archive_path)
+    out = UBlockArchive(out_path)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(out_path) or None) as scratch:
+        forest_path = os.path.join(scratch, "forest")
+        if checkpoint is not None:
+            for suffix in ("", ".idx", ".meta"):
+                shutil.copyfile(checkpoint + suffix, forest_path + suffix)
+        forest = Forest.open(forest_path)
+        try:
+            for height in range(start, end):
+                ub = archive.ublock(height)
+                old = ub.utreexo_data
+                udata = UData.gen_udata(list(old.stxos), forest, height)
+                udata.txo_ttls = old.txo_ttls
+
+                _, out_count, _, out_skip = dedupe_block(ub.block)
+                adds = UBlock.block_to_add_leaves(ub.block, [], out_skip, height, out_count)
+                forest.modify(adds, udata.acc_proof.targets)
+                # Part archives start at height 0, whatever start is
+                frame = UBlock(udata, ub.block).serialize_frame()
+                out.append(frame[FRAME_HEADER.size:], ub.block.msg_block.serialize_size())
+            end_roots = forest.get_roots()
+        finally:
+            forest.data.close()
+            out.close()
+            archive.close()
+    return end_roots
+
+
+def reproof_archive(archive_path: str, checkpoints: ForestCheckpoints, out_path: str,
+                    ttls_indexed: int, workers: Optional[int] = None) -> int:
+    """
+    Regenerate the UData of a whole archive into a new one at out_path,
+    one range per checkpoint on a pool of worker processes. The old
+    archive mustn't be written meanwhile. Returns the number of blocks.
+
+    TTLs are copied as they are, so the archive must have been indexed
+    by a TTLIndexer to its tip, given as ttls_indexed: before that its
+    TTLs are still placeholders. Each checkpoint must hold the forest
+    the range before it ends with, or nothing is written: one left from
+    another chain, or saved at the wrong height, raises ValueError.
+    """
+    archive = UBlockArchive(archive_path)
+    end = archive.num_heights()
+    archive.close()
+    if ttls_indexed < end:
+        raise ValueError(f"TTLs indexed to height {ttls_indexed} of {end}, "
+                         "the rest are placeholders")
+    ranges = reproof_ranges(checkpoints.heights(), end)
+    parts = [f"{out_path}.part-{start}" for start, _ in ranges]
+
+    try:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(reproof_range, archive_path,
+                                checkpoints.path(start) if start else None, start, stop, part)
+                for (start, stop), part in zip(ranges, parts)
+            ]
+            roots = None
+            # In order, so a bad checkpoint is reported before the range
+            # proved from it fails
+            for (start, _), future in zip(ranges, futures):
+                if roots is not None and checkpoints.roots(start) != roots:
+                    raise ValueError(f"checkpoint {checkpoints.path(start)} doesn't match "
+                                     f"the archive below height {start}")
+                roots = future.result()
+
+        out = UBlockArchive(out_path)
+        try:
+            out.truncate(0)
+            for part in parts:
+                part_archive = UBlockArchive(part)
+                out.extend(part_archive)
+                part_archive.close()
+        finally:
+            out.close()
+    finally:
+        for part in parts:
+            for suffix in (".dat", ".idx"):
+                if os.path.exists(part + suffix):
+                    os.remove(part + suffix)
+    return end
@@ -0,0 +1,159 @@
+import asyncio
+import io
+import struct
+from typing import Dict, Optional, Tuple
+
+from bridge.cachesim import CacheSimulator
+from btcacc import FLAG_PARTIAL_PROOF, UDATA_V2
+from wire.umsgblock import (
+    END_OF_RANGE, POLICY_HEADER, POLICY_MARKER, CachePolicy, UBlock,
+)
+
+DEFAULT_LISTEN = "127.0.0.1:8338"
+# Seconds open connections get to finish once the server is stopping
+SHUTDOWN_GRACE = 5.0
+
+
+class BlockStore:
+    """
+    Interface for the stored proof data a BridgeServer serves. Stored
+    UBlocks are kept as frames (a u32 length, then the UBlock), so a range
+    of them can be sent straight from the file. This base class holds no
+    blocks.
+    """
+
+    def num_heights(self) -> int:
+        """Number of heights stored, from 0"""
+        return 0
+
+    def span(self, start: int, end: int) -> Tuple[str, int, int]:
+        """File path, offset and length of the frames for heights start to end"""
+        raise NotImplementedError
+
+    def ublock(self, height: int) -> UBlock:
+        """The UBlock stored for height"""
+        raise NotImplementedError
+
+
+async def read_request(reader: asyncio.StreamReader) -> Tuple[Optional[CachePolicy], int, int]:
+    """
+    Read a block request from a stream, as read_block_request does. Raises
+    asyncio.IncompleteReadError if the client closes the connection.
+    """
+    policy = None
+    start = struct.unpack(">i", await reader.readexactly(4))[0]
+    if start == POLICY_MARKER:
+        header = await reader.readexactly(POLICY_HEADER.size)
+        roots = await reader.readexactly(32 * header[-1])
+        policy = CachePolicy.deserialize_body(io.BytesIO(header + roots))
+        start = struct.unpack(">i", await reader.readexactly(4))[0]
+
+    end = struct.unpack(">i", await reader.readexactly(4))[0]
+    if start < 0 or end < start:
+        raise ValueError(f"bad block range {start} to {end}")
+    return policy, start, end
+
+
+class BridgeServer:
+    """
+    BridgeServer serves UBlocks from a BlockStore to CSNs over TCP. A
+    client sends block requests (read_request), each answered with the
+    frames of the heights the store has in the range and END_OF_RANGE, so
+    a short range means the client reached the tip. Clients can keep
+    several requests outstanding on one connection.
+
+    Ranges are sent with loop.sendfile, which is zero-copy where the
+    platform allows. A client that opened with a CachePolicy gets its
+    blocks re-encoded with partial proofs by a CacheSimulator for the
+    connection instead, in v2 with the policy's flags as well.
+    """
+
+    def __init__(self, store: BlockStore, listen: str = DEFAULT_LISTEN):
+        self.store = store
+        self.host, port = listen.rsplit(":", 1)
+        self.port = int(port)
+        self.server: Optional[asyncio.AbstractServer] = None
+        # Connection tasks, and whether each is sending a range
+        self.clients: Dict[asyncio.Task, bool] = {}
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        # Port 0 picks a free one
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        """
+        Stop accepting clients and close the connections, giving those
+        sending a range a grace period to finish it
+        """
+        self.server.close()
+        for task, sending in list(self.clients.items()):
+            if not sending:
+                task.cancel()
+        tasks = list(self.clients)
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=SHUTDOWN_GRACE)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self.clients[task] = False
+        peer = writer.get_extra_info("peername")
+        sim = None
+        flags = 0
+        try:
+            first = True
+            while True:
+                try:
+                    policy, start, end = await read_request(reader)
+                except asyncio.IncompleteReadError:
+                    return
+
+                if policy is not None:
+                    if not first:
+                        raise ValueError("cache policy after the first request")
+                    sim = CacheSimulator(policy.lookahead, policy.num_leaves, policy.roots,
+                                         policy.max_nodes)
+                    flags = FLAG_PARTIAL_PROOF | policy.flags
+                first = False
+
+                self.clients[task] = True
+                last = min(end, self.store.num_heights() - 1)
+                if last >= start:
+                    if sim is None:
+                        await self._send_span(writer, start, last)
+                    else:
+                        await self._send_partial(writer, sim, flags, start, last)
+                writer.write(END_OF_RANGE)
+                await writer.drain()
+                self.clients[task] = False
+        except ConnectionError:
+            pass
+        except Exception as e:
+            print(f"Serving {peer}: {str(e)}")
+        finally:
+            self.clients.pop(task, None)
+            writer.close()
+
+    async def _send_span(self, writer: asyncio.StreamWriter, start: int, last: int) -> None:
+        path, offset, count = self.store.span(start, last)
+        await writer.drain()
+        # A file per send: sendfile's fallback moves the file position
+        with open(path, "rb") as f:
+            await asyncio.get_running_loop().sendfile(writer.transport, f, offset, count)
+
+    async def _send_partial(self, writer: asyncio.StreamWriter, sim: CacheSimulator,
+                            flags: int, start: int, last: int) -> None:
+        loop = asyncio.get_running_loop()
+        for height in range(start, last + 1):
+            # Off the event loop, so other clients keep being served
+            frame = await loop.run_in_executor(None, self._partial_frame, sim, flags, height)
+            writer.write(frame)
+            await writer.drain()
+
+    def _partial_frame(self, sim: CacheSimulator, flags: int, height: int) -> bytes:
+        ub = sim.process_ublock(self.store.ublock(height))
+        return ub.serialize_frame(UDATA_V2, flags)
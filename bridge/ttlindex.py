@@ -0,0 +1,181 @@
+import sqlite3
+from typing import Dict, List, Tuple
+
+from btcd.btcutil import Block
+
+from util import dedupe_block, outpoint_to_bytes
+
+# Blocks indexed between commits
+TTL_BATCH_BLOCKS = 1000
+# Outputs and spends held in memory before a commit comes early
+MAX_PENDING = 1 << 20
+# Keys per lookup query, under sqlite's bound parameter limit
+LOOKUP_CHUNK = 500
+# Blocks whose spends are kept so they can be rolled back, as many as
+# the prover keeps undo data for
+SPEND_HISTORY = 100
+
+
+class TTLIndexer:
+    """
+    TTLIndexer fills in the TTLs of a UBlockArchive: how many blocks each
+    output lives before it's spent. Blocks are indexed once each, in
+    height order. The height and output number of every output created
+    is kept in an sqlite table keyed by outpoint, and when a block spends
+    one its TTL is written into the creating block's UData in the archive.
+    Outputs never spent keep TTL 0.
+
+    Outputs and spends are batched in memory and written to the table
+    every TTL_BATCH_BLOCKS blocks, or sooner past MAX_PENDING entries, so
+    memory stays bounded over the whole chain. The archive is flushed
+    before each commit, so after a crash indexing picks up again from the
+    last committed height and redoes the same TTL writes.
+
+    The spends of the last spend_history blocks are kept in a second
+    table, so a reorg can roll indexing back and unspend their outputs.
+    """
+
+    def __init__(self, path: str, archive, batch_blocks: int = TTL_BATCH_BLOCKS,
+                 spend_history: int = SPEND_HISTORY):
+        self.archive = archive
+        self.batch_blocks = batch_blocks
+        self.spend_history = spend_history
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS txos "
+            "(outpoint BLOB PRIMARY KEY, height INTEGER NOT NULL, txo INTEGER NOT NULL) "
+            "WITHOUT ROWID"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS spends "
+            "(spend_height INTEGER NOT NULL, outpoint BLOB NOT NULL, "
+            "height INTEGER NOT NULL, txo INTEGER NOT NULL, "
+            "PRIMARY KEY (spend_height, outpoint)) WITHOUT ROWID"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'height'").fetchone()
+        self.db.commit()
+
+        # Next height to index, as committed
+        self.height = row[0] if row else 0
+        # Outputs created since the last commit: outpoint -> (height, txo)
+        self.created: Dict[bytes, Tuple[int, int]] = {}
+        # Spends of outputs created before it: (outpoint, spend height)
+        self.spent: List[Tuple[bytes, int]] = []
+        # TTLs written since the last commit: (spend height, outpoint, height, txo)
+        self.patched: List[Tuple[int, bytes, int, int]] = []
+        self.batched = 0
+
+    def index_block(self, height: int, blk: Block) -> None:
+        """Index the block at height, which must be the next one"""
+        if height != self.height:
+            raise ValueError(f"indexing block {height}, expected {self.height}")
+
+        # Outputs spent in their own block never become leaves, so both
+        # ends of those spends are skipped, as are unspendable outputs
+        _, _, in_skip, out_skip = dedupe_block(blk)
+        in_skip, out_skip = set(in_skip), set(out_skip)
+
+        txinnum = 0
+        for tx in blk.transactions:
+            for txin in tx.msg_tx.tx_in:
+                if txinnum not in in_skip:
+                    op = txin.previous_out_point
+                    key = outpoint_to_bytes(op.hash, op.index)
+                    created = self.created.pop(key, None)
+                    if created is None:
+                        self.spent.append((key, height))
+                    else:
+                        self.archive.set_ttl(created[0], created[1], height - created[0])
+                        self.patched.append((height, key) + created)
+                txinnum += 1
+
+        txonum = 0
+        for tx in blk.transactions:
+            txid = tx.hash()
+            for i in range(len(tx.msg_tx.tx_out)):
+                if txonum not in out_skip:
+                    self.created[outpoint_to_bytes(txid, i)] = (height, txonum)
+                txonum += 1
+
+        self.height += 1
+        self.batched += 1
+        if (self.batched >= self.batch_blocks
+                or len(self.created) + len(self.spent) >= MAX_PENDING):
+            self.commit()
+
+    def commit(self) -> None:
+        """Write the TTLs of the batched spends and store the batch"""
+        spent = [key for key, _ in self.spent]
+        found = {}
+        for i in range(0, len(spent), LOOKUP_CHUNK):
+            chunk = spent[i:i + LOOKUP_CHUNK]
+            found.update(
+                (key, (height, txo)) for key, height, txo in self.db.execute(
+                    "SELECT outpoint, height, txo FROM txos WHERE outpoint IN "
+                    f"({','.join('?' * len(chunk))})", chunk
+                )
+            )
+
+        for key, spend_height in self.spent:
+            if key not in found:
+                # Still pending, if the spend was recorded before its output
+                if key not in self.created:
+                    raise ValueError(f"block {spend_height} spends unknown outpoint {key.hex()}")
+                found[key] = self.created.pop(key)
+            height, txo = found[key]
+            self.archive.set_ttl(height, txo, spend_height - height)
+            self.patched.append((spend_height, key, height, txo))
+        self.archive.flush()
+
+        with self.db:
+            self.db.executemany("DELETE FROM txos WHERE outpoint = ?", ((k,) for k in spent))
+            self.db.executemany("INSERT OR REPLACE INTO spends VALUES (?, ?, ?, ?)", self.patched)
+            self.db.execute("DELETE FROM spends WHERE spend_height < ?",
+                            (self.height - self.spend_history,))
+            self.db.executemany(
+                "INSERT OR REPLACE INTO txos VALUES (?, ?, ?)",
+                ((key, height, txo) for key, (height, txo) in self.created.items())
+            )
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('height', ?)", (self.height,))
+
+        self.created.clear()
+        self.spent.clear()
+        self.patched.clear()
+        self.batched = 0
+
+    def rollback(self, height: int) -> None:
+        """
+        Undo indexing of the blocks from height on, for a reorg: the TTLs
+        their spends wrote go back to 0, and the outputs they spent or
+        created are unspent or forgotten. Call it before the archive is
+        truncated.
+        """
+        if height >= self.height:
+            return
+        if height < self.height - self.spend_history:
+            raise ValueError(f"can't roll back to {height}: spends kept from "
+                             f"{self.height - self.spend_history}")
+
+        self.commit()
+        unspent = [
+            (key, created, txo) for key, created, txo in self.db.execute(
+                "SELECT outpoint, height, txo FROM spends WHERE spend_height >= ?", (height,)
+            ) if created < height
+        ]
+        for _, created, txo in unspent:
+            self.archive.set_ttl(created, txo, 0)
+        self.archive.flush()
+
+        with self.db:
+            self.db.execute("DELETE FROM spends WHERE spend_height >= ?", (height,))
+            self.db.execute("DELETE FROM txos WHERE height >= ?", (height,))
+            self.db.executemany("INSERT OR REPLACE INTO txos VALUES (?, ?, ?)", unspent)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('height', ?)", (height,))
+        self.height = height
+
+    def close(self) -> None:
+        self.commit()
+        self.db.close()
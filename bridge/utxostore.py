@@ -0,0 +1,119 @@
+import sqlite3
+from typing import Dict, Iterable, List, Sequence, Set
+
+from btcd.wire import OutPoint
+
+from btcacc import LeafData
+from util import outpoint_to_bytes
+
+# Outputs added or spent before the cache is written out
+UTXO_CACHE_SIZE = 1 << 20
+# Blocks between flushes, however few outputs they touched
+UTXO_FLUSH_BLOCKS = 1000
+# Keys per lookup query, under sqlite's bound parameter limit
+LOOKUP_CHUNK = 500
+
+
+class LeafDataStore:
+    """
+    LeafDataStore holds the LeafData of every unspent output, for the
+    bridge to prove spends with. It's keyed by the 36-byte packed outpoint
+    and kept in an sqlite table, with LeafData in the compact encoding.
+
+    Writes go to a cache first: outputs added since the last flush are
+    only in memory, and spends of outputs already on disk are recorded
+    there to be deleted. An output spent before it reaches the disk, as
+    most are, never touches it. The cache is written out in one
+    transaction once it holds cache_size entries, every flush_blocks
+    blocks, or on flush.
+    """
+
+    def __init__(self, path: str, cache_size: int = UTXO_CACHE_SIZE,
+                 flush_blocks: int = UTXO_FLUSH_BLOCKS):
+        self.cache_size = cache_size
+        self.flush_blocks = flush_blocks
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS utxos (outpoint BLOB PRIMARY KEY, leaf BLOB NOT NULL) "
+            "WITHOUT ROWID"
+        )
+        self.db.commit()
+
+        # Added since the last flush
+        self.added: Dict[bytes, LeafData] = {}
+        # On disk, spent since the last flush
+        self.spent: Set[bytes] = set()
+        self.blocks = 0
+
+    def add(self, leaf_datas: Iterable[LeafData]) -> None:
+        """Add a block's new outputs"""
+        for ld in leaf_datas:
+            self.added[outpoint_to_bytes(ld.tx_hash, ld.index)] = ld
+
+    def spend(self, ops: Sequence[OutPoint]) -> List[LeafData]:
+        """Remove a block's spent outputs, returning their LeafData in order"""
+        return self._take([outpoint_to_bytes(op.hash, op.index) for op in ops])
+
+    def spend_keys(self, keys: Sequence[bytes]) -> List[LeafData]:
+        """spend, for outpoints already packed with outpoint_to_bytes"""
+        return self._take(list(keys))
+
+    def remove(self, leaf_datas: Iterable[LeafData]) -> None:
+        """Take back outputs that were added, as when their block is undone"""
+        self._take([outpoint_to_bytes(ld.tx_hash, ld.index) for ld in leaf_datas])
+
+    def _take(self, keys: List[bytes]) -> List[LeafData]:
+        found = {}
+        missing = []
+        for key in keys:
+            ld = self.added.pop(key, None)
+            if ld is None:
+                missing.append(key)
+            else:
+                found[key] = ld
+
+        for i in range(0, len(missing), LOOKUP_CHUNK):
+            chunk = [key for key in missing[i:i + LOOKUP_CHUNK] if key not in self.spent]
+            if not chunk:
+                continue
+            for key, leaf in self.db.execute(
+                f"SELECT outpoint, leaf FROM utxos WHERE outpoint IN ({','.join('?' * len(chunk))})",
+                chunk
+            ):
+                found[key] = LeafData.from_compact_bytes(leaf)
+                self.spent.add(key)
+
+        if len(found) != len(keys):
+            missing = [key for key in keys if key not in found]
+            raise ValueError(f"{len(missing)} outputs not found, first {missing[0].hex()}")
+        return [found[key] for key in keys]
+
+    def end_block(self) -> None:
+        """Note a block done, flushing if the cache is due"""
+        self.blocks += 1
+        if (self.blocks >= self.flush_blocks
+                or len(self.added) + len(self.spent) >= self.cache_size):
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the cached changes to disk"""
+        with self.db:
+            self.db.executemany("DELETE FROM utxos WHERE outpoint = ?",
+                                ((key,) for key in self.spent))
+            self.db.executemany(
+                "INSERT OR REPLACE INTO utxos VALUES (?, ?)",
+                ((key, ld.to_compact_bytes()) for key, ld in self.added.items())
+            )
+        self.added.clear()
+        self.spent.clear()
+        self.blocks = 0
+
+    def __len__(self) -> int:
+        on_disk = self.db.execute("SELECT COUNT(*) FROM utxos").fetchone()[0]
+        return on_disk - len(self.spent) + len(self.added)
+
+    def close(self) -> None:
+        self.flush()
+        self.db.close()
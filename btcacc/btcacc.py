@@ -1,10 +1,22 @@
 import hashlib
 import struct
+from array import array
 from dataclasses import dataclass
-from typing import Optional, BinaryIO
-import io
+from typing import Optional, BinaryIO, Iterable, Iterator, List, Sequence, Tuple
+
+from .compress import (
+    compress_amount, decompress_amount, get_script, get_varint, put_script,
+    put_varint,
+)
 
 HASH_SIZE = 32
+MAX_PK_SCRIPT_SIZE = 10000
+
+# 32B blockhash + 32B txhash + 4B index + 4B height/coinbase +
+# 8B amount + 2B pkscript_len, followed by the pkscript itself
+LEAF_HEADER = struct.Struct(">32s32sIiqH")
+# The same header after the two hashes, for packing from column buffers
+LEAF_FIELDS = struct.Struct(">IiqH")
 
 class Hash(bytes):
     """32-byte hash type with string representation"""
@@ -51,23 +63,42 @@ class LeafData:
 
     def serialize(self, w: BinaryIO) -> None:
         """Write LeafData to binary stream"""
-        # Combine height and coinbase into single int32
+        if len(self.pk_script) > MAX_PK_SCRIPT_SIZE:
+            raise ValueError("pksize too long")
+        if len(self.block_hash) != HASH_SIZE or len(self.tx_hash) != HASH_SIZE:
+            raise ValueError("LeafData hashes must be 32 bytes")
+
+        w.write(LEAF_HEADER.pack(
+            self.block_hash, self.tx_hash, self.index,
+            self.height_code(), self.amt, len(self.pk_script)
+        ))
+        w.write(self.pk_script)
+
+    def serialize_into(self, buf: bytearray, offset: int) -> int:
+        """
+        Write LeafData into buf at offset.
+        Returns the offset just past the written bytes.
+        """
+        pk_size = len(self.pk_script)
+        if pk_size > MAX_PK_SCRIPT_SIZE:
+            raise ValueError("pksize too long")
+        if len(self.block_hash) != HASH_SIZE or len(self.tx_hash) != HASH_SIZE:
+            raise ValueError("LeafData hashes must be 32 bytes")
+
+        LEAF_HEADER.pack_into(
+            buf, offset, self.block_hash, self.tx_hash, self.index,
+            self.height_code(), self.amt, pk_size
+        )
+        offset += LEAF_HEADER.size
+        buf[offset:offset + pk_size] = self.pk_script
+        return offset + pk_size
+
+    def height_code(self) -> int:
+        """Height and coinbase flag combined into a single int32"""
         hcb = self.height << 1
         if self.coinbase:
             hcb |= 1
-
-        # Write fields
-        w.write(self.block_hash)
-        w.write(self.tx_hash)
-        w.write(struct.pack(">I", self.index))
-        w.write(struct.pack(">i", hcb))
-        w.write(struct.pack(">q", self.amt))
-        
-        if len(self.pk_script) > 10000:
-            raise ValueError("pksize too long")
-            
-        w.write(struct.pack(">H", len(self.pk_script)))
-        w.write(self.pk_script)
+        return hcb
 
     def serialize_size(self) -> int:
         """Get serialized size in bytes"""
@@ -87,7 +118,7 @@ class LeafData:
         
         # Read pkscript
         pk_size = struct.unpack(">H", r.read(2))[0]
-        if pk_size > 10000:
+        if pk_size > MAX_PK_SCRIPT_SIZE:
             raise ValueError(
                 f"bh {self.block_hash.hex()} op {self.op_string()} "
                 f"pksize {pk_size} bytes too long"
@@ -99,8 +130,474 @@ class LeafData:
         self.coinbase = bool(hcb & 1)
         self.height = hcb >> 1
 
+    def put_compact(
+        self,
+        out: bytearray,
+        omit_block_hash: bool = False,
+        txid_index: Optional[int] = None,
+    ) -> None:
+        """
+        Append LeafData in the compact (v2) encoding:
+        - varint index
+        - varint height << 1 | coinbase
+        - varint compressed amount
+        - compressed pkscript
+        - blockhash (32 bytes), left out if omit_block_hash is set, in which
+          case the reader rebuilds it from the height
+        - txhash (32 bytes), or a varint index into the enclosing message's
+          txid table if txid_index is given
+        """
+        if len(self.pk_script) > MAX_PK_SCRIPT_SIZE:
+            raise ValueError("pksize too long")
+        if self.height < 0:
+            raise ValueError(f"height {self.height} is negative")
+        if len(self.block_hash) != HASH_SIZE or len(self.tx_hash) != HASH_SIZE:
+            raise ValueError("LeafData hashes must be 32 bytes")
+
+        put_varint(out, self.index)
+        put_varint(out, self.height_code())
+        put_varint(out, compress_amount(self.amt))
+        put_script(out, self.pk_script)
+        if not omit_block_hash:
+            out += self.block_hash
+        if txid_index is None:
+            out += self.tx_hash
+        else:
+            put_varint(out, txid_index)
+
+    def to_compact_bytes(self) -> bytes:
+        """Convert to the compact (v2) encoding"""
+        out = bytearray()
+        self.put_compact(out)
+        return bytes(out)
+
+    @staticmethod
+    def from_compact_bytes(b: bytes, block_hashes=None) -> "LeafData":
+        """
+        Create LeafData from the compact (v2) encoding. block_hashes maps
+        height to block hash and is required if the block hash was omitted.
+        """
+        table = LeafDataTable()
+        if table.append_compact(memoryview(b), 0, block_hashes) != len(b):
+            raise ValueError("trailing bytes after compact LeafData")
+        return table[0]
+
     def leaf_hash(self) -> bytes:
         """Calculate leaf hash using SHA512/256"""
-        buf = io.BytesIO()
-        self.serialize(buf)
-        return hashlib.sha512(buf.getvalue()).digest()[:HASH_SIZE] 
\ No newline at end of file
+        return leaf_hashes([self])[0]
+
+
+def leaf_hashes(leaves: Sequence[LeafData]) -> List[bytes]:
+    """
+    Calculate the leaf hashes of a whole batch of LeafData at once.
+
+    All leaves are packed into one preallocated buffer with the precompiled
+    LEAF_HEADER struct, and each digest is taken over a memoryview slice of
+    it, so no per-leaf stream or bytes objects get allocated.
+    """
+    if isinstance(leaves, (LeafDataTable, LeafDataView)):
+        return leaves.leaf_hashes()
+
+    total = 0
+    for ld in leaves:
+        total += LEAF_HEADER.size + len(ld.pk_script)
+
+    buf = bytearray(total)
+    pack_into = LEAF_HEADER.pack_into
+    ends = []
+    offset = 0
+    for ld in leaves:
+        pk_size = len(ld.pk_script)
+        if pk_size > MAX_PK_SCRIPT_SIZE:
+            raise ValueError("pksize too long")
+        if len(ld.block_hash) != HASH_SIZE or len(ld.tx_hash) != HASH_SIZE:
+            raise ValueError("LeafData hashes must be 32 bytes")
+
+        hcb = ld.height << 1
+        if ld.coinbase:
+            hcb |= 1
+
+        pack_into(
+            buf, offset, ld.block_hash, ld.tx_hash, ld.index,
+            hcb, ld.amt, pk_size
+        )
+        offset += LEAF_HEADER.size
+        buf[offset:offset + pk_size] = ld.pk_script
+        offset += pk_size
+        ends.append(offset)
+
+    return _hash_records(buf, ends)
+
+
+def _hash_records(buf: bytearray, ends: Sequence[int]) -> List[bytes]:
+    """Hash consecutive serialized LeafData records ending at each offset"""
+    view = memoryview(buf)
+    sha512 = hashlib.sha512
+    hashes = []
+    start = 0
+    for end in ends:
+        hashes.append(sha512(view[start:end]).digest()[:HASH_SIZE])
+        start = end
+
+    return hashes
+
+
+class LeafDataTable:
+    """
+    Columnar storage for many LeafData entries.
+
+    Every field lives in a typed array or a contiguous buffer instead of a
+    per-entry dataclass: block hashes and txids are packed 32 bytes apiece,
+    and all pk_scripts are concatenated with an offsets array marking where
+    each one starts. Entries are materialized as LeafData only on access.
+    """
+
+    def __init__(self):
+        self.block_hashes = bytearray()
+        self.tx_hashes = bytearray()
+        self.indexes = array("I")
+        self.heights = array("i")
+        self.amounts = array("q")
+        self.coinbases = bytearray()
+        self.pk_scripts = bytearray()
+        # pk_script i is pk_scripts[script_offsets[i]:script_offsets[i + 1]]
+        self.script_offsets = array("Q", [0])
+
+    @classmethod
+    def from_leaves(cls, leaves: Iterable[LeafData]) -> "LeafDataTable":
+        """Build a table from LeafData entries"""
+        table = cls()
+        table.extend(leaves)
+        return table
+
+    def __len__(self) -> int:
+        return len(self.heights)
+
+    def __getitem__(self, i: int) -> LeafData:
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("LeafDataTable index out of range")
+
+        h = i * HASH_SIZE
+        return LeafData(
+            block_hash=bytes(self.block_hashes[h:h + HASH_SIZE]),
+            tx_hash=Hash(bytes(self.tx_hashes[h:h + HASH_SIZE])),
+            index=self.indexes[i],
+            height=self.heights[i],
+            coinbase=bool(self.coinbases[i]),
+            amt=self.amounts[i],
+            pk_script=bytes(
+                self.pk_scripts[self.script_offsets[i]:self.script_offsets[i + 1]]
+            ),
+        )
+
+    def __iter__(self) -> Iterator[LeafData]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, ld: LeafData) -> None:
+        """Add a LeafData entry to the end of the table"""
+        if len(ld.pk_script) > MAX_PK_SCRIPT_SIZE:
+            raise ValueError("pksize too long")
+        if len(ld.block_hash) != HASH_SIZE or len(ld.tx_hash) != HASH_SIZE:
+            raise ValueError("LeafData hashes must be 32 bytes")
+
+        self.block_hashes += ld.block_hash
+        self.tx_hashes += ld.tx_hash
+        self.indexes.append(ld.index)
+        self.heights.append(ld.height)
+        self.amounts.append(ld.amt)
+        self.coinbases.append(1 if ld.coinbase else 0)
+        self.pk_scripts += ld.pk_script
+        self.script_offsets.append(len(self.pk_scripts))
+
+    def append_compact(
+        self,
+        buf,
+        offset: int,
+        block_hashes=None,
+        txids: Optional[Sequence[bytes]] = None,
+    ) -> int:
+        """
+        Decode one LeafData in the compact (v2) encoding at offset and add
+        it to the table. Returns the offset just past it.
+
+        If block_hashes is given the block hash was omitted and is looked
+        up as block_hashes[height]. If txids is given the txid is stored
+        as an index into it.
+        """
+        index, offset = get_varint(buf, offset)
+        hcb, offset = get_varint(buf, offset)
+        amt, offset = get_varint(buf, offset)
+        pk_script, offset = get_script(buf, offset, MAX_PK_SCRIPT_SIZE)
+        amt = decompress_amount(amt)
+        if index > 0xFFFFFFFF or hcb > 0x7FFFFFFF or amt > 0x7FFFFFFFFFFFFFFF:
+            raise ValueError("compact LeafData field out of range")
+
+        if block_hashes is None:
+            block_hash = buf[offset:offset + HASH_SIZE]
+            offset += HASH_SIZE
+        else:
+            try:
+                block_hash = block_hashes[hcb >> 1]
+            except (IndexError, KeyError):
+                raise ValueError(f"no block hash known for height {hcb >> 1}")
+
+        if txids is None:
+            tx_hash = buf[offset:offset + HASH_SIZE]
+            offset += HASH_SIZE
+        else:
+            txid_index, offset = get_varint(buf, offset)
+            if txid_index >= len(txids):
+                raise ValueError(
+                    f"txid index {txid_index} past {len(txids)} entry table"
+                )
+            tx_hash = txids[txid_index]
+
+        if offset > len(buf):
+            raise ValueError("unexpected end of compact LeafData")
+        if len(block_hash) != HASH_SIZE:
+            raise ValueError("block hash must be 32 bytes")
+
+        self.block_hashes += block_hash
+        self.tx_hashes += tx_hash
+        self.indexes.append(index)
+        self.heights.append(hcb >> 1)
+        self.amounts.append(amt)
+        self.coinbases.append(hcb & 1)
+        self.pk_scripts += pk_script
+        self.script_offsets.append(len(self.pk_scripts))
+        return offset
+
+    def extend(self, leaves: Iterable[LeafData]) -> None:
+        """Add several LeafData entries to the end of the table"""
+        for ld in leaves:
+            self.append(ld)
+
+    def nbytes(self) -> int:
+        """Bytes held by the column buffers"""
+        columns = (self.indexes, self.heights, self.amounts, self.script_offsets)
+        return (
+            len(self.block_hashes) + len(self.tx_hashes) + len(self.coinbases)
+            + len(self.pk_scripts) + sum(c.itemsize * len(c) for c in columns)
+        )
+
+    def serialize_size(self) -> int:
+        """Get serialized size of all entries in bytes"""
+        return LEAF_HEADER.size * len(self) + len(self.pk_scripts)
+
+    def serialize_into(self, buf: bytearray, offset: int) -> int:
+        """
+        Write all entries in LeafData wire format into buf at offset.
+        Returns the offset just past the written bytes.
+        """
+        self._pack_into(buf, offset)
+        return offset + self.serialize_size()
+
+    def _pack_into(self, buf: bytearray, offset: int) -> List[int]:
+        """Serialize every entry into buf at offset, returning record ends"""
+        pack_into = LEAF_FIELDS.pack_into
+        block_hashes = memoryview(self.block_hashes)
+        tx_hashes = memoryview(self.tx_hashes)
+        scripts = memoryview(self.pk_scripts)
+        offsets = self.script_offsets
+        ends = []
+        for i in range(len(self)):
+            h = i * HASH_SIZE
+            pk_start = offsets[i]
+            pk_size = offsets[i + 1] - pk_start
+            hcb = self.heights[i] << 1
+            if self.coinbases[i]:
+                hcb |= 1
+
+            buf[offset:offset + HASH_SIZE] = block_hashes[h:h + HASH_SIZE]
+            offset += HASH_SIZE
+            buf[offset:offset + HASH_SIZE] = tx_hashes[h:h + HASH_SIZE]
+            offset += HASH_SIZE
+            pack_into(
+                buf, offset, self.indexes[i], hcb, self.amounts[i], pk_size
+            )
+            offset += LEAF_FIELDS.size
+            buf[offset:offset + pk_size] = scripts[pk_start:pk_start + pk_size]
+            offset += pk_size
+            ends.append(offset)
+
+        return ends
+
+    def serialize(self, w: BinaryIO) -> None:
+        """Write all entries in LeafData wire format with a single write"""
+        buf = bytearray(self.serialize_size())
+        self._pack_into(buf, 0)
+        w.write(buf)
+
+    def leaf_hashes(self) -> List[bytes]:
+        """Calculate the leaf hashes of all entries"""
+        buf = bytearray(self.serialize_size())
+        return _hash_records(buf, self._pack_into(buf, 0))
+
+    @classmethod
+    def deserialize(cls, r: BinaryIO, count: int) -> "LeafDataTable":
+        """Read count entries in LeafData wire format into a new table"""
+        table = cls()
+        unpack = LEAF_HEADER.unpack
+        for _ in range(count):
+            header = r.read(LEAF_HEADER.size)
+            if len(header) != LEAF_HEADER.size:
+                raise ValueError("unexpected end of LeafData stream")
+
+            bh, txid, index, hcb, amt, pk_size = unpack(header)
+            if pk_size > MAX_PK_SCRIPT_SIZE:
+                raise ValueError(f"pksize {pk_size} bytes too long")
+
+            pk_script = r.read(pk_size)
+            if len(pk_script) != pk_size:
+                raise ValueError("unexpected end of LeafData stream")
+
+            table.block_hashes += bh
+            table.tx_hashes += txid
+            table.indexes.append(index)
+            table.heights.append(hcb >> 1)
+            table.amounts.append(amt)
+            table.coinbases.append(hcb & 1)
+            table.pk_scripts += pk_script
+            table.script_offsets.append(len(table.pk_scripts))
+
+        return table
+
+
+class LeafDataView:
+    """
+    Read-only sequence of LeafData records still sitting in a wire buffer.
+
+    Only the record boundaries are decoded up front. An entry is unpacked
+    into a LeafData when it is indexed, and since the wire format is the
+    leaf hash preimage, leaf hashing reads the buffer directly.
+    """
+
+    def __init__(self, buf: memoryview, offsets: array):
+        self.buf = buf
+        # record i is buf[offsets[i]:offsets[i + 1]]
+        self.offsets = offsets
+
+    @classmethod
+    def scan(cls, buf, offset: int, count: int) -> Tuple["LeafDataView", int]:
+        """
+        Find count LeafData records starting at offset.
+        Returns the view and the offset just past the last record.
+        """
+        buf = memoryview(buf)
+        unpack_from = struct.unpack_from
+        pk_len_offset = LEAF_HEADER.size - 2
+        offsets = array("Q", [offset])
+        for _ in range(count):
+            if offset + LEAF_HEADER.size > len(buf):
+                raise ValueError("unexpected end of LeafData buffer")
+
+            pk_size = unpack_from(">H", buf, offset + pk_len_offset)[0]
+            if pk_size > MAX_PK_SCRIPT_SIZE:
+                raise ValueError(f"pksize {pk_size} bytes too long")
+
+            offset += LEAF_HEADER.size + pk_size
+            offsets.append(offset)
+
+        if offset > len(buf):
+            raise ValueError("unexpected end of LeafData buffer")
+
+        return cls(buf, offsets), offset
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> LeafData:
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("LeafDataView index out of range")
+
+        offset = self.offsets[i]
+        bh, txid, index, hcb, amt, pk_size = LEAF_HEADER.unpack_from(self.buf, offset)
+        offset += LEAF_HEADER.size
+        return LeafData(
+            block_hash=bh,
+            tx_hash=Hash(txid),
+            index=index,
+            height=hcb >> 1,
+            coinbase=bool(hcb & 1),
+            amt=amt,
+            pk_script=bytes(self.buf[offset:offset + pk_size]),
+        )
+
+    def __iter__(self) -> Iterator[LeafData]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def serialize_size(self) -> int:
+        """Get serialized size of all records in bytes"""
+        return self.offsets[-1] - self.offsets[0]
+
+    def serialize_into(self, buf: bytearray, offset: int) -> int:
+        """
+        Copy the records into buf at offset.
+        Returns the offset just past the written bytes.
+        """
+        end = offset + self.serialize_size()
+        buf[offset:end] = self.buf[self.offsets[0]:self.offsets[-1]]
+        return end
+
+    def serialize(self, w: BinaryIO) -> None:
+        """Write the records straight out of the underlying buffer"""
+        w.write(self.buf[self.offsets[0]:self.offsets[-1]])
+
+    def leaf_hashes(self) -> List[bytes]:
+        """Calculate the leaf hashes of all records without unpacking them"""
+        buf = self.buf
+        sha512 = hashlib.sha512
+        offsets = self.offsets
+        hashes = []
+        for i in range(len(self)):
+            hashes.append(
+                sha512(buf[offsets[i]:offsets[i + 1]]).digest()[:HASH_SIZE]
+            )
+
+        return hashes
+
+
+class BlockHashIndex:
+    """
+    Height to block hash table, appended to as blocks are processed.
+    Hashes are stored back to back in one buffer, 32 bytes per height.
+    """
+
+    def __init__(self, start_height: int = 0):
+        self.start_height = start_height
+        self.hashes = bytearray()
+
+    def __len__(self) -> int:
+        return self.start_height + len(self.hashes) // HASH_SIZE
+
+    def __getitem__(self, height: int) -> bytes:
+        i = height - self.start_height
+        if height < self.start_height or i >= len(self.hashes) // HASH_SIZE:
+            raise IndexError(f"no block hash for height {height}")
+        return bytes(self.hashes[i * HASH_SIZE:(i + 1) * HASH_SIZE])
+
+    def append(self, block_hash: bytes) -> None:
+        """Add the hash of the next block"""
+        if len(block_hash) != HASH_SIZE:
+            raise ValueError("block hash must be 32 bytes")
+        self.hashes += block_hash
+
+    def serialize(self, w: BinaryIO) -> None:
+        """Write the start height, count and all hashes"""
+        w.write(struct.pack(">iI", self.start_height, len(self.hashes) // HASH_SIZE))
+        w.write(self.hashes)
+
+    def deserialize(self, r: BinaryIO) -> None:
+        """Read an index written by serialize"""
+        self.start_height, count = struct.unpack(">iI", r.read(8))
+        self.hashes = bytearray(r.read(count * HASH_SIZE))
+        if len(self.hashes) != count * HASH_SIZE:
+            raise ValueError(f"expected {count} block hashes")
@@ -0,0 +1,168 @@
+"""
+Compression primitives for the compact (v2) UData encoding.
+
+Varints, amount compression and script compression follow Bitcoin Core's
+coins database serialization (serialize.h VARINT, CompressAmount and
+ScriptCompression), with the script templates extended to the segwit
+output types.
+"""
+from typing import Tuple
+
+HASH_SIZE = 32
+
+# Script template tags. Tags below NUM_SPECIAL_SCRIPTS are a template
+# followed by its hash; anything larger is a raw script of
+# (tag - NUM_SPECIAL_SCRIPTS) bytes. Tag 5 is reserved.
+SCRIPT_P2PKH = 0
+SCRIPT_P2SH = 1
+SCRIPT_P2WPKH = 2
+SCRIPT_P2WSH = 3
+SCRIPT_P2TR = 4
+NUM_SPECIAL_SCRIPTS = 6
+
+# tag: (script prefix, hash size, script suffix)
+SCRIPT_TEMPLATES = {
+    SCRIPT_P2PKH: (b"\x76\xa9\x14", 20, b"\x88\xac"),
+    SCRIPT_P2SH: (b"\xa9\x14", 20, b"\x87"),
+    SCRIPT_P2WPKH: (b"\x00\x14", 20, b""),
+    SCRIPT_P2WSH: (b"\x00\x20", 32, b""),
+    SCRIPT_P2TR: (b"\x51\x20", 32, b""),
+}
+
+
+def put_varint(out: bytearray, n: int) -> None:
+    """Append n as a Bitcoin Core style MSB base-128 varint"""
+    if n < 0:
+        raise ValueError(f"varint {n} is negative")
+
+    tmp = bytearray()
+    tmp.append(n & 0x7F)
+    while n > 0x7F:
+        n = (n >> 7) - 1
+        tmp.append((n & 0x7F) | 0x80)
+
+    tmp.reverse()
+    out += tmp
+
+
+def get_varint(buf, offset: int) -> Tuple[int, int]:
+    """Read a varint at offset. Returns the value and the next offset."""
+    n = 0
+    while True:
+        if offset >= len(buf):
+            raise ValueError("unexpected end of varint")
+
+        b = buf[offset]
+        offset += 1
+        if n > 0xFFFFFFFFFFFFFF:
+            raise ValueError("varint too large")
+
+        n = (n << 7) | (b & 0x7F)
+        if b & 0x80:
+            n += 1
+        else:
+            return n, offset
+
+
+def zigzag(n: int) -> int:
+    """Map a signed integer to an unsigned one for a varint: 0, -1, 1, -2 to 0, 1, 2, 3"""
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+
+def unzigzag(n: int) -> int:
+    """Undo zigzag"""
+    return -((n + 1) >> 1) if n & 1 else n >> 1
+
+
+def compress_amount(n: int) -> int:
+    """
+    Compress a satoshi amount. Trailing decimal zeros are moved into an
+    exponent so round amounts compress to a byte or two.
+    """
+    if n < 0:
+        raise ValueError(f"amount {n} is negative")
+    if n == 0:
+        return 0
+
+    e = 0
+    while n % 10 == 0 and e < 9:
+        n //= 10
+        e += 1
+
+    if e < 9:
+        d = n % 10
+        n //= 10
+        return 1 + (n * 9 + d - 1) * 10 + e
+
+    return 1 + (n - 1) * 10 + 9
+
+
+def decompress_amount(x: int) -> int:
+    """Inverse of compress_amount"""
+    if x == 0:
+        return 0
+
+    x -= 1
+    e = x % 10
+    x //= 10
+    if e < 9:
+        d = (x % 9) + 1
+        x //= 9
+        n = x * 10 + d
+    else:
+        n = x + 1
+
+    return n * 10 ** e
+
+
+def script_template(pk_script: bytes) -> int:
+    """Returns the template tag matching pk_script, or -1 if there is none"""
+    size = len(pk_script)
+    if size == 25 and pk_script[:3] == b"\x76\xa9\x14" and pk_script[23:] == b"\x88\xac":
+        return SCRIPT_P2PKH
+    if size == 23 and pk_script[:2] == b"\xa9\x14" and pk_script[22] == 0x87:
+        return SCRIPT_P2SH
+    if size == 22 and pk_script[:2] == b"\x00\x14":
+        return SCRIPT_P2WPKH
+    if size == 34 and pk_script[:2] == b"\x00\x20":
+        return SCRIPT_P2WSH
+    if size == 34 and pk_script[:2] == b"\x51\x20":
+        return SCRIPT_P2TR
+    return -1
+
+
+def put_script(out: bytearray, pk_script: bytes) -> None:
+    """Append pk_script, collapsed to a tag and hash if it fits a template"""
+    tag = script_template(pk_script)
+    if tag < 0:
+        put_varint(out, len(pk_script) + NUM_SPECIAL_SCRIPTS)
+        out += pk_script
+        return
+
+    prefix, hash_size, _ = SCRIPT_TEMPLATES[tag]
+    out.append(tag)
+    out += pk_script[len(prefix):len(prefix) + hash_size]
+
+
+def get_script(buf, offset: int, max_size: int) -> Tuple[bytes, int]:
+    """Read a compressed script at offset. Returns it and the next offset."""
+    tag, offset = get_varint(buf, offset)
+    if tag < NUM_SPECIAL_SCRIPTS:
+        if tag not in SCRIPT_TEMPLATES:
+            raise ValueError(f"unknown script template {tag}")
+
+        prefix, hash_size, suffix = SCRIPT_TEMPLATES[tag]
+        size = hash_size
+    else:
+        size = tag - NUM_SPECIAL_SCRIPTS
+        if size > max_size:
+            raise ValueError(f"pksize {size} bytes too long")
+
+    end = offset + size
+    if end > len(buf):
+        raise ValueError("unexpected end of script")
+
+    if tag < NUM_SPECIAL_SCRIPTS:
+        return prefix + bytes(buf[offset:end]) + suffix, end
+
+    return bytes(buf[offset:end]), end
@@ -0,0 +1,55 @@
+import hashlib
+import io
+import os
+import struct
+import timeit
+
+from btcacc.btcacc import Hash, LeafData, leaf_hashes
+
+
+def make_leaves(count):
+    """Builds a block's worth of p2wpkh-sized leaves"""
+    leaves = []
+    for i in range(count):
+        leaves.append(LeafData(
+            block_hash=os.urandom(32),
+            tx_hash=Hash(os.urandom(32)),
+            index=i % 4,
+            height=700000,
+            coinbase=i == 0,
+            amt=1000 + i,
+            pk_script=b"\x00\x14" + os.urandom(20),
+        ))
+    return leaves
+
+
+def stream_leaf_hash(ld):
+    """The original per-leaf path: a fresh BytesIO and one pack per field"""
+    buf = io.BytesIO()
+    buf.write(ld.block_hash)
+    buf.write(ld.tx_hash)
+    buf.write(struct.pack(">I", ld.index))
+    buf.write(struct.pack(">i", ld.height_code()))
+    buf.write(struct.pack(">q", ld.amt))
+    buf.write(struct.pack(">H", len(ld.pk_script)))
+    buf.write(ld.pk_script)
+    return hashlib.sha512(buf.getvalue()).digest()[:32]
+
+
+def bench(count=10000, repeat=5):
+    leaves = make_leaves(count)
+
+    per_leaf = min(timeit.repeat(
+        lambda: [stream_leaf_hash(ld) for ld in leaves], number=1, repeat=repeat
+    )) / count
+    batched = min(timeit.repeat(
+        lambda: leaf_hashes(leaves), number=1, repeat=repeat
+    )) / count
+
+    return per_leaf, batched
+
+
+if __name__ == "__main__":
+    per_leaf, batched = bench()
+    print(f"per-leaf stream: {per_leaf * 1e6:.2f} us/leaf")
+    print(f"leaf_hashes:     {batched * 1e6:.2f} us/leaf")
@@ -1,10 +1,89 @@
 import struct
+import sys
 import io
+from array import array
 from dataclasses import dataclass, field
-from typing import List, BinaryIO, Optional
+from typing import List, BinaryIO, Optional, Union
 
 from accumulator import BatchProof, Forest, Hash
-from .btcacc import LeafData
+from .btcacc import HASH_SIZE, LeafData, LeafDataTable, LeafDataView, leaf_hashes
+from .compress import get_varint, put_varint, unzigzag, zigzag
+
+UDATA_V1 = 1
+UDATA_V2 = 2
+
+# A versioned encoding starts with VERSION_MARKER | version. A v1 UData
+# starts with its big-endian non-negative height, whose first byte never
+# has the high bit set, so the two can be told apart from the first byte.
+VERSION_MARKER = 0x80
+
+# v2 flags
+# Stxo block hashes are left out; the reader rebuilds them from the height
+FLAG_NO_BLOCK_HASH = 0x01
+# Stxo txids are indexes into a per-message table of distinct txids
+FLAG_TXID_TABLE = 0x02
+# Proof hashes the receiver already caches are left out; a bitmap says
+# which are present
+FLAG_PARTIAL_PROOF = 0x04
+V2_FLAGS = FLAG_NO_BLOCK_HASH | FLAG_TXID_TABLE | FLAG_PARTIAL_PROOF
+
+
+def ttls_from_bytes(data) -> array:
+    """Decode big-endian int32 TTLs in one bulk call"""
+    if len(data) % 4:
+        raise ValueError(f"TTL data length {len(data)} not a multiple of 4")
+
+    ttls = array("i")
+    ttls.frombytes(data)
+    if sys.byteorder == "little":
+        ttls.byteswap()
+    return ttls
+
+
+def ttls_to_bytes(ttls) -> bytes:
+    """Encode TTLs as big-endian int32s in one bulk call"""
+    out = array("i", ttls)
+    if sys.byteorder == "little":
+        out.byteswap()
+    return out.tobytes()
+
+
+class BufferWriter:
+    """
+    File-like writer that fills a preallocated buffer from an offset, so
+    stream serializers can write into a buffer sized up front.
+    """
+
+    def __init__(self, buf: bytearray, offset: int = 0):
+        self.buf = buf
+        self.offset = offset
+
+    def write(self, data) -> int:
+        n = len(data)
+        end = self.offset + n
+        if end > len(self.buf):
+            raise ValueError(
+                f"write of {n} bytes at {self.offset} overruns "
+                f"{len(self.buf)} byte buffer"
+            )
+
+        self.buf[self.offset:end] = data
+        self.offset = end
+        return n
+
+
+def _read_varint(r: BinaryIO) -> int:
+    """Read a varint from a stream one byte at a time"""
+    buf = bytearray()
+    while True:
+        b = r.read(1)
+        if len(b) != 1:
+            raise ValueError("unexpected end of varint")
+        buf += b
+        if len(buf) > 10:
+            raise ValueError("varint too large")
+        if not b[0] & 0x80:
+            return get_varint(buf, 0)[0]
 
 
 @dataclass
@@ -16,8 +95,17 @@ class UData:
 
     height: int = 0  # int32
     acc_proof: BatchProof = field(default_factory=BatchProof)
-    stxos: List[LeafData] = field(default_factory=list)
-    txo_ttls: List[int] = field(default_factory=list)  # List[int32]
+    stxos: Union[List[LeafData], LeafDataTable, LeafDataView] = field(default_factory=list)
+    txo_ttls: Union[List[int], array] = field(default_factory=list)  # int32s
+
+    def remember_flags(self, lookahead: int) -> List[bool]:
+        """
+        Which of the block's new TXOs a Pollard should cache, by txo number:
+        those spent within lookahead blocks, so they need no proof hashes
+        when they're spent. A TTL of 0 means the TXO wasn't spent when the
+        proof was made.
+        """
+        return [0 < ttl <= lookahead for ttl in self.txo_ttls]
 
     def proof_sanity(self, nl: int, h: int) -> bool:
         """
@@ -31,64 +119,109 @@ class UData:
 
         return True
 
-    def serialize(self, w: BinaryIO) -> None:
+    def serialize(self, w: BinaryIO, version: int = UDATA_V1, flags: int = 0) -> None:
         """
         Serialize UData to binary stream.
-        Format:
+        Format (v1):
         - height (4 bytes)
         - num TTLs (4 bytes)
         - TTL values (4 bytes each)
         - batch proof
         - LeafData entries
+
+        With version=UDATA_V2 the compact encoding from serialize_v2 is
+        written instead, using the given v2 flags.
+        """
+        if version == UDATA_V2:
+            w.write(self.serialize_v2(flags))
+            return
+        if version != UDATA_V1:
+            raise ValueError(f"unknown UData version {version}")
+        if flags:
+            raise ValueError("flags are only supported by the v2 encoding")
+
+        buf = bytearray(self.serialize_size())
+        self.serialize_into(buf, 0)
+        w.write(buf)
+
+    def serialize_into(self, buf: bytearray, offset: int) -> int:
+        """
+        Serialize UData into a preallocated buffer at offset, in the same
+        format as serialize(). Returns the offset just past the written bytes.
         """
         # Write height and number of TTLs
-        w.write(struct.pack(">i", self.height))
-        w.write(struct.pack(">I", len(self.txo_ttls)))
+        struct.pack_into(">iI", buf, offset, self.height, len(self.txo_ttls))
+        offset += 8
 
         # Write TTL values
-        for ttl in self.txo_ttls:
-            w.write(struct.pack(">i", ttl))
+        ttl_bytes = ttls_to_bytes(self.txo_ttls)
+        buf[offset:offset + len(ttl_bytes)] = ttl_bytes
+        offset += len(ttl_bytes)
 
         # Write batch proof
-        self.acc_proof.serialize(w)
+        offset = self.acc_proof.serialize_into(buf, offset)
 
         # Write leaf data
+        if isinstance(self.stxos, (LeafDataTable, LeafDataView)):
+            return self.stxos.serialize_into(buf, offset)
+
         for ld in self.stxos:
-            ld.serialize(w)
+            offset = ld.serialize_into(buf, offset)
+
+        return offset
 
     def serialize_size(self) -> int:
         """Calculate serialized size in bytes"""
         # Calculate leaf data size
-        ld_size = sum(ld.serialize_size() for ld in self.stxos)
-
-        # Get proof size
-        buf = io.BytesIO()
-        self.acc_proof.serialize(buf)
-        proof_size = len(buf.getvalue())
-
-        if buf.tell() != self.acc_proof.serialize_size():
-            print(
-                f" buf.tell() {buf.tell()}, "
-                f"AccProof.serialize_size() {self.acc_proof.serialize_size()}"
-            )
+        if isinstance(self.stxos, (LeafDataTable, LeafDataView)):
+            ld_size = self.stxos.serialize_size()
+        else:
+            ld_size = sum(ld.serialize_size() for ld in self.stxos)
 
         # 8 bytes for height & numTTLs + 4 bytes per TTL + proof size + leaf sizes
-        return 8 + (4 * len(self.txo_ttls)) + proof_size + ld_size
+        return (
+            8 + (4 * len(self.txo_ttls)) + self.acc_proof.serialize_size()
+            + ld_size
+        )
 
-    def deserialize(self, r: BinaryIO) -> None:
-        """Read UData from binary stream"""
+    def deserialize(self, r: BinaryIO, block_hashes=None) -> None:
+        """
+        Read UData from binary stream, detecting the encoding version.
+        block_hashes maps height to block hash and is needed for v2 data
+        written with FLAG_NO_BLOCK_HASH.
+        """
         try:
+            first = r.read(1)
+            if len(first) != 1:
+                raise ValueError("unexpected end of stream")
+
+            if first[0] & VERSION_MARKER:
+                header = first + r.read(1)
+                length = _read_varint(r)
+                payload = r.read(length)
+                if len(payload) != length:
+                    raise ValueError(f"expected {length} byte payload")
+
+                udata = UData.from_v2_payload(
+                    header, memoryview(payload), block_hashes
+                )
+                self.height = udata.height
+                self.acc_proof = udata.acc_proof
+                self.stxos = udata.stxos
+                self.txo_ttls = udata.txo_ttls
+                return
+
             # Read height
-            self.height = struct.unpack(">i", r.read(4))[0]
+            self.height = struct.unpack(">i", first + r.read(3))[0]
 
             # Read number of TTLs
             num_ttls = struct.unpack(">I", r.read(4))[0]
 
             # Read TTL values
-            self.txo_ttls = []
-            for _ in range(num_ttls):
-                ttl = struct.unpack(">i", r.read(4))[0]
-                self.txo_ttls.append(ttl)
+            ttl_data = r.read(4 * num_ttls)
+            if len(ttl_data) != 4 * num_ttls:
+                raise ValueError(f"{num_ttls} TTLs but only {len(ttl_data)} bytes")
+            self.txo_ttls = list(ttls_from_bytes(ttl_data))
 
             # Read batch proof
             self.acc_proof = BatchProof()
@@ -104,6 +237,220 @@ class UData:
         except Exception as e:
             raise ValueError(f"UData deserialize error: {str(e)}")
 
+    @staticmethod
+    def from_buffer(buf, block_hashes=None) -> "UData":
+        """
+        Decode UData from a buffer in the serialize() format without
+        copying it. TTLs are decoded in one bulk array call, and stxos are
+        returned as a LeafDataView over buf, so buf must not be modified
+        while the UData is in use.
+
+        Buffers in the compact v2 encoding are detected and decoded with
+        stxos in a LeafDataTable.
+        """
+        buf = memoryview(buf)
+        udata = UData()
+
+        if len(buf) and buf[0] & VERSION_MARKER:
+            return UData.from_v2_bytes(buf, block_hashes)
+
+        try:
+            udata.height, num_ttls = struct.unpack_from(">iI", buf, 0)
+            offset = 8
+
+            # Read TTL values
+            ttl_end = offset + 4 * num_ttls
+            if ttl_end > len(buf):
+                raise ValueError(f"{num_ttls} TTLs but only {len(buf)} bytes")
+            udata.txo_ttls = ttls_from_bytes(buf[offset:ttl_end])
+            offset = ttl_end
+
+            # Read batch proof
+            udata.acc_proof, offset = BatchProof.from_buffer(buf, offset)
+
+            # Read leaf data
+            udata.stxos, _ = LeafDataView.scan(
+                buf, offset, len(udata.acc_proof.targets)
+            )
+
+        except Exception as e:
+            raise ValueError(f"UData deserialize error: {str(e)}")
+
+        return udata
+
+    def serialize_v2(self, flags: int = 0) -> bytes:
+        """
+        Encode UData in the compact v2 format:
+        - version marker (1 byte, VERSION_MARKER | 2)
+        - flags (1 byte)
+        - varint payload length
+        - payload:
+          - varint height
+          - varint num TTLs, then a zigzag varint per TTL, as TTLs are
+            signed like v1's
+          - varint num targets, then a varint per target
+          - varint num proof hashes, then 32 bytes per hash; with
+            FLAG_PARTIAL_PROOF a bitmap of the hashes present comes first,
+            and only those are written
+          - with FLAG_TXID_TABLE: varint num txids, then 32 bytes per txid
+          - LeafData entries in the compact encoding (one per target)
+
+        FLAG_NO_BLOCK_HASH drops the stxo block hashes, and
+        FLAG_TXID_TABLE replaces each stxo txid with a varint index into
+        the txid table, so stxos spending the same transaction share it.
+        FLAG_PARTIAL_PROOF allows proof hashes to be None.
+        """
+        if flags & ~V2_FLAGS:
+            raise ValueError(f"unknown UData flags {flags:#x}")
+
+        proof = self.acc_proof.proof
+        partial = bool(flags & FLAG_PARTIAL_PROOF)
+        if not partial and any(h is None for h in proof):
+            raise ValueError("partial proof needs FLAG_PARTIAL_PROOF")
+
+        payload = bytearray()
+        put_varint(payload, self.height)
+
+        put_varint(payload, len(self.txo_ttls))
+        for ttl in self.txo_ttls:
+            put_varint(payload, zigzag(ttl))
+
+        put_varint(payload, len(self.acc_proof.targets))
+        for target in self.acc_proof.targets:
+            put_varint(payload, target)
+
+        put_varint(payload, len(proof))
+        if partial:
+            bitmap = bytearray((len(proof) + 7) // 8)
+            for i, h in enumerate(proof):
+                if h is not None:
+                    bitmap[i >> 3] |= 1 << (i & 7)
+            payload += bitmap
+        for h in proof:
+            if h is not None:
+                payload += h
+
+        stxos = list(self.stxos)
+        txid_indexes = None
+        if flags & FLAG_TXID_TABLE:
+            txid_indexes = {}
+            for ld in stxos:
+                txid_indexes.setdefault(bytes(ld.tx_hash), len(txid_indexes))
+
+            put_varint(payload, len(txid_indexes))
+            for txid in txid_indexes:
+                payload += txid
+
+        omit_block_hash = bool(flags & FLAG_NO_BLOCK_HASH)
+        for ld in stxos:
+            ld.put_compact(
+                payload,
+                omit_block_hash,
+                None if txid_indexes is None else txid_indexes[bytes(ld.tx_hash)],
+            )
+
+        out = bytearray((VERSION_MARKER | UDATA_V2, flags))
+        put_varint(out, len(payload))
+        out += payload
+        return bytes(out)
+
+    @staticmethod
+    def from_v2_bytes(b, block_hashes=None) -> "UData":
+        """Create UData from the compact v2 format"""
+        b = memoryview(b)
+        try:
+            if len(b) < 2:
+                raise ValueError("unexpected end of data")
+
+            length, offset = get_varint(b, 2)
+            if offset + length != len(b):
+                raise ValueError(
+                    f"{length} byte payload but {len(b) - offset} bytes given"
+                )
+        except Exception as e:
+            raise ValueError(f"UData deserialize error: {str(e)}")
+
+        return UData.from_v2_payload(b[:2], b[offset:], block_hashes)
+
+    @staticmethod
+    def from_v2_payload(header: bytes, payload, block_hashes=None) -> "UData":
+        """
+        Decode a v2 payload given its two header bytes. block_hashes maps
+        height to block hash and is required with FLAG_NO_BLOCK_HASH.
+        """
+        udata = UData()
+
+        try:
+            version = header[0] & ~VERSION_MARKER
+            if version != UDATA_V2:
+                raise ValueError(f"unknown UData version {version}")
+            flags = header[1]
+            if flags & ~V2_FLAGS:
+                raise ValueError(f"unknown UData flags {flags:#x}")
+            if flags & FLAG_NO_BLOCK_HASH and block_hashes is None:
+                raise ValueError("block hashes omitted but no height index given")
+
+            udata.height, offset = get_varint(payload, 0)
+
+            num_ttls, offset = get_varint(payload, offset)
+            ttls = array("i")
+            for _ in range(num_ttls):
+                ttl, offset = get_varint(payload, offset)
+                ttls.append(unzigzag(ttl))
+            udata.txo_ttls = ttls
+
+            udata.acc_proof = BatchProof()
+            num_targets, offset = get_varint(payload, offset)
+            targets = []
+            for _ in range(num_targets):
+                target, offset = get_varint(payload, offset)
+                targets.append(target)
+            udata.acc_proof.targets = targets
+
+            num_hashes, offset = get_varint(payload, offset)
+            present = range(num_hashes)
+            if flags & FLAG_PARTIAL_PROOF:
+                end = offset + (num_hashes + 7) // 8
+                if end > len(payload):
+                    raise ValueError(f"{num_hashes} proof hashes but data too short")
+                bitmap = payload[offset:end]
+                offset = end
+                present = [i for i in range(num_hashes) if bitmap[i >> 3] >> (i & 7) & 1]
+
+            end = offset + len(present) * HASH_SIZE
+            if end > len(payload):
+                raise ValueError(f"{num_hashes} proof hashes but data too short")
+            proof = [None] * num_hashes
+            for i in present:
+                proof[i] = Hash(bytes(payload[offset:offset + HASH_SIZE]))
+                offset += HASH_SIZE
+            udata.acc_proof.proof = proof
+
+            txids = None
+            if flags & FLAG_TXID_TABLE:
+                num_txids, offset = get_varint(payload, offset)
+                end = offset + num_txids * HASH_SIZE
+                if end > len(payload):
+                    raise ValueError(f"{num_txids} txids but data too short")
+                txids = [payload[i:i + HASH_SIZE] for i in range(offset, end, HASH_SIZE)]
+                offset = end
+
+            if not flags & FLAG_NO_BLOCK_HASH:
+                block_hashes = None
+
+            stxos = LeafDataTable()
+            for _ in range(num_targets):
+                offset = stxos.append_compact(payload, offset, block_hashes, txids)
+            udata.stxos = stxos
+
+            if offset != len(payload):
+                raise ValueError(f"{len(payload) - offset} trailing bytes")
+
+        except Exception as e:
+            raise ValueError(f"UData deserialize error: {str(e)}")
+
+        return udata
+
     def to_compact_bytes(self) -> bytes:
         """Convert to compact byte format
         Compact format:
@@ -119,35 +466,42 @@ class UData:
         buf.write(struct.pack(">I", len(self.stxos)))
 
         # Write STXO data
-        for stxo in self.stxos:
-            stxo.serialize(buf)
+        if isinstance(self.stxos, (LeafDataTable, LeafDataView)):
+            self.stxos.serialize(buf)
+        else:
+            for stxo in self.stxos:
+                stxo.serialize(buf)
 
         # Write proof data
         self.acc_proof.serialize(buf)
 
         return buf.getvalue()
 
+    def to_compact_v2_bytes(self, flags: int = 0) -> bytes:
+        """Convert to the compact v2 encoding; see serialize_v2"""
+        return self.serialize_v2(flags)
+
     @staticmethod
-    def from_compact_bytes(b: bytes) -> "UData":
-        """Create UData from compact byte format"""
-        buf = io.BytesIO(b)
+    def from_compact_bytes(b: bytes, block_hashes=None) -> "UData":
+        """
+        Create UData from compact byte format. The v2 encoding is accepted
+        too. Compact format stxos are returned as a LeafDataView over b.
+        """
+        b = memoryview(b)
+        if len(b) and b[0] & VERSION_MARKER:
+            return UData.from_v2_bytes(b, block_hashes)
+
         udata = UData()
 
         try:
             # Read height and number of STXOs
-            udata.height = struct.unpack(">i", buf.read(4))[0]
-            num_stxos = struct.unpack(">I", buf.read(4))[0]
+            udata.height, num_stxos = struct.unpack_from(">iI", b, 0)
 
-            # Read STXO data
-            udata.stxos = []
-            for _ in range(num_stxos):
-                ld = LeafData()
-                ld.deserialize(buf)
-                udata.stxos.append(ld)
+            # Find STXO data
+            udata.stxos, offset = LeafDataView.scan(b, 8, num_stxos)
 
             # Read proof data
-            udata.acc_proof = BatchProof()
-            udata.acc_proof.deserialize(buf)
+            udata.acc_proof, _ = BatchProof.from_buffer(b, offset)
 
             # Verify consistency
             if len(udata.acc_proof.targets) != num_stxos:
@@ -170,7 +524,7 @@ class UData:
         ud = UData(height=height, stxos=del_leaves)
 
         # Create hashes from leaf data
-        del_hashes = [ld.leaf_hash() for ld in ud.stxos]
+        del_hashes = leaf_hashes(ud.stxos)
 
         # Generate block proof
         try:
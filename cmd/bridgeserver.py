@@ -1,8 +1,17 @@
+import asyncio
 import os
 import signal
+import threading
 import tracemalloc
 import gc
-from multiprocessing import Process
+from itertools import takewhile
+
+from accumulator import Forest
+from bridge.archive import UBlockArchive
+from bridge.pipeline import build_archive, read_block_file
+from bridge.reproof import ForestCheckpoints
+from bridge.server import DEFAULT_LISTEN, BlockStore, BridgeServer
+from bridge.utxostore import LeafDataStore
 
 class Bridge:
     @staticmethod
@@ -10,18 +19,88 @@ class Bridge:
         # Simulate config parsing
         if len(args) < 1:
             raise ValueError("Missing arguments")
-        return {"CpuProf": "", "TraceProf": "", "MemProf": ""}, None
+        return {"CpuProf": "", "TraceProf": "", "MemProf": "", "ForestFile": "",
+                "ListenAddr": DEFAULT_LISTEN, "ArchiveFile": "", "BlocksFile": "",
+                "UtxoFile": "", "CheckpointDir": ""}, None
+
+    @staticmethod
+    def open_forest(config):
+        """
+        Open the bridge's forest: memory-mapped from config["ForestFile"]
+        if set, so it survives restarts, otherwise in memory
+        """
+        path = config.get("ForestFile", "")
+        if path:
+            return Forest.open(path)
+        return Forest()
+
+    @staticmethod
+    def open_store(config):
+        """
+        The stored proof data to serve: the UBlock archive at
+        config["ArchiveFile"] if set, otherwise nothing
+        """
+        path = config.get("ArchiveFile", "")
+        if path:
+            return UBlockArchive(path)
+        return BlockStore()
+
+    @staticmethod
+    def build(config, forest, archive, sig):
+        """
+        Prove the blocks of config["BlocksFile"] past the archive's tip on
+        forest and append them to archive, until the file runs out or
+        sig.poll() says to stop. The LeafData of unspent outputs are kept
+        at config["UtxoFile"], by default next to the archive.
+        """
+        start = archive.num_heights()
+        if start and not forest.num_leaves:
+            raise ValueError(f"archive is at height {start} but the forest is empty; "
+                             "set ForestFile to the forest it was built on")
+
+        utxos = LeafDataStore(config.get("UtxoFile") or config["ArchiveFile"] + ".utxos")
+        checkpoints = None
+        if config.get("CheckpointDir"):
+            checkpoints = ForestCheckpoints(config["CheckpointDir"])
+        blocks = takewhile(lambda _: not sig.poll(), read_block_file(config["BlocksFile"], start))
+        try:
+            count = build_archive(forest, archive, blocks, utxos, checkpoints=checkpoints)
+        finally:
+            archive.flush()
+            forest.flush()
+            utxos.close()
+        print(f"Proved {count} blocks, archive now at height {archive.num_heights()}")
 
     @staticmethod
     def start(config, sig):
         print("Bridge started with config:", config)
+        forest = Bridge.open_forest(config)
+        store = Bridge.open_store(config)
         try:
-            while True:
-                if sig.poll():
-                    print("Signal received, stopping bridge...")
-                    break
+            if config.get("BlocksFile"):
+                if not isinstance(store, UBlockArchive):
+                    raise ValueError("BlocksFile needs an ArchiveFile to write proofs to")
+                Bridge.build(config, forest, store, sig)
+            if not sig.poll():
+                asyncio.run(Bridge.serve(config, store, sig))
         except KeyboardInterrupt:
             print("Keyboard interrupt detected.")
+        finally:
+            if isinstance(store, UBlockArchive):
+                store.close()
+            forest.close()
+
+    @staticmethod
+    async def serve(config, store, sig):
+        """Serve store to CSNs until sig is set"""
+        server = BridgeServer(store, config.get("ListenAddr") or DEFAULT_LISTEN)
+        await server.start()
+        print(f"Listening on {server.host}:{server.port}")
+        try:
+            await sig.wait()
+            print("Signal received, stopping bridge...")
+        finally:
+            await server.stop()
 
 def main():
     # Set garbage collection threshold for more frequent collections
@@ -49,11 +128,43 @@ def main():
         exit(1)
 
 
+class StopSignal:
+    """
+    Set by SignalHandler. Bridge.build polls it between blocks, and
+    Bridge.serve waits on it in its event loop.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        # (loop, asyncio.Event) of each wait() in progress
+        self._waiters = []
+
+    def set(self):
+        # No lock: this runs in a signal handler. The flag is set before
+        # the waiters are read and wait() registers before reading it, so
+        # every waiter is woken one way or the other.
+        self._event.set()
+        for loop, event in list(self._waiters):
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(event.set)
+
+    def poll(self) -> bool:
+        return self._event.is_set()
+
+    async def wait(self):
+        """Wait until set, without blocking the running event loop"""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        self._waiters.append(waiter)
+        try:
+            if not self._event.is_set():
+                await waiter[1].wait()
+        finally:
+            self._waiters.remove(waiter)
+
+
 class SignalHandler:
     def __init__(self, cfg):
         self.cfg = cfg
-        self.queue = Process(target=self._handle_signal)
-        self.queue.daemon = True
+        self.queue = StopSignal()
 
     def start(self):
         signal.signal(signal.SIGINT, self._handler)
@@ -62,6 +173,7 @@ class SignalHandler:
     
     def _handler(self, signum, frame):
         print(f"Received signal: {signum}")
+        self.queue.set()
         if self.cfg["CpuProf"]:
             print("Stopping CPU profile...")
 
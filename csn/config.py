@@ -1,9 +1,10 @@
 import argparse
 
 class Config:
-    def __init__(self, params, remote_host, watch_addr, lookahead, quitafter, checksig, trace_prof, cpu_prof, mem_prof, prof_server):
+    def __init__(self, params, remote_host, watch_addr, lookahead, quitafter, checksig, trace_prof, cpu_prof, mem_prof, prof_server, max_mem=0, remote_hosts=None):
         self.params = params
         self.remote_host = remote_host
+        self.remote_hosts = remote_hosts or [remote_host]
         self.watch_addr = watch_addr
         self.lookahead = lookahead
         self.quitafter = quitafter
@@ -12,6 +13,7 @@ class Config:
         self.cpu_prof = cpu_prof
         self.mem_prof = mem_prof
         self.prof_server = prof_server
+        self.max_mem = max_mem
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description="A dynamic hash-based accumulator designed for the Bitcoin UTXO set.")
@@ -27,11 +29,16 @@ def parse_args(args):
     parser.add_argument("-watchaddr", type=str, default="", 
                         help="Address to watch & report transactions. Only bech32 p2wpkh supported.")
     parser.add_argument("-host", type=str, default="127.0.0.1", 
-                        help="Remote server to connect to. Defaults to localhost.")
+                        help="Remote server to connect to, or a comma separated list to download "
+                             "from several at once. Defaults to localhost.")
     parser.add_argument("-checksig", type=bool, default=True, 
                         help="Check Bitcoin transaction signatures. (slower)")
     parser.add_argument("-lookahead", type=int, default=1000, 
                         help="Size of the look-ahead cache in blocks.")
+    parser.add_argument("-maxmem", type=int, default=0, 
+                        help="Pollard memory budget in MB. Caches every TXO with a known spend "
+                             "instead of using -lookahead, evicting those spent last when over it. "
+                             "0 for no budget.")
     parser.add_argument("-quitafter", type=int, default=-1, 
                         help="Quit IBD after n blocks. (for testing)")
     parser.add_argument("-profserver", type=str, default="", 
@@ -51,9 +58,11 @@ def parse_args(args):
         raise ValueError(f"Invalid network: {parsed_args.net}")
 
     # Default host to localhost if empty
-    remote_host = parsed_args.host or "127.0.0.1:8338"
-    if ":" not in remote_host:
-        remote_host += ":8338"
+    remote_hosts = [host.strip() for host in parsed_args.host.split(",") if host.strip()]
+    if not remote_hosts:
+        remote_hosts = ["127.0.0.1:8338"]
+    remote_hosts = [host if ":" in host else host + ":8338" for host in remote_hosts]
+    remote_host = remote_hosts[0]
 
     config = Config(
         params=params,
@@ -65,7 +74,9 @@ def parse_args(args):
         trace_prof=parsed_args.trace,
         cpu_prof=parsed_args.cpuprof,
         mem_prof=parsed_args.memprof,
-        prof_server=parsed_args.profserver
+        prof_server=parsed_args.profserver,
+        max_mem=parsed_args.maxmem,
+        remote_hosts=remote_hosts
     )
     return config
 
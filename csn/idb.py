@@ -1,10 +1,12 @@
 import time
 from typing import Dict, List, Set, Tuple
 from dataclasses import dataclass
-from btcutil import Block
-from wire import OutPoint, TxOut, MsgTx
+from btcd.btcutil import Block
+from btcd.wire import OutPoint, TxOut, MsgTx
 from accumulator import Hash
-from btcacc import LeafData
+from btcacc import FLAG_NO_BLOCK_HASH, FLAG_TXID_TABLE, BlockHashIndex, LeafData, leaf_hashes
+from wire.download import multi_bridge_reader
+from wire.umsgblock import CachePolicy, StreamBlockHashes, UBlock, ublock_network_reader
 from util import dedupe_block
 
 
@@ -18,10 +20,14 @@ class Csn:
     def __init__(self):
         self.current_height = 0
         self.remote_host = ""
+        # Bridges to download from at once; just remote_host if empty
+        self.remote_hosts: List[str] = []
         self.height_chan = None
         self.pollard = None
         self.total_score = 0
         self.utxo_store: Dict[OutPoint, LeafData] = {}
+        # Lets UData sent without stxo block hashes be decoded
+        self.block_hashes = BlockHashIndex()
         self.watch_addrs: Set[bytes] = set()
         self.tx_chan = None
         self.check_signatures = False
@@ -35,16 +41,23 @@ class Csn:
         # TODO: Implement stop_run_ibd equivalent
         # go stop_run_ibd(cfg, sig, halt_request, halt_accept)
 
-        lookahead = 1000
         total_txo_added = 0
         total_dels = 0
 
-        ublock_queue = (
-            []
-        )  # This would be replaced with proper async queue in production
+        # Partial proofs only save anything if the pollard caches leaves
+        policy = self.cache_policy() if self.pollard.lookahead else None
+        decode = StreamBlockHashes(self.block_hashes).decode
 
-        # TODO: Implement ublock_network_reader equivalent
-        # go uwire.UblockNetworkReader(ublock_queue, self.remote_host, self.current_height, lookahead)
+        # Bounded, so the readers stop when we fall behind
+        if len(self.remote_hosts) > 1:
+            ublock_queue = multi_bridge_reader(
+                self.remote_hosts, self.current_height, self.pollard.lookahead,
+                policy=policy, decode=decode,
+            )
+        else:
+            ublock_queue = ublock_network_reader(
+                self.remote_host, self.current_height, self.pollard.lookahead, policy, decode
+            )
 
         plus_time = 0
         start_time = time.time()
@@ -53,21 +66,24 @@ class Csn:
         block_count = 0
 
         while not stop:
-            try:
-                block_n_proof = ublock_queue.pop(0)  # This would block in production
-            except IndexError:
+            block_n_proof = ublock_queue.get()
+            if block_n_proof is None:
                 print("ublock_queue channel closed")
                 sig_chan.append(True)
                 break
 
             try:
-                self.put_block_in_pollard(
+                added, deleted = self.put_block_in_pollard(
                     block_n_proof, total_txo_added, total_dels, plus_time
                 )
+                total_txo_added += added
+                total_dels += deleted
             except Exception as e:
                 # In production, should handle this more gracefully
                 raise e
 
+            self.block_hashes.append(block_n_proof.block.hash())
+
             if self.height_chan is not None:
                 self.height_chan.append(self.current_height)
 
@@ -144,8 +160,11 @@ class Csn:
 
     def put_block_in_pollard(
         self, ub, total_txo_added: int, total_dels: int, plus_time: float
-    ) -> None:
-        """Process a block and update the Pollard tree"""
+    ) -> Tuple[int, int]:
+        """
+        Process a block and update the Pollard tree. Returns the number of
+        TXOs added and deleted.
+        """
         plus_start = time.time()
 
         nl, h = self.pollard.reconstruct_stats()
@@ -158,9 +177,53 @@ class Csn:
                 f"uData missing utxo data for block {ub.utreexo_data.height} err: {err}"
             )
 
-        # Continue with rest of implementation...
-        # Note: This method would need significant adaptation as it relies heavily
-        # on Utreexo-specific data structures that would need Python equivalents
+        udata = ub.utreexo_data
+
+        # Check the proof against the roots and put the parts of it we
+        # need into the pollard
+        try:
+            self.pollard.ingest_batch_proof(
+                leaf_hashes(udata.stxos), udata.acc_proof
+            )
+        except ValueError as e:
+            raise Exception(f"block {udata.height} proof invalid: {str(e)}")
+
+        # Cache the new TXOs that get spent within the lookahead window.
+        # Their TTLs decide what's evicted if the pollard has a budget.
+        remember = udata.remember_flags(self.pollard.lookahead)
+
+        # Hashes to add into the accumulator
+        block_adds = UBlock.block_to_add_leaves(
+            ub.block, remember, out_skip, udata.height, out_count, udata.txo_ttls
+        )
+
+        # blockAdds are the added txos and the proof targets are the
+        # positions of the leaves to delete
+        self.pollard.modify(block_adds, udata.acc_proof.targets)
+
+        return len(block_adds), len(udata.acc_proof.targets)
+
+    def cache_policy(self) -> CachePolicy:
+        """
+        Forget the pollard's cached leaves and describe its cache to the
+        bridge, which simulates it from the current roots on and sends
+        partial proofs
+        """
+        self.pollard.forget_all()
+        num_leaves, _ = self.pollard.reconstruct_stats()
+
+        # Block hashes can be left out if every earlier one is indexed
+        flags = FLAG_TXID_TABLE
+        if self.block_hashes.start_height == 0 and len(self.block_hashes) == self.current_height:
+            flags |= FLAG_NO_BLOCK_HASH
+
+        return CachePolicy(
+            lookahead=self.pollard.lookahead,
+            num_leaves=num_leaves,
+            roots=list(self.pollard.get_roots()),
+            max_nodes=self.pollard.max_nodes,
+            flags=flags,
+        )
 
     def register_out_point(self, out_point: OutPoint):
         """Register an outpoint - implementation depends on requirements"""
@@ -4,14 +4,26 @@ import time
 from http.server import SimpleHTTPRequestHandler, HTTPServer
 from bech32 import bech32_decode
 
+from accumulator import Pollard
+from csn.idb import Csn
+from csn.reload import restore_block_hashes, restore_pollard
+
+# Lookahead covering any TTL, for when a memory budget decides the cache
+MAX_LOOKAHEAD = 0x7fffffff
+
 class Config:
-    def __init__(self, cpu_prof=None, trace_prof=None, prof_server=None, look_ahead=0, check_sig=False, watch_addr=""):
+    def __init__(self, cpu_prof=None, trace_prof=None, prof_server=None, look_ahead=0, check_sig=False, watch_addr="", max_mem=0,
+                 remote_host="", remote_hosts=None):
+        # Bridges to download from; remote_host is the first of them
+        self.remote_hosts = remote_hosts or [remote_host or "127.0.0.1:8338"]
+        self.remote_host = remote_host or self.remote_hosts[0]
         self.cpu_prof = cpu_prof
         self.trace_prof = trace_prof
         self.prof_server = prof_server
         self.look_ahead = look_ahead
         self.check_sig = check_sig
         self.watch_addr = watch_addr
+        self.max_mem = max_mem
 
 def start_cpu_profile(file_path):
     pass
@@ -29,6 +41,11 @@ def run_profiler_server(port):
     thread.daemon = True
     thread.start()
 
+def init_csn_state():
+    """The pollard, height and UTXOs saved by an earlier run, or fresh ones"""
+    height, pol, utxos = restore_pollard()
+    return pol, height, utxos
+
 def run_ibd(cfg: Config, sig: threading.Event):
     if cfg.cpu_prof:
         try:
@@ -49,17 +66,26 @@ def run_ibd(cfg: Config, sig: threading.Event):
 
     try:
         pol, height, utxos = init_csn_state()
+        # Saved with the pollard, so it should end at the same height
+        block_hashes = restore_block_hashes(height)
     except Exception as e:
         print(f"init_csn_state error: {e}")
         return
 
     pol.lookahead = cfg.look_ahead
-
-    c = Csn(
-        pollard=pol,
-        check_signatures=cfg.check_sig,
-        utxo_store=utxos
-    )
+    if cfg.max_mem:
+        # Cache everything that gets spent and let the budget decide
+        pol.lookahead = MAX_LOOKAHEAD
+        pol.max_nodes = Pollard.nodes_for_bytes(cfg.max_mem << 20)
+
+    c = Csn()
+    c.pollard = pol
+    c.check_signatures = cfg.check_sig
+    c.utxo_store = utxos
+    c.block_hashes = block_hashes
+    c.remote_host = cfg.remote_host
+    # IBD downloads from all of them at once if there's more than one
+    c.remote_hosts = cfg.remote_hosts
 
     try:
         tx_chan, height_chan = c.start(cfg, height, "compactstate", "", sig)
@@ -6,10 +6,11 @@ from pathlib import Path
 from btcd.chaincfg.chainhash import Hash
 from btcd.wire import OutPoint
 from accumulator import Pollard
-from btcacc import LeafData
+from btcacc import BlockHashIndex, LeafData
 
 # Constants
 POLLARD_FILE_PATH = "pollard.dat"
+BLOCK_HASHES_FILE_PATH = "blockhashes.dat"
 
 
 def restore_pollard() -> Tuple[int, Pollard, Dict[OutPoint, LeafData]]:
@@ -67,10 +68,39 @@ def save_ibd_sim_data(csn) -> None:
             # Save pollard state
             csn.pollard.write_pollard(pol_file)
 
+        save_block_hashes(csn.block_hashes)
+
     except Exception as e:
         raise Exception(f"Error saving IBD sim data: {str(e)}")
 
 
+def restore_block_hashes(height: int, custom_path: str = None) -> BlockHashIndex:
+    """
+    Restores the height to block hash index saved alongside the pollard,
+    for resuming at height. If none was saved, or it doesn't end at
+    height, returns an empty index starting there, which can't look up
+    the hashes of earlier blocks.
+    """
+    path = Path(custom_path or BLOCK_HASHES_FILE_PATH)
+    index = BlockHashIndex()
+    if path.exists():
+        try:
+            with path.open("rb") as f:
+                index.deserialize(f)
+        except Exception as e:
+            raise Exception(f"Error restoring block hashes: {str(e)}")
+        if len(index) == height:
+            return index
+
+    return BlockHashIndex(height)
+
+
+def save_block_hashes(index: BlockHashIndex, custom_path: str = None) -> None:
+    """Saves the height to block hash index"""
+    with Path(custom_path or BLOCK_HASHES_FILE_PATH).open("wb") as f:
+        index.serialize(f)
+
+
 def get_pollard_path(custom_path: str = None) -> Path:
     """
     Returns the path to the pollard file, allowing for a custom path override.
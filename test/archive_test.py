@@ -0,0 +1,175 @@
+import asyncio
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from bridge.archive import INDEX_ENTRY, UBlockArchive
+from bridge.server import BridgeServer
+from wire.umsgblock import ublock_stream_reader
+
+
+def payload(height):
+    """A stand-in record: a 'block' part, then a 'udata' part"""
+    return b"B" * (height % 7) + struct.pack(">I", height) * (1 + height % 3)
+
+
+class TestUBlockArchive(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "ublocks")
+        self.archive = UBlockArchive(self.path)
+
+    def tearDown(self):
+        self.archive.close()
+        self.dir.cleanup()
+
+    def fill(self, n):
+        for height in range(self.archive.num_heights(), n):
+            self.assertEqual(self.archive.append(payload(height), height % 7), height)
+
+    def reopen(self):
+        self.archive.close()
+        self.archive = UBlockArchive(self.path)
+
+    def test_append_and_read(self):
+        self.fill(20)
+        self.reopen()
+        self.assertEqual(self.archive.num_heights(), 20)
+        for height in (0, 7, 19):
+            self.assertEqual(bytes(self.archive.record(height)), payload(height))
+            self.assertEqual(bytes(self.archive.udata_record(height)),
+                             payload(height)[height % 7:])
+        self.assertEqual([bytes(r) for r in self.archive.scan(3, 5)],
+                         [payload(h) for h in range(3, 6)])
+        with self.assertRaises(ValueError):
+            self.archive.record(20)
+
+    def test_reads_see_appends(self):
+        self.fill(3)
+        record = self.archive.record(2)
+        self.fill(6)
+        self.assertEqual(bytes(self.archive.record(5)), payload(5))
+        self.assertEqual(bytes(record), payload(2))
+
+    def test_span_is_frames(self):
+        self.fill(10)
+        path, offset, count = self.archive.span(2, 4)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read(count)
+        expected = b"".join(struct.pack(">I", len(payload(h))) + payload(h) for h in range(2, 5))
+        self.assertEqual(data, expected)
+
+    def test_recovers_torn_data(self):
+        self.fill(10)
+        self.archive.flush()
+        # the last record only half written
+        size = os.path.getsize(self.path + ".dat")
+        with open(self.path + ".dat", "r+b") as f:
+            f.truncate(size - 3)
+        self.reopen()
+        self.assertEqual(self.archive.num_heights(), 9)
+        self.fill(12)
+        self.assertEqual(bytes(self.archive.record(11)), payload(11))
+
+    def test_recovers_torn_index(self):
+        self.fill(5)
+        self.archive.flush()
+        # data written past the index, and half an index entry
+        with open(self.path + ".dat", "ab") as f:
+            f.write(b"\x00\x00\x00\x09partial")
+        with open(self.path + ".idx", "ab") as f:
+            f.write(b"\x01" * (INDEX_ENTRY.size // 2))
+        self.reopen()
+        self.assertEqual(self.archive.num_heights(), 5)
+        self.assertEqual(os.path.getsize(self.path + ".idx"), 5 * INDEX_ENTRY.size)
+        self.fill(6)
+        self.assertEqual(bytes(self.archive.record(5)), payload(5))
+
+    def test_index_waits_for_data(self):
+        self.fill(5)
+        self.archive.flush()
+        self.fill(8)
+        self.assertEqual(os.path.getsize(self.path + ".idx"), 5 * INDEX_ENTRY.size)
+        self.assertEqual(bytes(self.archive.record(7)), payload(7))
+
+        # A crash now, before the last records' data reached the disk
+        crashed = os.path.join(self.dir.name, "crashed")
+        for suffix in (".dat", ".idx"):
+            shutil.copyfile(self.path + suffix, crashed + suffix)
+        with open(crashed + ".dat", "ab") as f:
+            f.write(bytes(64))
+        archive = UBlockArchive(crashed)
+        self.assertEqual(archive.num_heights(), 5)
+        self.assertEqual(bytes(archive.record(4)), payload(4))
+        archive.close()
+
+        self.reopen()
+        self.assertEqual(self.archive.num_heights(), 8)
+
+    def test_index_written_in_batches(self):
+        with patch("bridge.archive.INDEX_BATCH", 4):
+            self.fill(10)
+        self.assertEqual(os.path.getsize(self.path + ".idx"), 8 * INDEX_ENTRY.size)
+
+    def test_truncate(self):
+        self.fill(10)
+        self.archive.truncate(4)
+        self.assertEqual(self.archive.num_heights(), 4)
+        self.fill(6)
+        self.reopen()
+        self.assertEqual([bytes(r) for r in self.archive.scan(0, 5)],
+                         [payload(h) for h in range(6)])
+        with self.assertRaises(ValueError):
+            self.archive.truncate(7)
+
+    def test_set_ttl(self):
+        # a stand-in block, then a v1 UData with 3 TTLs
+        self.archive.append(b"blk" + struct.pack(">iI", 0, 3) + bytes(12) + b"proof", 3)
+        record = self.archive.udata_record(0)
+        self.archive.set_ttl(0, 2, 9)
+        self.archive.set_ttl(0, 0, 1)
+        self.reopen()
+        self.assertEqual(bytes(record), bytes(self.archive.udata_record(0)))
+        self.assertEqual(struct.unpack_from(">3i", self.archive.udata_record(0), 8), (1, 0, 9))
+        with self.assertRaises(ValueError):
+            self.archive.set_ttl(0, 3, 1)
+
+    def test_extend(self):
+        self.fill(4)
+        other = UBlockArchive(os.path.join(self.dir.name, "other"))
+        for height in range(10, 13):
+            other.append(payload(height), height % 7)
+        self.archive.extend(other)
+        other.close()
+        self.assertEqual(self.archive.num_heights(), 7)
+        self.assertEqual(bytes(self.archive.record(6)), payload(12))
+        self.assertEqual(bytes(self.archive.udata_record(5)), payload(11)[11 % 7:])
+
+    def test_bad_udata_offset(self):
+        with self.assertRaises(ValueError):
+            self.archive.append(b"abc", 4)
+
+    def test_served_by_bridge(self):
+        self.fill(30)
+
+        async def run():
+            server = BridgeServer(self.archive, "127.0.0.1:0")
+            await server.start()
+            try:
+                queue = asyncio.Queue()
+                end = await ublock_stream_reader(queue, f"127.0.0.1:{server.port}", 5,
+                                                 decode=bytes, range_size=8)
+                return end, [queue.get_nowait() for _ in range(queue.qsize())]
+            finally:
+                await server.stop()
+
+        end, got = asyncio.run(run())
+        self.assertEqual((end, got), (30, [payload(h) for h in range(5, 30)]))
+
+
+if __name__ == "__main__":
+    unittest.main()
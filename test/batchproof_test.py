@@ -0,0 +1,68 @@
+import io
+import unittest
+
+from accumulator import BatchProof, Hash, parent_hash
+
+
+class TestBatchProof(unittest.TestCase):
+    def setUp(self):
+        self.proof = BatchProof(
+            targets=[0, 5, 1 << 40],
+            proof=[Hash(bytes([i]) * 32) for i in range(2)],
+        )
+
+    def test_serialize_and_deserialize(self):
+        buf = io.BytesIO()
+        self.proof.serialize(buf)
+        self.assertEqual(len(buf.getvalue()), self.proof.serialize_size())
+
+        buf.seek(0)
+        decoded = BatchProof()
+        decoded.deserialize(buf)
+        self.assertEqual(decoded, self.proof)
+
+    def test_serialize_into_and_from_buffer(self):
+        buf = bytearray(3 + self.proof.serialize_size())
+        end = self.proof.serialize_into(buf, 3)
+        self.assertEqual(end, len(buf))
+
+        decoded, offset = BatchProof.from_buffer(memoryview(buf), 3)
+        self.assertEqual(decoded, self.proof)
+        self.assertEqual(offset, end)
+
+    def test_empty(self):
+        buf = io.BytesIO()
+        BatchProof().serialize(buf)
+        self.assertEqual(buf.getvalue(), bytes(8))
+
+    def test_from_buffer_truncated(self):
+        buf = bytearray(self.proof.serialize_size())
+        self.proof.serialize_into(buf, 0)
+        with self.assertRaises(ValueError):
+            BatchProof.from_buffer(buf[:-1], 0)
+
+    def test_deserialize_huge_count(self):
+        with self.assertRaises(ValueError):
+            BatchProof().deserialize(io.BytesIO(b"\xff\xff\xff\xff" + bytes(4)))
+
+    def test_calculate_roots(self):
+        leaves = [bytes([i]) * 32 for i in range(5)]
+        left = parent_hash(leaves[0], leaves[1])
+        right = parent_hash(leaves[2], leaves[3])
+        root = parent_hash(left, right)
+
+        proof = BatchProof(targets=[0, 3], proof=[leaves[1], leaves[2]])
+        self.assertEqual(proof.calculate_roots([leaves[0], leaves[3]], 5), {12: root})
+
+        # the single leaf tree is its own root
+        proof = BatchProof(targets=[4], proof=[])
+        self.assertEqual(proof.calculate_roots([leaves[4]], 5), {4: leaves[4]})
+
+    def test_calculate_roots_wrong_proof_size(self):
+        proof = BatchProof(targets=[0], proof=[])
+        with self.assertRaises(ValueError):
+            proof.calculate_roots([bytes(32)], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,9 @@
+import dataclasses
 import unittest
 import io
-from your_module import Hash, LeafData
+import hashlib
+from btcacc.compress import put_script, put_varint
+from your_module import BlockHashIndex, Hash, LeafData, LeafDataTable, LeafDataView, leaf_hashes
 
 class TestHash(unittest.TestCase):
     def test_valid_hash_creation(self):
@@ -48,6 +51,33 @@ class TestLeafData(unittest.TestCase):
         leaf_hash = self.leaf_data.leaf_hash()
         self.assertEqual(len(leaf_hash), 32)
 
+    def test_leaf_hashes_matches_leaf_hash(self):
+        other = LeafData(
+            block_hash=b'\x05' * 32,
+            tx_hash=Hash(b'\x06' * 32),
+            index=7,
+            height=200,
+            coinbase=False,
+            amt=123,
+            pk_script=b'',
+        )
+        hashes = leaf_hashes([self.leaf_data, other])
+        self.assertEqual(hashes, [self.leaf_data.leaf_hash(), other.leaf_hash()])
+
+    def test_leaf_hashes_matches_serialization(self):
+        buffer = io.BytesIO()
+        self.leaf_data.serialize(buffer)
+        expected = hashlib.sha512(buffer.getvalue()).digest()[:32]
+        self.assertEqual(leaf_hashes([self.leaf_data]), [expected])
+
+    def test_leaf_hashes_empty(self):
+        self.assertEqual(leaf_hashes([]), [])
+
+    def test_leaf_hashes_pk_script_too_long(self):
+        self.leaf_data.pk_script = b'\x04' * 10001
+        with self.assertRaises(ValueError):
+            leaf_hashes([self.leaf_data])
+
     def test_serialize_and_deserialize(self):
         buffer = io.BytesIO()
         self.leaf_data.serialize(buffer)
@@ -70,16 +100,207 @@ class TestLeafData(unittest.TestCase):
     def test_serialize_size(self):
         self.assertEqual(self.leaf_data.serialize_size(), 82 + len(self.leaf_data.pk_script))
 
+    def test_serialize_into(self):
+        buffer = io.BytesIO()
+        self.leaf_data.serialize(buffer)
+
+        buf = bytearray(2 + self.leaf_data.serialize_size())
+        end = self.leaf_data.serialize_into(buf, 2)
+        self.assertEqual(end, len(buf))
+        self.assertEqual(bytes(buf[2:]), buffer.getvalue())
+
+    def test_compact_round_trip(self):
+        compact = self.leaf_data.to_compact_bytes()
+        self.assertLess(len(compact), self.leaf_data.serialize_size())
+        self.assertEqual(LeafData.from_compact_bytes(compact), self.leaf_data)
+
+    def test_compact_template_script(self):
+        self.leaf_data.pk_script = b'\x00\x14' + b'\x07' * 20
+        compact = self.leaf_data.to_compact_bytes()
+        self.assertEqual(LeafData.from_compact_bytes(compact), self.leaf_data)
+
+    def test_compact_without_block_hash(self):
+        out = bytearray()
+        self.leaf_data.put_compact(out, omit_block_hash=True)
+        self.assertEqual(len(out), len(self.leaf_data.to_compact_bytes()) - 32)
+        block_hashes = {100: self.leaf_data.block_hash}
+        self.assertEqual(LeafData.from_compact_bytes(bytes(out), block_hashes), self.leaf_data)
+
+    def test_compact_trailing_bytes(self):
+        with self.assertRaises(ValueError):
+            LeafData.from_compact_bytes(self.leaf_data.to_compact_bytes() + b'\x00')
+
     def test_pk_script_too_long(self):
         self.leaf_data.pk_script = b'\x04' * 10001  # Exceed the limit
         with self.assertRaises(ValueError):
             buffer = io.BytesIO()
             self.leaf_data.serialize(buffer)
 
+    def test_wrong_hash_size(self):
+        for wrong in ({"block_hash": b'\x01' * 31}, {"block_hash": b'\x01' * 33},
+                      {"tx_hash": b'\x02' * 31}):
+            leaf_data = dataclasses.replace(self.leaf_data, **wrong)
+            for write in (lambda: leaf_data.serialize(io.BytesIO()),
+                          lambda: leaf_data.serialize_into(bytearray(200), 0),
+                          leaf_data.to_compact_bytes,
+                          leaf_data.leaf_hash):
+                with self.assertRaises(ValueError):
+                    write()
+
     def test_invalid_deserialize_pk_script_size(self):
         invalid_data = io.BytesIO(b'\x01' * 82 + struct.pack(">H", 10001) + b'\x04' * 10001)
         with self.assertRaises(ValueError):
             self.leaf_data.deserialize(invalid_data)
 
+class TestLeafDataTable(unittest.TestCase):
+    def setUp(self):
+        self.leaves = [
+            LeafData(
+                block_hash=bytes([i]) * 32,
+                tx_hash=Hash(bytes([i + 1]) * 32),
+                index=i,
+                height=100 + i,
+                coinbase=i == 0,
+                amt=5000 * i,
+                pk_script=b'\x03' * i,
+            )
+            for i in range(4)
+        ]
+        self.table = LeafDataTable.from_leaves(self.leaves)
+
+    def test_len_and_indexing(self):
+        self.assertEqual(len(self.table), 4)
+        self.assertEqual(self.table[2], self.leaves[2])
+        self.assertEqual(self.table[-1], self.leaves[-1])
+        with self.assertRaises(IndexError):
+            self.table[4]
+
+    def test_iteration(self):
+        self.assertEqual(list(self.table), self.leaves)
+
+    def test_append(self):
+        table = LeafDataTable()
+        table.append(self.leaves[1])
+        self.assertEqual(len(table), 1)
+        self.assertEqual(table[0], self.leaves[1])
+
+    def test_append_pk_script_too_long(self):
+        self.leaves[0].pk_script = b'\x04' * 10001
+        with self.assertRaises(ValueError):
+            LeafDataTable().append(self.leaves[0])
+
+    def test_append_compact_amount_too_large(self):
+        data = bytearray()
+        # e = 9, so this decompresses to (2**50 + 1) * 10**9
+        for n in (0, 0, 10 * 2**50 + 10):
+            put_varint(data, n)
+        put_script(data, b'\x51')
+        data += bytes(64)
+
+        with self.assertRaises(ValueError):
+            self.table.append_compact(memoryview(data), 0)
+        # Every column still holds the same entries
+        self.assertEqual(list(self.table), self.leaves)
+        self.assertEqual(len(self.table.indexes), len(self.table.amounts))
+
+    def test_serialize_matches_leaf_data(self):
+        expected = io.BytesIO()
+        for ld in self.leaves:
+            ld.serialize(expected)
+
+        buffer = io.BytesIO()
+        self.table.serialize(buffer)
+        self.assertEqual(buffer.getvalue(), expected.getvalue())
+        self.assertEqual(self.table.serialize_size(), len(expected.getvalue()))
+
+    def test_serialize_into(self):
+        buffer = io.BytesIO()
+        self.table.serialize(buffer)
+
+        buf = bytearray(1 + self.table.serialize_size())
+        self.assertEqual(self.table.serialize_into(buf, 1), len(buf))
+        self.assertEqual(bytes(buf[1:]), buffer.getvalue())
+
+    def test_deserialize(self):
+        buffer = io.BytesIO()
+        self.table.serialize(buffer)
+        buffer.seek(0)
+        self.assertEqual(list(LeafDataTable.deserialize(buffer, 4)), self.leaves)
+
+    def test_deserialize_truncated(self):
+        buffer = io.BytesIO()
+        self.table.serialize(buffer)
+        with self.assertRaises(ValueError):
+            LeafDataTable.deserialize(io.BytesIO(buffer.getvalue()[:-1]), 4)
+
+    def test_leaf_hashes(self):
+        self.assertEqual(leaf_hashes(self.table), leaf_hashes(self.leaves))
+
+class TestLeafDataView(unittest.TestCase):
+    def setUp(self):
+        self.leaves = [
+            LeafData(
+                block_hash=bytes([i]) * 32,
+                tx_hash=Hash(bytes([i + 1]) * 32),
+                index=i,
+                height=100 + i,
+                coinbase=i == 0,
+                amt=5000 * i,
+                pk_script=b'\x03' * i,
+            )
+            for i in range(3)
+        ]
+        buffer = io.BytesIO()
+        buffer.write(b'\xff' * 5)
+        for ld in self.leaves:
+            ld.serialize(buffer)
+        self.data = buffer.getvalue()
+
+    def test_scan(self):
+        view, end = LeafDataView.scan(self.data, 5, 3)
+        self.assertEqual(end, len(self.data))
+        self.assertEqual(len(view), 3)
+        self.assertEqual(list(view), self.leaves)
+        self.assertEqual(view[-1], self.leaves[-1])
+
+    def test_scan_truncated(self):
+        with self.assertRaises(ValueError):
+            LeafDataView.scan(self.data[:-1], 5, 3)
+
+    def test_serialize(self):
+        view, _ = LeafDataView.scan(self.data, 5, 3)
+        buffer = io.BytesIO()
+        view.serialize(buffer)
+        self.assertEqual(buffer.getvalue(), self.data[5:])
+        self.assertEqual(view.serialize_size(), len(self.data) - 5)
+
+    def test_leaf_hashes(self):
+        view, _ = LeafDataView.scan(self.data, 5, 3)
+        self.assertEqual(leaf_hashes(view), leaf_hashes(self.leaves))
+
+class TestBlockHashIndex(unittest.TestCase):
+    def test_lookup(self):
+        index = BlockHashIndex(start_height=5)
+        index.append(b'\x01' * 32)
+        index.append(b'\x02' * 32)
+        self.assertEqual(len(index), 7)
+        self.assertEqual(index[6], b'\x02' * 32)
+        with self.assertRaises(IndexError):
+            index[4]
+        with self.assertRaises(IndexError):
+            index[7]
+
+    def test_serialize(self):
+        index = BlockHashIndex(start_height=3)
+        index.append(b'\x01' * 32)
+        buffer = io.BytesIO()
+        index.serialize(buffer)
+        buffer.seek(0)
+
+        restored = BlockHashIndex()
+        restored.deserialize(buffer)
+        self.assertEqual(len(restored), 4)
+        self.assertEqual(restored[3], b'\x01' * 32)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,92 @@
+import random
+import unittest
+
+from accumulator import Forest, Leaf, Pollard
+from bridge.cachesim import CacheSimulator
+from btcacc import LeafData, UData, leaf_hashes
+
+
+def make_leaf_datas(start, count):
+    return [
+        LeafData(block_hash=bytes(32), tx_hash=i.to_bytes(32, "big"), index=0,
+                 height=1, amt=1000 + i, pk_script=b"\x51")
+        for i in range(start, start + count)
+    ]
+
+
+class TestCacheSimulator(unittest.TestCase):
+    def setUp(self):
+        self.forest = Forest()
+        self.csn = Pollard()
+        self.csn.lookahead = 3
+        self.sim = CacheSimulator(3, 0, [])
+        self.unspent = []  # (LeafData, spend height)
+        self.height = 0
+        self.next_leaf = 0
+
+    def run_blocks(self, num_blocks):
+        rng = random.Random(9)
+        full_hashes = partial_hashes = 0
+        for height in range(self.height, self.height + num_blocks):
+            spent = [ld for ld, h in self.unspent if h == height]
+            self.unspent = [(ld, h) for ld, h in self.unspent if h != height]
+
+            new = make_leaf_datas(self.next_leaf, 10)
+            self.next_leaf += 10
+            ttls = [rng.randint(1, 6) for _ in new]
+            self.unspent += [(ld, height + ttl) for ld, ttl in zip(new, ttls)]
+
+            udata = UData(height=height, stxos=spent, txo_ttls=ttls)
+            udata.acc_proof = self.forest.prove_batch(leaf_hashes(spent))
+            remember = udata.remember_flags(self.sim.lookahead)
+            adds = [Leaf(hash=h, remember=r, ttl=t)
+                    for h, r, t in zip(leaf_hashes(new), remember, ttls)]
+            self.forest.modify(adds, udata.acc_proof.targets)
+
+            sent = self.sim.process(udata, adds)
+            full_hashes += len(udata.acc_proof.proof)
+            partial_hashes += sum(h is not None for h in sent.acc_proof.proof)
+
+            # the CSN fills the gaps from its cache and verifies
+            self.csn.ingest_batch_proof(leaf_hashes(sent.stxos), sent.acc_proof)
+            self.assertEqual(sent.acc_proof.proof, udata.acc_proof.proof)
+            self.csn.modify(adds, sent.acc_proof.targets)
+            self.assertEqual(self.csn.get_roots(), self.forest.get_roots())
+
+        self.height += num_blocks
+        return full_hashes, partial_hashes
+
+    def test_partial_proofs_fill_in(self):
+        full_hashes, partial_hashes = self.run_blocks(30)
+        self.assertLess(partial_hashes, full_hashes)
+
+    def test_starts_from_announced_roots(self):
+        self.csn.lookahead = 0
+        self.sim = CacheSimulator(0, 0, [])
+        self.run_blocks(5)
+
+        # a new session from the CSN's current roots
+        self.csn.lookahead = 3
+        self.csn.forget_all()
+        self.sim = CacheSimulator(3, self.csn.num_leaves, self.csn.get_roots())
+        self.run_blocks(10)
+
+    def test_budgeted_cache_matches(self):
+        self.csn.lookahead = 100
+        self.csn.max_nodes = 30
+        self.sim = CacheSimulator(100, 0, [], max_nodes=30)
+        full_hashes, partial_hashes = self.run_blocks(30)
+        self.assertLess(partial_hashes, full_hashes)
+        self.assertLessEqual(self.csn.node_count(), 30)
+
+    def test_trim_rejects_wrong_proof_size(self):
+        self.forest.modify([Leaf(hash=h) for h in leaf_hashes(make_leaf_datas(0, 4))], [])
+        sim = CacheSimulator(0, 4, self.forest.get_roots())
+        proof = self.forest.prove_batch(leaf_hashes(make_leaf_datas(0, 1)))
+        proof.proof.pop()
+        with self.assertRaises(ValueError):
+            sim.trim(proof)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+
+from btcacc.compress import (
+    NUM_SPECIAL_SCRIPTS, SCRIPT_P2PKH, SCRIPT_P2SH, SCRIPT_P2TR, SCRIPT_P2WPKH,
+    SCRIPT_P2WSH, compress_amount, decompress_amount, get_script, get_varint,
+    put_script, put_varint, script_template, unzigzag, zigzag,
+)
+
+
+class TestVarint(unittest.TestCase):
+    def test_known_encodings(self):
+        for n, encoded in [(0, "00"), (127, "7f"), (128, "8000"), (255, "807f"),
+                           (16511, "ff7f"), (16512, "808000")]:
+            out = bytearray()
+            put_varint(out, n)
+            self.assertEqual(out.hex(), encoded)
+
+    def test_round_trip(self):
+        for n in [0, 1, 0x7f, 0x80, 0x3fff, 0x4000, 2**32, 2**56 - 1]:
+            out = bytearray(b"\xaa")
+            put_varint(out, n)
+            self.assertEqual(get_varint(out, 1), (n, len(out)))
+
+    def test_negative(self):
+        with self.assertRaises(ValueError):
+            put_varint(bytearray(), -1)
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            get_varint(b"\x80", 0)
+
+    def test_zigzag(self):
+        self.assertEqual([zigzag(n) for n in (0, -1, 1, -2, 2)], [0, 1, 2, 3, 4])
+        for n in [0, 1, -1, 2**31 - 1, -2**31]:
+            self.assertEqual(unzigzag(zigzag(n)), n)
+
+
+class TestAmountCompression(unittest.TestCase):
+    def test_known_values(self):
+        self.assertEqual(compress_amount(0), 0)
+        self.assertEqual(compress_amount(1), 1)
+        self.assertEqual(compress_amount(100000000), 9)
+        self.assertEqual(compress_amount(5000000000), 50)
+        self.assertEqual(compress_amount(2100000000000000), 0x1406f40)
+
+    def test_round_trip(self):
+        for amt in [0, 1, 9, 10, 1234, 546, 100000000, 123456789, 2100000000000000]:
+            self.assertEqual(decompress_amount(compress_amount(amt)), amt)
+
+    def test_negative(self):
+        with self.assertRaises(ValueError):
+            compress_amount(-1)
+
+
+class TestScriptCompression(unittest.TestCase):
+    scripts = {
+        SCRIPT_P2PKH: b"\x76\xa9\x14" + b"\x01" * 20 + b"\x88\xac",
+        SCRIPT_P2SH: b"\xa9\x14" + b"\x02" * 20 + b"\x87",
+        SCRIPT_P2WPKH: b"\x00\x14" + b"\x03" * 20,
+        SCRIPT_P2WSH: b"\x00\x20" + b"\x04" * 32,
+        SCRIPT_P2TR: b"\x51\x20" + b"\x05" * 32,
+    }
+
+    def test_templates(self):
+        for tag, script in self.scripts.items():
+            self.assertEqual(script_template(script), tag)
+            out = bytearray()
+            put_script(out, script)
+            self.assertEqual(out[0], tag)
+            self.assertLess(len(out), len(script))
+            self.assertEqual(get_script(out, 0, 10000), (script, len(out)))
+
+    def test_raw_script(self):
+        script = b"\x6a\x04test"
+        self.assertEqual(script_template(script), -1)
+        out = bytearray()
+        put_script(out, script)
+        self.assertEqual(out[0], len(script) + NUM_SPECIAL_SCRIPTS)
+        self.assertEqual(get_script(out, 0, 10000), (script, len(out)))
+
+    def test_near_template_is_raw(self):
+        script = b"\x76\xa9\x14" + b"\x01" * 20 + b"\x88\xad"
+        self.assertEqual(script_template(script), -1)
+
+    def test_raw_script_too_long(self):
+        out = bytearray()
+        put_script(out, b"\x00" * 101)
+        with self.assertRaises(ValueError):
+            get_script(out, 0, 100)
+
+    def test_reserved_tag(self):
+        with self.assertRaises(ValueError):
+            get_script(b"\x05" + b"\x00" * 32, 0, 10000)
+
+
+if __name__ == "__main__":
+    unittest.main()
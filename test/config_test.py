@@ -49,6 +49,14 @@ class TestParseArgs(unittest.TestCase):
 
         self.assertEqual(config.remote_host, "192.168.1.1:8338")
 
+    def test_several_hosts(self):
+        args = ['-host=10.0.0.1:1234,10.0.0.2']
+        with patch('sys.argv', ['script_name'] + args):
+            config = parse_args(args)
+
+        self.assertEqual(config.remote_host, "10.0.0.1:1234")
+        self.assertEqual(config.remote_hosts, ["10.0.0.1:1234", "10.0.0.2:8338"])
+
     def test_cpu_and_memory_profiling(self):
         args = ['-cpuprof=cpu.prof', '-memprof=mem.prof']
         with patch('sys.argv', ['script_name'] + args):
@@ -0,0 +1,241 @@
+import hashlib
+import os
+import random
+import tempfile
+import unittest
+
+from accumulator import EMPTY_HASH, Forest, Leaf, parent_hash
+from accumulator.positions import tree_rows
+
+
+def make_hashes(start, count):
+    return [hashlib.sha256(i.to_bytes(8, "big")).digest() for i in range(start, start + count)]
+
+
+def collapse(slots):
+    """Root of a perfect tree of slots with deleted (None) leaves collapsed"""
+    if len(slots) == 1:
+        return slots[0]
+    mid = len(slots) // 2
+    left, right = collapse(slots[:mid]), collapse(slots[mid:])
+    if left is None:
+        return right
+    if right is None:
+        return left
+    return parent_hash(left, right)
+
+
+def expected_roots(slots):
+    roots = []
+    start = 0
+    for row in range(tree_rows(len(slots)), -1, -1):
+        if (len(slots) >> row) & 1:
+            roots.append(collapse(slots[start:start + (1 << row)]) or EMPTY_HASH)
+            start += 1 << row
+    return roots
+
+
+class TestForest(unittest.TestCase):
+    def setUp(self):
+        self.forest = Forest()
+
+    def test_add(self):
+        hashes = make_hashes(0, 5)
+        self.forest.modify([Leaf(hash=h) for h in hashes], [])
+
+        self.assertEqual(self.forest.num_leaves, 5)
+        self.assertEqual(self.forest.rows, 3)
+        self.assertEqual(self.forest.get_roots(), expected_roots(hashes))
+        self.assertEqual(self.forest.positions.get(hashes[4]), 4)
+
+    def test_delete_moves_sibling_up(self):
+        hashes = make_hashes(0, 4)
+        self.forest.modify([Leaf(hash=h) for h in hashes], [])
+        self.forest.modify([], [0])
+
+        # leaf 1 moves up into the parent at position 4
+        self.assertEqual(self.forest.positions.get(hashes[1]), 4)
+        self.assertEqual(self.forest.get_roots(),
+                         [parent_hash(hashes[1], parent_hash(hashes[2], hashes[3]))])
+
+    def test_delete_root_then_add(self):
+        hashes = make_hashes(0, 2)
+        self.forest.modify([Leaf(hash=hashes[0])], [])
+        self.forest.modify([], [0])
+        self.assertEqual(self.forest.get_roots(), [EMPTY_HASH])
+
+        # the new leaf climbs past the empty root
+        self.forest.modify([Leaf(hash=hashes[1])], [])
+        self.assertEqual(self.forest.get_roots(), [hashes[1]])
+        self.assertEqual(self.forest.positions.get(hashes[1]), 2)
+
+    def test_remap_keeps_positions(self):
+        hashes = make_hashes(0, 8)
+        self.forest.modify([Leaf(hash=h) for h in hashes[:3]], [])
+        self.forest.modify([Leaf(hash=h) for h in hashes[3:]], [0])
+
+        self.assertEqual(self.forest.rows, 3)
+        self.assertEqual(self.forest.get_roots(), expected_roots([None] + hashes[1:]))
+        for h in hashes[1:]:
+            self.assertTrue(self.forest.verify_batch_proof([h], self.forest.prove_batch([h])))
+
+    def test_random_blocks(self):
+        rng = random.Random(7)
+        slots = []
+        live = []
+        next_leaf = 0
+        for _ in range(50):
+            adds = make_hashes(next_leaf, rng.randint(0, 30))
+            next_leaf += len(adds)
+            dels = rng.sample(live, min(len(live), rng.randint(0, 20)))
+
+            proof = self.forest.prove_batch(dels)
+            self.assertTrue(self.forest.verify_batch_proof(dels, proof))
+            targets = list(proof.targets)
+            rng.shuffle(targets)
+            self.forest.modify([Leaf(hash=h) for h in adds], targets)
+
+            for h in dels:
+                live.remove(h)
+                slots[slots.index(h)] = None
+            live += adds
+            slots += adds
+            self.assertEqual(self.forest.get_roots(), expected_roots(slots))
+            self.assertEqual(len(self.forest.positions), len(live))
+
+    def test_undo(self):
+        rng = random.Random(0)
+        live = []
+        next_leaf = 0
+        states = []
+        # adds that climb past empty roots move the old roots up with them
+        for _ in range(60):
+            adds = make_hashes(next_leaf, rng.randint(0, 20))
+            next_leaf += len(adds)
+            dels = rng.sample(live, min(len(live), rng.randint(0, 15)))
+            states.append((self.forest.num_leaves, self.forest.rows, bytes(self.forest.data.buf),
+                           dict(self.forest.positions.items())))
+            undo = self.forest.modify([Leaf(hash=h) for h in adds],
+                                      self.forest.prove_batch(dels).targets)
+            states[-1] += (undo,)
+            for h in dels:
+                live.remove(h)
+            live += adds
+
+        for num_leaves, rows, buf, positions, undo in reversed(states):
+            self.forest.undo(undo)
+            self.assertEqual((self.forest.num_leaves, self.forest.rows), (num_leaves, rows))
+            self.assertEqual(bytes(self.forest.data.buf), buf)
+            self.assertEqual(dict(self.forest.positions.items()), positions)
+
+    def test_prove_batch_unknown_hash(self):
+        self.forest.modify([Leaf(hash=h) for h in make_hashes(0, 2)], [])
+        with self.assertRaises(ValueError):
+            self.forest.prove_batch(make_hashes(5, 1))
+
+    def test_modify_invalid_delete(self):
+        self.forest.modify([Leaf(hash=h) for h in make_hashes(0, 2)], [])
+        with self.assertRaises(ValueError):
+            self.forest.modify([], [2])
+        with self.assertRaises(ValueError):
+            self.forest.modify([], [0, 0])
+
+    def test_verify_wrong_hash(self):
+        hashes = make_hashes(0, 4)
+        self.forest.modify([Leaf(hash=h) for h in hashes], [])
+        proof = self.forest.prove_batch([hashes[0]])
+        self.assertFalse(self.forest.verify_batch_proof([hashes[1]], proof))
+
+    def test_stats(self):
+        self.forest.modify([Leaf(hash=h) for h in make_hashes(0, 3)], [])
+        self.assertIn("numleaves: 3", self.forest.stats())
+
+
+class TestDiskForest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "forest.dat")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_matches_ram_forest(self):
+        rng = random.Random(3)
+        ram = Forest()
+        # two hot rows, so modifications cross the mapped/resident boundary
+        disk = Forest.open(self.path, hot_rows=2)
+        live = []
+        next_leaf = 0
+        for _ in range(30):
+            adds = make_hashes(next_leaf, rng.randint(0, 20))
+            next_leaf += len(adds)
+            dels = rng.sample(live, min(len(live), rng.randint(0, 10)))
+
+            for forest in (ram, disk):
+                targets = forest.prove_batch(dels).targets
+                forest.modify([Leaf(hash=h) for h in adds], targets)
+            for h in dels:
+                live.remove(h)
+            live += adds
+
+            self.assertEqual(disk.get_roots(), ram.get_roots())
+            self.assertEqual(dict(disk.positions.items()), dict(ram.positions.items()))
+        disk.close()
+
+    def test_reopen(self):
+        hashes = make_hashes(0, 11)
+        forest = Forest.open(self.path, hot_rows=2)
+        forest.modify([Leaf(hash=h) for h in hashes], [])
+        forest.modify([], [3, 8])
+        roots = forest.get_roots()
+        positions = dict(forest.positions.items())
+        forest.close()
+
+        reopened = Forest.open(self.path, hot_rows=3)
+        self.assertEqual(reopened.num_leaves, 11)
+        self.assertEqual(reopened.get_roots(), roots)
+        self.assertEqual(dict(reopened.positions.items()), positions)
+        self.assertTrue(reopened.verify_batch_proof(
+            [hashes[0]], reopened.prove_batch([hashes[0]])))
+        reopened.close()
+
+    def test_save_checkpoint(self):
+        hashes = make_hashes(0, 20)
+        for forest in (Forest(), Forest.open(self.path, hot_rows=2)):
+            forest.modify([Leaf(hash=h) for h in hashes], [])
+            forest.modify([], [1, 12])
+            checkpoint = os.path.join(self.tmpdir.name, "checkpoint")
+            forest.save(checkpoint)
+            # later changes don't reach the checkpoint
+            roots = forest.get_roots()
+            forest.modify([Leaf(hash=h) for h in make_hashes(20, 3)], [4])
+
+            loaded = Forest.open(checkpoint)
+            self.assertEqual((loaded.num_leaves, loaded.get_roots()), (20, roots))
+            self.assertTrue(loaded.verify_batch_proof(
+                [hashes[4]], loaded.prove_batch([hashes[4]])))
+            loaded.close()
+            forest.close()
+
+    def test_undo_on_disk(self):
+        rng = random.Random(5)
+        forest = Forest.open(self.path, hot_rows=2)
+        hashes = make_hashes(0, 40)
+        forest.modify([Leaf(hash=h) for h in hashes[:30]], [])
+        roots = forest.get_roots()
+        dels = rng.sample(hashes[:30], 8)
+        undo = forest.modify([Leaf(hash=h) for h in hashes[30:]], forest.prove_batch(dels).targets)
+        forest.undo(undo)
+        self.assertEqual((forest.num_leaves, forest.get_roots()), (30, roots))
+        self.assertTrue(forest.verify_batch_proof(dels, forest.prove_batch(dels)))
+        forest.close()
+
+    def test_open_without_meta(self):
+        with open(self.path, "wb") as f:
+            f.write(bytes(32))
+        with self.assertRaises(ValueError):
+            Forest.open(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+
+from accumulator import DiskForestData, RamForestData
+
+
+def hash_of(i):
+    return i.to_bytes(4, "big") * 8
+
+
+class TestForestData(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "forest.dat")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def stores(self):
+        ram = RamForestData()
+        disk = DiskForestData(self.path, hot_rows=2)
+        for data in (ram, disk):
+            data.resize(15)
+            for pos in range(15):
+                data.write(pos, hash_of(pos + 1))
+        return ram, disk
+
+    def test_read_write_across_hot_rows(self):
+        ram, disk = self.stores()
+        # the top two rows (positions 12-14) are resident
+        self.assertEqual(disk.hot_start, 12)
+        for pos in range(15):
+            self.assertEqual(disk.read(pos), ram.read(pos))
+        self.assertEqual(disk.read_range(10, 4), ram.read_range(10, 4))
+        disk.close()
+
+    def test_copy_and_clear_ranges(self):
+        ram, disk = self.stores()
+        for data in (ram, disk):
+            data.copy_range(8, 11, 4)
+            data.copy_range(3, 1, 5)
+            data.clear_range(13, 2)
+        self.assertEqual(disk.read_range(0, 15), ram.read_range(0, 15))
+        self.assertTrue(disk.is_empty(14))
+        disk.close()
+
+    def test_resize_keeps_data(self):
+        _, disk = self.stores()
+        disk.resize(31)
+        self.assertEqual(disk.size(), 31)
+        self.assertEqual(disk.read(13), hash_of(14))
+        self.assertTrue(disk.is_empty(30))
+        disk.close()
+
+        reopened = DiskForestData(self.path, hot_rows=2)
+        self.assertEqual(reopened.read(13), hash_of(14))
+        self.assertEqual(reopened.size(), 31)
+        reopened.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -36,6 +36,22 @@ class TestIBD(unittest.TestCase):
         mock_bech32_decode.assert_called_once_with("bc1qexampleaddress")
         mock_Csn.return_value.register_address.assert_called_once()
 
+    @patch("your_module.restore_block_hashes")
+    @patch("your_module.Csn")
+    @patch("your_module.init_csn_state", return_value=(MagicMock(), 0, MagicMock()))
+    def test_remote_hosts_reach_csn(self, mock_init_csn_state, mock_Csn, mock_restore_block_hashes):
+        config = Config(remote_hosts=["10.0.0.1:1234", "10.0.0.2:8338"])
+        sig = threading.Event()
+        sig.set()
+        run_ibd(config, sig)
+        self.assertEqual(mock_Csn.return_value.remote_host, "10.0.0.1:1234")
+        self.assertEqual(mock_Csn.return_value.remote_hosts, ["10.0.0.1:1234", "10.0.0.2:8338"])
+
+    def test_config_remote_host(self):
+        self.assertEqual(Config().remote_hosts, ["127.0.0.1:8338"])
+        config = Config(remote_host="10.0.0.1:1234")
+        self.assertEqual((config.remote_host, config.remote_hosts), ("10.0.0.1:1234", ["10.0.0.1:1234"]))
+
     @patch("your_module.init_csn_state", side_effect=Exception("init error"))
     def test_init_csn_state_failure(self, mock_init_csn_state):
         config = Config()
@@ -0,0 +1,228 @@
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from unittest.mock import Mock, patch
+
+from accumulator import Forest
+from bridge.archive import UBlockArchive
+from bridge.pipeline import (
+    BLOCK_RECORD, BlockProver, PreparedBlock, ProofPipeline, build_archive, read_block_file,
+)
+from bridge.reproof import ForestCheckpoints
+from bridge.utxostore import LeafDataStore
+from btcacc import LeafData, LeafDataTable, leaf_hashes
+from server_test import StandInBlock, StandInMsgBlock, build_chain
+from util import outpoint_to_bytes
+
+
+def square(n):
+    # Later items finish first, so the order has to be restored
+    time.sleep(0.001 * (n % 3))
+    return n * n
+
+
+def fail_at_five(n):
+    if n == 5:
+        raise ValueError("bad block")
+    return n
+
+
+class TestProofPipeline(unittest.TestCase):
+    def run_pipeline(self, prepare, prove, items, executor=None, depth=4):
+        written = []
+        pipeline = ProofPipeline(prepare, prove, written.append, executor, depth)
+        return pipeline.run(items), written
+
+    def test_in_order_through_processes(self):
+        proved = []
+
+        def prove(n):
+            proved.append(n)
+            return -n
+
+        with ProcessPoolExecutor(2) as executor:
+            count, written = self.run_pipeline(square, prove, range(30), executor)
+        self.assertEqual(count, 30)
+        self.assertEqual(proved, [n * n for n in range(30)])
+        self.assertEqual(written, [-n * n for n in range(30)])
+
+    def test_prove_is_sequential(self):
+        threads = set()
+
+        def prove(n):
+            threads.add(threading.get_ident())
+            return n
+
+        with ThreadPoolExecutor(4) as executor:
+            count, written = self.run_pipeline(square, prove, range(50), executor)
+        self.assertEqual(threads, {threading.get_ident()})
+        self.assertEqual(written, [n * n for n in range(50)])
+
+    def test_bounded_ahead_of_prove(self):
+        taken = []
+
+        def items():
+            for n in range(20):
+                taken.append(n)
+                yield n
+
+        def prove(n):
+            # Never more than depth items taken past the one being proved
+            self.assertLessEqual(len(taken), n + 1 + 3)
+            return n
+
+        with ThreadPoolExecutor(2) as executor:
+            count, _ = self.run_pipeline(lambda n: n, prove, items(), executor, depth=3)
+        self.assertEqual(count, 20)
+
+    def test_prepare_error(self):
+        with ProcessPoolExecutor(2) as executor:
+            with self.assertRaises(ValueError):
+                self.run_pipeline(fail_at_five, lambda n: n, range(10), executor)
+
+    def test_prove_error(self):
+        def prove(n):
+            if n == 3:
+                raise KeyError(n)
+            return n
+
+        with ThreadPoolExecutor(2) as executor:
+            with self.assertRaises(KeyError):
+                self.run_pipeline(lambda n: n, prove, range(10), executor)
+
+    def test_write_error(self):
+        def write(n):
+            if n == 2:
+                raise OSError("disk full")
+
+        pipeline = ProofPipeline(lambda n: n, lambda n: n, write, ThreadPoolExecutor(2), 2)
+        with self.assertRaises(OSError):
+            pipeline.run(range(100))
+
+    def test_bad_depth(self):
+        with self.assertRaises(ValueError):
+            ProofPipeline(square, square, print, depth=0)
+
+
+def prepared(height, spends):
+    """A block creating 3 outputs and spending spends, as (height, index)"""
+    leaf_datas = [LeafData(tx_hash=bytes([height]) * 32, index=i, height=height, amt=i)
+                  for i in range(3)]
+    return PreparedBlock(
+        height, b"", LeafDataTable.from_leaves(leaf_datas), b"".join(leaf_hashes(leaf_datas)),
+        b"".join(outpoint_to_bytes(bytes([h]) * 32, i) for h, i in spends), 3,
+    )
+
+
+class TestBlockProver(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.archive = UBlockArchive(os.path.join(self.dir.name, "ublocks"))
+        self.utxos = LeafDataStore(os.path.join(self.dir.name, "utxos.db"), flush_blocks=2)
+        self.checkpoints = ForestCheckpoints(os.path.join(self.dir.name, "checkpoints"), 2)
+        self.prover = BlockProver(Forest(), self.utxos, self.checkpoints, undo_depth=3)
+
+    def tearDown(self):
+        self.utxos.db.close()
+        self.archive.close()
+        self.dir.cleanup()
+
+    def test_rollback(self):
+        blocks = [prepared(0, []), prepared(1, [(0, 1)]), prepared(2, [(0, 0), (1, 2)]),
+                  prepared(3, [(2, 1), (1, 0)]), prepared(4, [(3, 0), (0, 2)])]
+        roots = []
+        for block in blocks:
+            self.archive.append(bytes(8), 0)
+            udata = self.prover(block).udata
+            self.assertEqual(len(udata.acc_proof.targets), len(block.spent_keys()))
+            roots.append(self.prover.forest.get_roots())
+        self.assertEqual(self.checkpoints.heights(), [2, 4])
+
+        ttls = Mock()
+        self.prover.rollback(3, self.archive, ttls)
+        ttls.rollback.assert_called_once_with(3)
+        self.assertEqual(self.archive.num_heights(), 3)
+        self.assertEqual(self.prover.forest.get_roots(), roots[2])
+        self.assertEqual(self.checkpoints.heights(), [2])
+        self.assertEqual(len(self.utxos), 9 - 3)
+
+        # the rolled back spends can be made again, by another block
+        self.archive.append(bytes(8), 0)
+        self.prover(prepared(3, [(2, 1), (0, 2)]))
+        self.assertEqual(len(self.utxos), 9 - 3 + 3 - 2)
+        with self.assertRaises(ValueError):
+            self.prover.rollback(0, self.archive)
+
+
+class TestBuildArchive(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    @patch("bridge.pipeline.Block", StandInBlock)
+    @patch("bridge.pipeline.MsgBlock", StandInMsgBlock)
+    def test_matches_chain(self):
+        ublocks, chain_forest = build_chain(12)
+        path = os.path.join(self.dir.name, "bootstrap.dat")
+        raws = []
+        with open(path, "wb") as f:
+            for ub in ublocks:
+                buf = io.BytesIO()
+                ub.block.msg_block.serialize(buf)
+                raws.append(buf.getvalue())
+                f.write(BLOCK_RECORD.pack(b"\xf9\xbe\xb4\xd9", len(raws[-1])) + raws[-1])
+
+        forest = Forest()
+        archive = UBlockArchive(os.path.join(self.dir.name, "ublocks"))
+        utxos = LeafDataStore(os.path.join(self.dir.name, "utxos.db"))
+        try:
+            self.assertEqual(build_archive(forest, archive, read_block_file(path), utxos, workers=2), 12)
+            self.assertEqual(forest.get_roots(), chain_forest.get_roots())
+            for height, ub in enumerate(ublocks):
+                self.assertEqual(bytes(archive.record(height)[:len(raws[height])]), raws[height])
+                udata = archive.udata(height)
+                self.assertEqual(udata.height, height)
+                self.assertEqual(udata.acc_proof.targets, ub.utreexo_data.acc_proof.targets)
+                self.assertEqual(udata.acc_proof.proof, ub.utreexo_data.acc_proof.proof)
+                self.assertEqual(list(udata.stxos), list(ub.utreexo_data.stxos))
+        finally:
+            utxos.db.close()
+            archive.close()
+
+
+class TestReadBlockFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "bootstrap.dat")
+        self.blocks = [bytes([height]) * (height + 1) for height in range(5)]
+        with open(self.path, "wb") as f:
+            for raw in self.blocks:
+                f.write(BLOCK_RECORD.pack(b"\xf9\xbe\xb4\xd9", len(raw)) + raw)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_from_start(self):
+        self.assertEqual(list(read_block_file(self.path)), list(enumerate(self.blocks)))
+        self.assertEqual(list(read_block_file(self.path, 3)), [(3, self.blocks[3]), (4, self.blocks[4])])
+        self.assertEqual(list(read_block_file(self.path, 9)), [])
+
+    def test_stops_at_incomplete_record(self):
+        with open(self.path, "ab") as f:
+            f.write(BLOCK_RECORD.pack(b"\xf9\xbe\xb4\xd9", 10) + bytes(4))
+        self.assertEqual(len(list(read_block_file(self.path))), 5)
+
+    def test_stops_at_zeroed_record(self):
+        with open(self.path, "ab") as f:
+            f.write(bytes(64))
+        self.assertEqual(len(list(read_block_file(self.path))), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
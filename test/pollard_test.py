@@ -0,0 +1,181 @@
+import hashlib
+import io
+import random
+import unittest
+
+from accumulator import BatchProof, Forest, Leaf, Pollard
+
+
+def make_hashes(start, count):
+    return [hashlib.sha256(i.to_bytes(8, "big")).digest() for i in range(start, start + count)]
+
+
+class TestPollard(unittest.TestCase):
+    def setUp(self):
+        self.forest = Forest()
+        self.pollard = Pollard()
+        self.live = []
+        self.next_leaf = 0
+
+    def apply_block(self, num_adds, dels, remember=(), ttls=()):
+        adds = [
+            Leaf(hash=h, remember=i in remember, ttl=ttls[i] if i < len(ttls) else 0)
+            for i, h in enumerate(make_hashes(self.next_leaf, num_adds))
+        ]
+        self.next_leaf += num_adds
+
+        proof = self.forest.prove_batch(dels)
+        self.pollard.ingest_batch_proof(dels, proof)
+        self.forest.modify(adds, proof.targets)
+        self.pollard.modify(adds, proof.targets)
+
+        for h in dels:
+            self.live.remove(h)
+        self.live += [leaf.hash for leaf in adds]
+
+    def test_matches_forest(self):
+        rng = random.Random(11)
+        for _ in range(40):
+            num_adds = rng.randint(0, 25)
+            remember = {i for i in range(num_adds) if rng.random() < 0.3}
+            dels = rng.sample(self.live, min(len(self.live), rng.randint(0, 15)))
+            self.apply_block(num_adds, dels, remember)
+            self.assertEqual(self.pollard.get_roots(), self.forest.get_roots())
+        self.assertEqual(self.pollard.reconstruct_stats(),
+                         (self.forest.num_leaves, self.forest.rows))
+
+    def test_prunes_to_roots_without_remember(self):
+        rng = random.Random(5)
+        for _ in range(20):
+            dels = rng.sample(self.live, min(len(self.live), 8))
+            self.apply_block(16, dels)
+        self.assertEqual(self.pollard.node_count(),
+                         sum(1 for h in self.pollard.get_roots() if any(h)))
+
+    def test_remembered_leaf_kept(self):
+        self.apply_block(8, [], remember={3})
+        leaf = self.live[3]
+        # leaf 3 and its path: 3 leaves, 2 row 1, 2 row 2, plus the root
+        self.assertEqual(self.pollard.node_count(), 7)
+        self.assertEqual(self.pollard.read_position(3), leaf)
+        self.assertIsNone(self.pollard.read_position(0))
+
+        self.apply_block(0, [leaf])
+        self.assertEqual(self.pollard.node_count(), 1)
+        self.assertEqual(self.pollard.get_roots(), self.forest.get_roots())
+
+    def test_ingest_bad_proof(self):
+        self.apply_block(4, [])
+        proof = self.forest.prove_batch([self.live[0]])
+        with self.assertRaises(ValueError):
+            self.pollard.ingest_batch_proof([self.live[1]], proof)
+        with self.assertRaises(ValueError):
+            self.pollard.ingest_batch_proof([self.live[0]], BatchProof(targets=[0], proof=[]))
+
+    def test_delete_not_held(self):
+        self.apply_block(4, [])
+        with self.assertRaises(ValueError):
+            self.pollard.modify([], [0])
+
+    def test_write_and_restore(self):
+        rng = random.Random(2)
+        for _ in range(10):
+            dels = rng.sample(self.live, min(len(self.live), 5))
+            self.apply_block(12, dels, remember={0, 5})
+        self.pollard.lookahead = 100
+
+        buf = io.BytesIO()
+        self.pollard.write_pollard(buf)
+        buf.seek(0)
+        restored = Pollard()
+        restored.lookahead = 100
+        restored.restore_pollard(buf)
+
+        self.assertEqual(restored.get_roots(), self.pollard.get_roots())
+        self.assertEqual(restored.node_count(), self.pollard.node_count())
+        self.assertEqual(restored.lookahead, 100)
+
+        # the restored pollard keeps working
+        self.pollard = restored
+        self.apply_block(3, rng.sample(self.live, 4))
+        self.assertEqual(self.pollard.get_roots(), self.forest.get_roots())
+
+    def test_restore_truncated(self):
+        self.apply_block(5, [])
+        buf = io.BytesIO()
+        self.pollard.write_pollard(buf)
+        with self.assertRaises(ValueError):
+            Pollard().restore_pollard(io.BytesIO(buf.getvalue()[:-1]))
+
+    def test_fill_proof_from_cache(self):
+        self.apply_block(8, [], remember={2})
+        leaf = self.live[2]
+        proof = self.forest.prove_batch([leaf])
+        full = list(proof.proof)
+        proof.proof = [None] * len(full)
+
+        self.pollard.fill_proof(proof)
+        self.assertEqual(proof.proof, full)
+
+    def test_fill_proof_not_cached(self):
+        self.apply_block(8, [])
+        proof = self.forest.prove_batch([self.live[2]])
+        proof.proof[0] = None
+        with self.assertRaises(ValueError):
+            self.pollard.ingest_batch_proof([self.live[2]], proof)
+
+    def test_from_roots_and_forget_all(self):
+        self.apply_block(7, [], remember={0, 4})
+        self.apply_block(0, [self.live[1]])
+        self.pollard.lookahead = 9
+
+        fresh = Pollard.from_roots(self.pollard.num_leaves, self.pollard.get_roots())
+        self.pollard.forget_all()
+        for pollard in (fresh, self.pollard):
+            self.assertEqual(pollard.get_roots(), self.forest.get_roots())
+            self.assertEqual(pollard.node_count(), 3)
+        self.assertEqual(self.pollard.lookahead, 9)
+
+        with self.assertRaises(ValueError):
+            Pollard.from_roots(7, [])
+
+    def test_evicts_latest_expiry_first(self):
+        self.pollard.max_nodes = 9
+        # leaves 0..7 spent 1..8 blocks from now; 7 has no known spend
+        self.apply_block(8, [], remember=set(range(8)), ttls=[1, 2, 3, 4, 5, 6, 7, 0])
+        self.assertLessEqual(self.pollard.node_count(), 9)
+        self.assertEqual(self.pollard.get_roots(), self.forest.get_roots())
+        self.assertEqual(self.pollard.read_position(0), self.live[0])
+        self.assertEqual(self.pollard.read_position(1), self.live[1])
+        for pos in (6, 7):
+            self.assertIsNone(self.pollard.read_position(pos))
+
+    def test_budget_holds_across_blocks(self):
+        self.pollard.max_nodes = 40
+        rng = random.Random(3)
+        for _ in range(30):
+            num_adds = rng.randint(1, 20)
+            ttls = [rng.randint(1, 30) for _ in range(num_adds)]
+            dels = rng.sample(self.live, min(len(self.live), rng.randint(0, 10)))
+            self.apply_block(num_adds, dels, set(range(num_adds)), ttls)
+            self.assertLessEqual(self.pollard.node_count(), 40)
+            self.assertEqual(self.pollard.get_roots(), self.forest.get_roots())
+        self.assertIn("/40", self.pollard.stats())
+
+        self.pollard.forget_all()
+        self.assertEqual(self.pollard.max_nodes, 40)
+
+    def test_nodes_for_bytes(self):
+        self.assertEqual(Pollard.nodes_for_bytes(0), 1)
+        self.assertGreater(Pollard.nodes_for_bytes(64 << 20), 500000)
+
+    def test_stats(self):
+        self.apply_block(3, [])
+        stats = self.pollard.stats()
+        self.assertIn("nl 3", stats)
+        self.assertIn("nodes", stats)
+        self.assertGreater(self.pollard.nbytes(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+from accumulator import PositionIndex, RamForestData
+
+
+def make_hash(i):
+    return hashlib.sha256(i.to_bytes(8, "big")).digest()
+
+
+class TestPositionIndex(unittest.TestCase):
+    def setUp(self):
+        self.data = RamForestData(4096)
+        self.index = PositionIndex(self.data)
+        self.hashes = [make_hash(i) for i in range(1500)]
+        for pos, h in enumerate(self.hashes):
+            self.data.write(pos, h)
+
+    def test_insert_and_get_grows(self):
+        self.index.insert_many((h, pos) for pos, h in enumerate(self.hashes))
+        self.assertEqual(len(self.index), 1500)
+        self.assertGreaterEqual(self.index.capacity(), 3000)
+        self.assertEqual(self.index.get_many(self.hashes[:3]), [0, 1, 2])
+        self.assertIsNone(self.index.get(make_hash(5000)))
+
+    def test_prefix_collision_confirmed_by_storage(self):
+        # same 8-byte prefix, different hash
+        other = self.hashes[0][:8] + bytes(24)
+        self.data.write(2000, other)
+        self.index.insert(self.hashes[0], 0)
+        self.index.insert(other, 2000)
+
+        self.assertEqual(self.index.get(self.hashes[0]), 0)
+        self.assertEqual(self.index.get(other), 2000)
+        self.assertEqual(self.index.pop(other), 2000)
+        self.assertEqual(self.index.get(self.hashes[0]), 0)
+
+    def test_pop_and_reinsert(self):
+        self.index.insert_many((h, pos) for pos, h in enumerate(self.hashes[:10]))
+        self.assertEqual(self.index.pop_many(self.hashes[:5]), [0, 1, 2, 3, 4])
+        self.assertNotIn(self.hashes[0], self.index)
+        with self.assertRaises(KeyError):
+            self.index.pop(self.hashes[0])
+
+        self.index.insert(self.hashes[0], 0)
+        self.assertEqual(len(self.index), 6)
+
+    def test_move_after_overwrite(self):
+        self.index.insert(self.hashes[1], 1)
+        self.data.write(8, self.hashes[1])
+        self.data.write(1, bytes(32))
+        self.index.move(self.hashes[1], 1, 8)
+        self.assertEqual(self.index.get(self.hashes[1]), 8)
+
+    def test_remap(self):
+        # 3 rows to 4: row 0 stays, position 9 (row 1) becomes 17
+        self.index.insert(self.hashes[3], 3)
+        self.index.insert(self.hashes[9], 9)
+        self.data.write(17, self.hashes[9])
+        self.index.remap(3, 4)
+        self.assertEqual(self.index.get(self.hashes[3]), 3)
+        self.assertEqual(self.index.get(self.hashes[9]), 17)
+
+    def test_save_and_load(self):
+        self.index.insert_many((h, pos) for pos, h in enumerate(self.hashes))
+        self.index.pop(self.hashes[7])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "forest.idx")
+            self.index.save(path)
+            loaded = PositionIndex.load(path, self.data)
+
+        self.assertEqual(len(loaded), 1499)
+        self.assertEqual(dict(loaded.items()), dict(self.index.items()))
+        self.assertIsNone(loaded.get(self.hashes[7]))
+
+    def test_load_bad_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "forest.idx")
+            with open(path, "wb") as f:
+                f.write(b"nope" + bytes(16))
+            with self.assertRaises(ValueError):
+                PositionIndex.load(path, self.data)
+
+
+if __name__ == "__main__":
+    unittest.main()
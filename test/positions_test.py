@@ -0,0 +1,71 @@
+import unittest
+
+from accumulator.positions import (
+    detect_row, is_root_position, left_child, num_positions, parent,
+    proof_positions, remap_position, root_position, root_positions,
+    row_offset, targets_by_row, tree_rows,
+)
+
+
+class TestPositions(unittest.TestCase):
+    def test_tree_rows(self):
+        for n, rows in [(0, 0), (1, 0), (2, 1), (3, 2), (4, 2), (5, 3), (8, 3), (9, 4)]:
+            self.assertEqual(tree_rows(n), rows)
+
+    def test_row_layout(self):
+        # 3 rows: row 0 is 0-7, row 1 8-11, row 2 12-13, row 3 14
+        self.assertEqual(num_positions(3), 15)
+        self.assertEqual([row_offset(r, 3) for r in range(4)], [0, 8, 12, 14])
+        self.assertEqual([detect_row(p, 3) for p in (0, 7, 8, 11, 12, 13, 14)],
+                         [0, 0, 1, 1, 2, 2, 3])
+
+    def test_parent_and_child(self):
+        self.assertEqual(parent(0, 3), 8)
+        self.assertEqual(parent(7, 3), 11)
+        self.assertEqual(parent(9, 3), 12)
+        self.assertEqual(parent(13, 3), 14)
+        for pos in range(14):
+            up = parent(pos, 3)
+            self.assertIn(pos, (left_child(up, 3), left_child(up, 3) + 1))
+
+    def test_root_positions(self):
+        # 7 leaves: roots at rows 2, 1 and 0
+        self.assertEqual(root_positions(7, 3), [12, 10, 6])
+        self.assertEqual(root_position(8, 3, 3), 14)
+        self.assertTrue(is_root_position(10, 7, 3))
+        self.assertFalse(is_root_position(8, 7, 3))
+
+    def test_remap_position(self):
+        self.assertEqual(remap_position(5, 3, 4), 5)
+        self.assertEqual(remap_position(9, 3, 4), 17)
+        self.assertEqual(remap_position(14, 3, 4), 28)
+
+    def test_proof_positions(self):
+        # 8 leaves; proving 0 needs 1, 9 and 13
+        self.assertEqual(proof_positions([0], 8, 3), [1, 9, 13])
+        # 0 and 1 share their parent, so only 9 and 13 are needed
+        self.assertEqual(proof_positions([1, 0], 8, 3), [9, 13])
+        # 0 and 2 compute 8 and 9 between them
+        self.assertEqual(proof_positions([0, 2], 8, 3), [1, 3, 13])
+        # a root needs nothing
+        self.assertEqual(proof_positions([6], 7, 3), [])
+
+    def test_proof_positions_shared_ancestors(self):
+        # every leaf of an 8 leaf tree needs nothing from outside it
+        self.assertEqual(proof_positions(range(8), 8, 3), [])
+        # a leaf that moved up to row 1 next to a row 0 target's parent
+        self.assertEqual(proof_positions([0, 9], 8, 3), [1, 13])
+
+    def test_targets_by_row(self):
+        self.assertEqual(targets_by_row([12, 3, 9, 3, 0], 8, 3),
+                         [[0, 3], [9], [12], []])
+        with self.assertRaises(ValueError):
+            targets_by_row([11], 6, 3)
+
+    def test_proof_positions_invalid(self):
+        with self.assertRaises(ValueError):
+            proof_positions([7], 7, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from accumulator import Forest, Leaf
+from bridge.archive import UBlockArchive
+from bridge.reproof import ForestCheckpoints, reproof_archive, reproof_ranges
+from server_test import StandInBlock, StandInMsgBlock, build_chain
+from util import dedupe_block
+from wire.umsgblock import UBlock
+
+
+class TestForestCheckpoints(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.checkpoints = ForestCheckpoints(os.path.join(self.dir.name, "checkpoints"), 4)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_saved_every_interval(self):
+        forest = Forest()
+        roots = {}
+        for height in range(10):
+            h = hashlib.sha256(height.to_bytes(4, "big")).digest()
+            forest.modify([Leaf(hash=h)], [])
+            self.checkpoints.after_block(forest, height)
+            roots[height + 1] = forest.get_roots()
+
+        self.assertEqual(self.checkpoints.heights(), [4, 8])
+        for height in (4, 8):
+            loaded = Forest.open(self.checkpoints.path(height))
+            self.assertEqual((loaded.num_leaves, loaded.get_roots()), (height, roots[height]))
+            loaded.close()
+            self.assertEqual(self.checkpoints.roots(height), roots[height])
+
+    def test_incomplete_checkpoint_ignored(self):
+        with open(self.checkpoints.path(4), "wb") as f:
+            f.write(bytes(32))
+        self.assertEqual(self.checkpoints.heights(), [])
+
+    def test_ranges(self):
+        self.assertEqual(reproof_ranges([4, 8, 12], 10), [(0, 4), (4, 8), (8, 10)])
+        self.assertEqual(reproof_ranges([], 5), [(0, 5)])
+        self.assertEqual(reproof_ranges([5], 5), [(0, 5)])
+        self.assertEqual(reproof_ranges([], 0), [])
+
+    def test_bad_interval(self):
+        with self.assertRaises(ValueError):
+            ForestCheckpoints(self.dir.name, 0)
+
+
+class TestReproofArchive(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "archive")
+        self.checkpoints = ForestCheckpoints(os.path.join(self.dir.name, "checkpoints"), 4)
+        # Forked workers see the stand-in blocks too
+        for target, new in (("MsgBlock", StandInMsgBlock), ("Block", StandInBlock)):
+            patcher = patch(f"wire.umsgblock.{target}", new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.ublocks, _ = build_chain(14)
+        archive = UBlockArchive(self.path)
+        forest = Forest()
+        for height, ub in enumerate(self.ublocks):
+            archive.append_ublock(ub)
+            _, out_count, _, out_skip = dedupe_block(ub.block)
+            adds = UBlock.block_to_add_leaves(ub.block, [], out_skip, height, out_count)
+            forest.modify(adds, ub.utreexo_data.acc_proof.targets)
+            self.checkpoints.after_block(forest, height)
+            if height == 6:
+                forest.save(os.path.join(self.dir.name, "early"))
+        archive.close()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def reproof(self, ttls_indexed=14):
+        out_path = os.path.join(self.dir.name, "reproofed")
+        return reproof_archive(self.path, self.checkpoints, out_path, ttls_indexed, workers=2), out_path
+
+    def test_same_udata(self):
+        count, out_path = self.reproof()
+        self.assertEqual(count, 14)
+        out = UBlockArchive(out_path)
+        for height, ub in enumerate(self.ublocks):
+            self.assertEqual(out.ublock(height).serialize_frame(), ub.serialize_frame())
+        out.close()
+
+    def test_placeholder_ttls(self):
+        with self.assertRaisesRegex(ValueError, "placeholders"):
+            self.reproof(ttls_indexed=10)
+        self.assertFalse(os.path.exists(os.path.join(self.dir.name, "reproofed.dat")))
+
+    def test_stale_checkpoint(self):
+        # The checkpoint for 8 as if saved a block early
+        for suffix in ("", ".idx", ".meta"):
+            shutil.copyfile(os.path.join(self.dir.name, "early") + suffix,
+                            self.checkpoints.path(8) + suffix)
+        with self.assertRaisesRegex(ValueError, "doesn't match"):
+            self.reproof()
+        self.assertFalse(os.path.exists(os.path.join(self.dir.name, "reproofed.dat")))
+
+
+if __name__ == "__main__":
+    unittest.main()
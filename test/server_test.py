@@ -0,0 +1,301 @@
+import asyncio
+import os
+import pickle
+import random
+import struct
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from btcd.wire import OutPoint, TxOut
+
+from accumulator import Forest, Pollard
+from bridge.server import BlockStore, BridgeServer
+from btcacc import FLAG_NO_BLOCK_HASH, FLAG_PARTIAL_PROOF, BlockHashIndex, UData
+from csn.idb import Config, Csn
+from util import block_to_del_ops, dedupe_block
+from wire.umsgblock import UBlock, ublock_stream_reader
+
+
+def decode_height(data):
+    return int.from_bytes(data, "big")
+
+
+class FrameFileStore(BlockStore):
+    """Heights 0 to n-1 as 4-byte frames in one file"""
+
+    def __init__(self, path, n):
+        self.path = path
+        self.n = n
+        with open(path, "wb") as f:
+            for height in range(n):
+                f.write(struct.pack(">II", 4, height))
+
+    def num_heights(self):
+        return self.n
+
+    def span(self, start, end):
+        return self.path, 8 * start, 8 * (end - start + 1)
+
+
+class TestBridgeServer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = FrameFileStore(os.path.join(self.dir.name, "frames"), 50)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def serve(self, client):
+        """Run client(host) against a server over the store"""
+        async def run():
+            server = BridgeServer(self.store, "127.0.0.1:0")
+            await server.start()
+            try:
+                return await asyncio.wait_for(client(f"127.0.0.1:{server.port}"), 20)
+            finally:
+                await server.stop()
+
+        return asyncio.run(run())
+
+    async def read_all(self, host, start, **kwargs):
+        queue = asyncio.Queue()
+        end = await ublock_stream_reader(queue, host, start, decode=decode_height, **kwargs)
+        return end, [queue.get_nowait() for _ in range(queue.qsize())]
+
+    def test_serves_ranges_to_tip(self):
+        end, got = self.serve(lambda host: self.read_all(host, 10, range_size=7))
+        self.assertEqual((end, got), (50, list(range(10, 50))))
+
+    def test_past_tip(self):
+        end, got = self.serve(lambda host: self.read_all(host, 60))
+        self.assertEqual((end, got), (60, []))
+
+    def test_many_clients(self):
+        async def clients(host):
+            return await asyncio.gather(*[
+                self.read_all(host, i % 50, range_size=16) for i in range(200)
+            ])
+
+        for i, (end, got) in enumerate(self.serve(clients)):
+            self.assertEqual((end, got), (50, list(range(i % 50, 50))))
+
+    def test_bad_request_closes(self):
+        async def client(host):
+            addr, port = host.rsplit(":", 1)
+            reader, writer = await asyncio.open_connection(addr, int(port))
+            writer.write(struct.pack(">ii", 9, 3))
+            data = await reader.read()
+            writer.close()
+            return data
+
+        self.assertEqual(self.serve(client), b"")
+
+    def test_stop_closes_idle_connections(self):
+        async def run():
+            server = BridgeServer(self.store, "127.0.0.1:0")
+            await server.start()
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            await asyncio.sleep(0.05)
+            await asyncio.wait_for(server.stop(), 1)
+            data = await reader.read()
+            writer.close()
+            return data
+
+        self.assertEqual(asyncio.run(run()), b"")
+
+    def test_empty_store(self):
+        self.store = BlockStore()
+        end, got = self.serve(lambda host: self.read_all(host, 0))
+        self.assertEqual((end, got), (0, []))
+
+
+class StandInMsgBlock:
+    """Just transactions as (txid, spent outpoints, output values), pickled"""
+
+    def __init__(self, txs=()):
+        self.txs = list(txs)
+
+    def serialize(self, w):
+        data = pickle.dumps(self.txs)
+        w.write(struct.pack(">I", len(data)) + data)
+
+    def serialize_size(self):
+        return 4 + len(pickle.dumps(self.txs))
+
+    def deserialize(self, r):
+        size = struct.unpack(">I", r.read(4))[0]
+        self.txs = pickle.loads(r.read(size))
+
+
+class StandInBlock:
+    def __init__(self, msg_block):
+        self.msg_block = msg_block
+        self.transactions = [
+            SimpleNamespace(hash=lambda txid=txid: txid, msg_tx=SimpleNamespace(
+                tx_in=[SimpleNamespace(previous_out_point=OutPoint(hash=h, index=i))
+                       for h, i in spends],
+                tx_out=[TxOut(value=v, pk_script=b"\x51") for v in values],
+            ))
+            for txid, spends, values in msg_block.txs
+        ]
+
+    def hash(self):
+        return struct.pack(">I", len(self.transactions)) * 8
+
+
+class UBlockStore(BlockStore):
+    """UBlocks kept in memory, and as frames in a file"""
+
+    def __init__(self, path, ublocks):
+        self.path = path
+        self.ublocks = ublocks
+        self.tip = len(ublocks)
+        self.offsets = [0]
+        with open(path, "wb") as f:
+            for ub in ublocks:
+                self.offsets.append(self.offsets[-1] + f.write(ub.serialize_frame()))
+
+    def num_heights(self):
+        return self.tip
+
+    def span(self, start, end):
+        return self.path, self.offsets[start], self.offsets[end + 1] - self.offsets[start]
+
+    def ublock(self, height):
+        return self.ublocks[height]
+
+
+def build_chain(num_blocks, seed=3):
+    """
+    UBlocks for a chain where each coinbase makes 4 outputs, spent a few
+    blocks later, with the bridge's Forest after the last block
+    """
+    rng = random.Random(seed)
+    forest = Forest()
+    unspent = {}  # (txid, index) -> (LeafData, spend height)
+    ublocks = []
+    for height in range(num_blocks):
+        spends = [op for op, (_, at) in unspent.items() if at == height]
+        txs = [(struct.pack(">II", height, 0) * 4, [(bytes(32), 0xffffffff)], [50] * 4)]
+        if spends:
+            txs.append((struct.pack(">II", height, 1) * 4, spends, [10]))
+        blk = StandInBlock(StandInMsgBlock(txs))
+
+        ttls = [rng.randint(1, 6) for _ in range(4)] + [0] * (len(txs) - 1)
+        _, out_count, _, out_skip = dedupe_block(blk)
+        leaf_datas, txonums = UBlock.block_leaf_datas(blk, out_skip, height)
+        del_leaves = [unspent.pop((op.hash, op.index))[0] for op in block_to_del_ops(blk)]
+
+        udata = UData.gen_udata(del_leaves, forest, height)
+        udata.txo_ttls = ttls
+        forest.modify(UBlock.leaves_for(leaf_datas, txonums), udata.acc_proof.targets)
+        for ld, ttl in zip(leaf_datas, ttls):
+            if ttl:
+                unspent[(ld.tx_hash, ld.index)] = (ld, height + ttl)
+        ublocks.append(UBlock(udata, blk))
+    return ublocks, forest
+
+
+class CountingCsn(Csn):
+    """A Csn noting how many proof hashes each UBlock left out"""
+
+    def __init__(self):
+        super().__init__()
+        self.left_out = []
+
+    def put_block_in_pollard(self, ub, *args):
+        self.left_out.append(sum(h is None for h in ub.utreexo_data.acc_proof.proof))
+        return super().put_block_in_pollard(ub, *args)
+
+
+class TestPartialProofs(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def serve(self, store, client):
+        """Run client(host) on this thread against a server on another"""
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        server = BridgeServer(store, "127.0.0.1:0")
+        try:
+            asyncio.run_coroutine_threadsafe(server.start(), loop).result(5)
+            return client(f"127.0.0.1:{server.port}")
+        finally:
+            asyncio.run_coroutine_threadsafe(server.stop(), loop).result(10)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+    def run_ibd(self, lookahead, num_blocks=40, sessions=(40,)):
+        """
+        Run a CSN's IBD against a bridge, in sessions of so many blocks,
+        each up to the bridge's tip at the time. Returns the CSN and the v2
+        flags of each UData it decoded.
+        """
+        ublocks, forest = build_chain(num_blocks)
+        store = UBlockStore(os.path.join(self.dir.name, "frames"), ublocks)
+        csn = CountingCsn()
+        csn.pollard = Pollard()
+        csn.pollard.lookahead = lookahead
+        flags = []
+        from_buffer = UData.from_buffer
+
+        def decode_udata(buf, block_hashes=None):
+            flags.append(buf[1] if buf[0] & 0x80 else 0)
+            return from_buffer(buf, block_hashes)
+
+        def client(host):
+            csn.remote_host = host
+            for blocks in sessions:
+                store.tip = csn.current_height + blocks
+                csn.ibd_thread(Config(quit_after=blocks), [])
+
+        with patch("wire.umsgblock.MsgBlock", StandInMsgBlock), \
+                patch("wire.umsgblock.Block", StandInBlock), \
+                patch.object(UData, "from_buffer", side_effect=decode_udata):
+            self.serve(store, client)
+
+        self.assertEqual(len(csn.left_out), num_blocks)
+        self.assertEqual(csn.pollard.get_roots(), forest.get_roots())
+        return csn, flags
+
+    def test_csn_ingests_partial_proofs(self):
+        csn, flags = self.run_ibd(lookahead=4)
+        self.assertGreater(sum(csn.left_out), 0)
+        # Sent without block hashes, which the CSN looked up by height
+        self.assertTrue(all(f & FLAG_NO_BLOCK_HASH and f & FLAG_PARTIAL_PROOF for f in flags))
+
+    def test_no_policy_without_lookahead(self):
+        csn, flags = self.run_ibd(lookahead=0)
+        self.assertEqual(sum(csn.left_out), 0)
+        self.assertEqual(set(flags), {0})
+
+    def test_resumed_sessions(self):
+        csn, flags = self.run_ibd(lookahead=4, sessions=(25, 15))
+        self.assertEqual(len(csn.block_hashes), 40)
+        self.assertTrue(all(f & FLAG_NO_BLOCK_HASH for f in flags))
+
+    def test_resumed_without_block_hashes(self):
+        class ResumingCsn(CountingCsn):
+            def ibd_thread(self, cfg, sig_chan):
+                if self.current_height:
+                    # As restored at this height with no saved index
+                    self.block_hashes = BlockHashIndex(self.current_height)
+                super().ibd_thread(cfg, sig_chan)
+
+        with patch(f"{__name__}.CountingCsn", ResumingCsn):
+            csn, flags = self.run_ibd(lookahead=4, sessions=(25, 15))
+        # Partial proofs still, but with block hashes after the restart
+        self.assertTrue(all(f & FLAG_PARTIAL_PROOF for f in flags))
+        self.assertEqual([bool(f & FLAG_NO_BLOCK_HASH) for f in flags], [True] * 25 + [False] * 15)
+
+
+if __name__ == "__main__":
+    unittest.main()
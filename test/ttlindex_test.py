@@ -0,0 +1,152 @@
+import os
+import struct
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from bridge.archive import UBlockArchive
+from bridge.ttlindex import TTLIndexer
+
+COINBASE = SimpleNamespace(hash=bytes(32), index=0xffffffff)
+
+
+def txid(height, n):
+    return struct.pack(">II", height, n) * 4
+
+
+def make_tx(height, n, spends=(), outs=1):
+    """A stand-in transaction; spends are (height, n, index) outpoints"""
+    tx_in = [SimpleNamespace(previous_out_point=SimpleNamespace(hash=txid(h, t), index=i))
+             for h, t, i in spends] or [SimpleNamespace(previous_out_point=COINBASE)]
+    tx_out = [SimpleNamespace(value=1, pk_script=b"", unspendable=False)] * outs
+    return SimpleNamespace(hash=lambda: txid(height, n),
+                           msg_tx=SimpleNamespace(tx_in=tx_in, tx_out=tx_out))
+
+
+def make_block(height, spends=()):
+    """A coinbase with 2 outputs, then a transaction per spend"""
+    return SimpleNamespace(transactions=[make_tx(height, 0, outs=2)] + [
+        make_tx(height, n + 1, [spend]) for n, spend in enumerate(spends)
+    ])
+
+
+def udata_payload(height, num_outputs):
+    """A v1 record: a stand-in block, then UData with zero TTLs"""
+    return b"blk" + struct.pack(">iI", height, num_outputs) + bytes(4 * num_outputs) + b"proof"
+
+
+class TestTTLIndexer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.archive = UBlockArchive(os.path.join(self.dir.name, "ublocks"))
+        self.db_path = os.path.join(self.dir.name, "ttl.db")
+        self.indexer = TTLIndexer(self.db_path, self.archive, batch_blocks=3)
+
+    def tearDown(self):
+        self.indexer.db.close()
+        self.archive.close()
+        self.dir.cleanup()
+
+    def index(self, spends_at):
+        """Archive and index blocks; spends_at maps height to its spends"""
+        start = self.indexer.height
+        for height, spends in enumerate(spends_at, start):
+            blk = make_block(height, spends)
+            num_outputs = 2 + len(blk.transactions) - 1
+            self.archive.append(udata_payload(height, num_outputs), 3)
+            self.indexer.index_block(height, blk)
+
+    def ttls(self, height):
+        record = bytes(self.archive.udata_record(height))
+        count = struct.unpack_from(">I", record, 4)[0]
+        return list(struct.unpack_from(f">{count}i", record, 8))
+
+    def test_ttls_across_batches(self):
+        self.index([
+            [],
+            [(0, 0, 1)],             # in the same batch
+            [],
+            [(1, 1, 0), (0, 0, 0)],  # from the last batch
+            [(3, 2, 0)],
+        ])
+        self.indexer.close()
+        self.assertEqual(self.ttls(0), [3, 1])
+        self.assertEqual(self.ttls(1), [0, 0, 2])
+        self.assertEqual(self.ttls(3), [0, 0, 0, 1])
+        self.assertEqual(self.ttls(4), [0, 0, 0])
+
+    def test_resumes_from_commit(self):
+        self.index([[], [], []])
+        self.index([[(1, 0, 1)]])  # not committed
+        self.indexer.db.close()
+
+        self.indexer = TTLIndexer(self.db_path, self.archive, batch_blocks=3)
+        self.assertEqual(self.indexer.height, 3)
+        self.archive.truncate(3)
+        self.index([[(1, 0, 1)], [(0, 0, 0)]])
+        self.indexer.commit()
+        self.assertEqual(self.ttls(0), [4, 0])
+        self.assertEqual(self.ttls(1), [0, 2])
+
+    def test_in_block_spends(self):
+        self.index([
+            [],
+            [(0, 0, 0), (1, 1, 0), (1, 0, 1)],  # tx 2 spends tx 1, tx 3 the coinbase
+            [(1, 0, 0)],
+        ])
+        self.indexer.close()
+        self.assertEqual(self.ttls(0), [1, 0])
+        # Outputs spent in their own block are skipped, so keep TTL 0
+        self.assertEqual(self.ttls(1), [1, 0, 0, 0, 0])
+
+    def test_rollback_across_spends(self):
+        self.index([
+            [],
+            [],
+            [(0, 0, 1)],  # written when indexed
+            [(1, 0, 0)],  # written at the next commit
+            [(3, 0, 0)],
+            [],
+            [(0, 0, 0)],  # still pending
+        ])
+        self.assertEqual(self.ttls(0), [0, 2])
+        self.assertEqual(self.ttls(1), [2, 0])
+        self.assertEqual(self.ttls(3), [1, 0, 0])
+
+        self.indexer.rollback(2)
+        self.assertEqual(self.indexer.height, 2)
+        self.assertEqual(self.ttls(0), [0, 0])
+        self.assertEqual(self.ttls(1), [0, 0])
+
+        # the outputs spent by the reorged blocks can be spent again
+        self.archive.truncate(2)
+        self.index([[(1, 0, 0)], [(0, 0, 1)]])
+        self.indexer.close()
+        self.assertEqual(self.ttls(0), [0, 3])
+        self.assertEqual(self.ttls(1), [1, 0])
+        self.assertEqual(self.ttls(2), [0, 0, 0])
+
+        self.indexer = TTLIndexer(self.db_path, self.archive, batch_blocks=3)
+        self.assertEqual(self.indexer.height, 4)
+
+    def test_rollback_too_far(self):
+        self.indexer.spend_history = 2
+        self.index([[], [], [], []])
+        with self.assertRaises(ValueError):
+            self.indexer.rollback(1)
+        self.indexer.rollback(2)
+        self.assertEqual(self.indexer.height, 2)
+
+    def test_unknown_spend(self):
+        self.index([[]])
+        self.index([[(7, 0, 0)]])
+        with self.assertRaises(ValueError):
+            self.indexer.commit()
+
+    def test_wrong_height(self):
+        with self.assertRaises(ValueError):
+            self.indexer.index_block(1, make_block(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,19 +1,31 @@
 import unittest
 import io
-from unittest.mock import MagicMock
-from your_module.udata import UData
-from accumulator import BatchProof, LeafData
+import struct
+from unittest.mock import MagicMock, patch
+from your_module import BlockHashIndex
+from your_module.udata import (
+    UData, UDATA_V2, FLAG_NO_BLOCK_HASH, FLAG_PARTIAL_PROOF, FLAG_TXID_TABLE,
+)
+from your_module.btcacc import LeafData
+from accumulator import BatchProof
 
 class TestUData(unittest.TestCase):
     def setUp(self):
         self.mock_batch_proof = MagicMock(spec=BatchProof)
         self.mock_batch_proof.targets = [0, 1]
+        self.mock_batch_proof.proof = []
         self.mock_batch_proof.serialize = MagicMock()
         self.mock_batch_proof.deserialize = MagicMock()
         self.mock_batch_proof.serialize_size = MagicMock(return_value=10)
+        self.mock_batch_proof.serialize_into = MagicMock(
+            side_effect=lambda buf, offset: offset + 10
+        )
 
         self.mock_leaf_data = MagicMock(spec=LeafData)
         self.mock_leaf_data.serialize = MagicMock()
+        self.mock_leaf_data.serialize_into = MagicMock(
+            side_effect=lambda buf, offset: offset + 20
+        )
         self.mock_leaf_data.deserialize = MagicMock()
         self.mock_leaf_data.serialize_size = MagicMock(return_value=20)
         self.mock_leaf_data.leaf_hash = MagicMock(return_value=b"hash")
@@ -35,7 +47,7 @@ class TestUData(unittest.TestCase):
         serialized_data = buf.getvalue()
 
         self.mock_batch_proof.serialize.assert_called_once()
-        self.assertEqual(self.mock_leaf_data.serialize.call_count, 2)
+        self.assertEqual(self.mock_leaf_data.serialize_into.call_count, 2)
 
         buf.seek(0)
         new_udata = UData()
@@ -48,6 +60,11 @@ class TestUData(unittest.TestCase):
         self.assertEqual(len(new_udata.stxos), 2)
         self.assertEqual(self.mock_leaf_data.deserialize.call_count, 2)
 
+    def test_remember_flags(self):
+        udata = UData(txo_ttls=[0, 1, 5, 6, 1000])
+        self.assertEqual(udata.remember_flags(5), [False, True, True, False, False])
+        self.assertEqual(udata.remember_flags(0), [False] * 5)
+
     def test_serialize_size(self):
         size = self.udata.serialize_size()
         expected_size = 8 + (4 * len(self.udata.txo_ttls)) + 10 + (2 * 20)
@@ -66,7 +83,8 @@ class TestUData(unittest.TestCase):
         del_leaves = [self.mock_leaf_data, self.mock_leaf_data]
         height = 100
 
-        result = UData.gen_udata(del_leaves, mock_forest, height)
+        with patch("your_module.udata.leaf_hashes", return_value=[b"hash", b"hash"]):
+            result = UData.gen_udata(del_leaves, mock_forest, height)
 
         self.assertEqual(result.height, height)
         self.assertEqual(result.stxos, del_leaves)
@@ -78,8 +96,9 @@ class TestUData(unittest.TestCase):
         mock_forest.prove_batch = MagicMock(return_value=self.mock_batch_proof)
 
         del_leaves = [self.mock_leaf_data]
-        with self.assertRaises(ValueError):
-            UData.gen_udata(del_leaves, mock_forest, 100)
+        with patch("your_module.udata.leaf_hashes", return_value=[b"hash"]):
+            with self.assertRaises(ValueError):
+                UData.gen_udata(del_leaves, mock_forest, 100)
 
     def test_to_compact_bytes(self):
         compact_bytes = self.udata.to_compact_bytes()
@@ -133,6 +152,199 @@ class TestUData(unittest.TestCase):
         new_udata.deserialize(buf)
         self.assertEqual(new_udata.txo_ttls, self.udata.txo_ttls)
 
+    def test_from_buffer(self):
+        stxos = [
+            LeafData(height=10, amt=1, pk_script=b"\x51"),
+            LeafData(height=11, amt=2, index=3),
+        ]
+        proof = BatchProof()
+        proof.targets = [4, 9]
+        udata = UData(height=42, acc_proof=proof, stxos=stxos, txo_ttls=[5, -1, 300])
+        buf = io.BytesIO()
+        udata.serialize(buf)
+
+        new_udata = UData.from_buffer(memoryview(buf.getvalue()))
+
+        self.assertEqual(new_udata.height, 42)
+        self.assertEqual(list(new_udata.txo_ttls), [5, -1, 300])
+        self.assertEqual(new_udata.acc_proof.targets, [4, 9])
+        self.assertEqual(len(new_udata.stxos), 2)
+        self.assertEqual(new_udata.stxos[1].index, 3)
+        self.assertEqual(new_udata.stxos[0].pk_script, b"\x51")
+        self.assertEqual(new_udata.serialize_size(), len(buf.getvalue()))
+
+    def test_from_buffer_invalid_data(self):
+        with self.assertRaises(ValueError):
+            UData.from_buffer(b"\x00\x00\x00\x2A\x00\x00\x00\x02\x00\x00")
+
+    def test_serialize_into(self):
+        stxos = [LeafData(height=10, amt=1, pk_script=b"\x51")]
+        proof = BatchProof()
+        proof.targets = [4]
+        udata = UData(height=42, acc_proof=proof, stxos=stxos, txo_ttls=[5, 6])
+        expected = io.BytesIO()
+        udata.serialize(expected)
+
+        buf = bytearray(3 + udata.serialize_size())
+        end = udata.serialize_into(buf, 3)
+
+        self.assertEqual(end, len(buf))
+        self.assertEqual(bytes(buf[3:]), expected.getvalue())
+
+    def test_serialize_size_matches_serialize(self):
+        proof = BatchProof()
+        proof.targets = [1, 2]
+        udata = UData(
+            height=1, acc_proof=proof,
+            stxos=[LeafData(pk_script=b"\x00" * 22), LeafData()],
+            txo_ttls=[0, 1, 2],
+        )
+        buf = io.BytesIO()
+        udata.serialize(buf)
+        self.assertEqual(udata.serialize_size(), len(buf.getvalue()))
+
+    def test_serialize_into_too_small(self):
+        with self.assertRaises(Exception):
+            self.udata.serialize_into(bytearray(4), 0)
+
+    def make_real_udata(self):
+        stxos = [
+            LeafData(height=10, amt=100000000, pk_script=b"\x00\x14" + b"\x01" * 20),
+            LeafData(height=11, coinbase=True, amt=2, index=3, pk_script=b"\x51"),
+        ]
+        proof = BatchProof()
+        proof.targets = [4, 9]
+        proof.proof = [b"\x02" * 32]
+        return UData(height=42, acc_proof=proof, stxos=stxos, txo_ttls=[5, 0, 300])
+
+    def assert_same_udata(self, new_udata, udata):
+        self.assertEqual(new_udata.height, udata.height)
+        self.assertEqual(list(new_udata.txo_ttls), list(udata.txo_ttls))
+        self.assertEqual(new_udata.acc_proof.targets, udata.acc_proof.targets)
+        self.assertEqual(new_udata.acc_proof.proof, udata.acc_proof.proof)
+        self.assertEqual(list(new_udata.stxos), list(udata.stxos))
+
+    def test_serialize_v2_round_trip(self):
+        udata = self.make_real_udata()
+        v1 = io.BytesIO()
+        udata.serialize(v1)
+        v2 = io.BytesIO()
+        udata.serialize(v2, version=UDATA_V2)
+        self.assertLess(len(v2.getvalue()), len(v1.getvalue()))
+
+        self.assert_same_udata(UData.from_buffer(v2.getvalue()), udata)
+        self.assert_same_udata(UData.from_compact_bytes(v2.getvalue()), udata)
+
+    def test_deserialize_detects_version(self):
+        udata = self.make_real_udata()
+        for version in (1, UDATA_V2):
+            buf = io.BytesIO()
+            udata.serialize(buf, version=version)
+            buf.write(b"next")
+            buf.seek(0)
+
+            new_udata = UData()
+            new_udata.deserialize(buf)
+            self.assert_same_udata(new_udata, udata)
+            self.assertEqual(buf.read(), b"next")
+
+    def test_compact_bytes_keeps_format(self):
+        udata = self.make_real_udata()
+        compact = udata.to_compact_bytes()
+        self.assertEqual(compact[:8], struct.pack(">iI", 42, 2))
+
+        new_udata = UData.from_compact_bytes(compact)
+        self.assertEqual(new_udata.height, udata.height)
+        self.assertEqual(new_udata.acc_proof.targets, udata.acc_proof.targets)
+        self.assertEqual(list(new_udata.stxos), udata.stxos)
+
+    def test_v2_unknown_flags(self):
+        data = bytearray(self.make_real_udata().to_compact_v2_bytes())
+        data[1] = 0x40
+        with self.assertRaises(ValueError):
+            UData.from_buffer(bytes(data))
+
+    def test_v2_truncated(self):
+        data = self.make_real_udata().to_compact_v2_bytes()
+        with self.assertRaises(ValueError):
+            UData.from_compact_bytes(data[:-1])
+
+    def test_v2_negative_ttl(self):
+        udata = self.make_real_udata()
+        udata.txo_ttls = [-1, 0, 2**31 - 1, -2**31]
+        self.assert_same_udata(UData.from_buffer(udata.to_compact_v2_bytes()), udata)
+
+    def make_block_hash_index(self):
+        index = BlockHashIndex()
+        for height in range(12):
+            index.append(bytes([height]) * 32)
+        return index
+
+    def make_shared_txid_udata(self, index):
+        udata = self.make_real_udata()
+        for ld in udata.stxos:
+            ld.block_hash = index[ld.height]
+            ld.tx_hash = b"\x09" * 32
+        return udata
+
+    def test_v2_no_block_hash(self):
+        index = self.make_block_hash_index()
+        udata = self.make_shared_txid_udata(index)
+        full = udata.to_compact_v2_bytes()
+        compact = udata.to_compact_v2_bytes(FLAG_NO_BLOCK_HASH)
+
+        self.assertEqual(len(full) - len(compact), 2 * 32)
+        self.assert_same_udata(UData.from_buffer(compact, index), udata)
+
+    def test_v2_no_block_hash_requires_index(self):
+        udata = self.make_shared_txid_udata(self.make_block_hash_index())
+        compact = udata.to_compact_v2_bytes(FLAG_NO_BLOCK_HASH)
+        with self.assertRaises(ValueError):
+            UData.from_buffer(compact)
+        with self.assertRaises(ValueError):
+            UData.from_buffer(compact, BlockHashIndex())
+
+    def test_v2_txid_table(self):
+        index = self.make_block_hash_index()
+        udata = self.make_shared_txid_udata(index)
+        full = udata.to_compact_v2_bytes()
+        compact = udata.to_compact_v2_bytes(FLAG_TXID_TABLE)
+
+        self.assertLess(len(compact), len(full))
+        self.assert_same_udata(UData.from_compact_bytes(compact), udata)
+
+    def test_v2_all_flags_stream(self):
+        index = self.make_block_hash_index()
+        udata = self.make_shared_txid_udata(index)
+        buf = io.BytesIO()
+        udata.serialize(buf, version=UDATA_V2, flags=FLAG_NO_BLOCK_HASH | FLAG_TXID_TABLE)
+        buf.seek(0)
+
+        new_udata = UData()
+        new_udata.deserialize(buf, index)
+        self.assert_same_udata(new_udata, udata)
+
+    def test_v2_partial_proof(self):
+        udata = self.make_real_udata()
+        full = udata.to_compact_v2_bytes(FLAG_PARTIAL_PROOF)
+        udata.acc_proof.proof[0] = None
+        partial = udata.to_compact_v2_bytes(FLAG_PARTIAL_PROOF)
+
+        self.assertEqual(len(full) - len(partial), 32)
+        self.assert_same_udata(UData.from_compact_bytes(partial), udata)
+
+    def test_partial_proof_needs_flag(self):
+        udata = self.make_real_udata()
+        udata.acc_proof.proof[0] = None
+        with self.assertRaises(ValueError):
+            udata.to_compact_v2_bytes()
+        with self.assertRaises(ValueError):
+            udata.serialize(io.BytesIO())
+
+    def test_v1_rejects_flags(self):
+        with self.assertRaises(ValueError):
+            self.make_real_udata().serialize(io.BytesIO(), flags=FLAG_TXID_TABLE)
+
     def test_gen_udata_with_empty_forest(self):
         mock_forest = MagicMock()
         mock_forest.prove_batch = MagicMock(return_value=BatchProof())
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from bridge.utxostore import LeafDataStore
+from btcacc import LeafData
+
+
+def leaf(height, index):
+    return LeafData(tx_hash=bytes([height]) * 32, index=index, height=height,
+                    coinbase=index == 0, amt=1000 * height + index,
+                    pk_script=b"\x00\x14" + bytes([index % 256]) * 20)
+
+
+def op(ld):
+    return SimpleNamespace(hash=ld.tx_hash, index=ld.index)
+
+
+class TestLeafDataStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "utxos.db")
+        self.store = LeafDataStore(self.path, cache_size=100, flush_blocks=2)
+
+    def tearDown(self):
+        self.store.db.close()
+        self.dir.cleanup()
+
+    def test_spend_from_cache_and_disk(self):
+        old = [leaf(1, i) for i in range(3)]
+        self.store.add(old)
+        self.store.flush()
+        new = [leaf(2, i) for i in range(3)]
+        self.store.add(new)
+
+        spends = [new[1], old[2], old[0], new[0]]
+        self.assertEqual(self.store.spend([op(ld) for ld in spends]), spends)
+        self.assertEqual(len(self.store), 2)
+        self.store.flush()
+        self.assertEqual(self.store.spend([op(old[1]), op(new[2])]), [old[1], new[2]])
+        self.assertEqual(len(self.store), 0)
+
+    def test_spent_outputs_gone(self):
+        ld = leaf(1, 0)
+        self.store.add([ld])
+        self.store.flush()
+        self.store.spend([op(ld)])
+        with self.assertRaises(ValueError):
+            self.store.spend([op(ld)])
+        self.store.flush()
+        with self.assertRaises(ValueError):
+            self.store.spend([op(ld)])
+
+    def test_flushes(self):
+        self.store.add([leaf(1, 0)])
+        self.store.end_block()
+        self.assertEqual(len(self.store.added), 1)
+        self.store.end_block()
+        self.assertEqual(len(self.store.added), 0)
+
+        self.store.add([leaf(2, i) for i in range(100)])
+        self.store.end_block()
+        self.assertEqual(len(self.store.added), 0)
+        self.assertEqual(len(self.store), 101)
+
+    def test_persists(self):
+        lds = [leaf(3, i) for i in range(5)]
+        self.store.add(lds)
+        self.store.close()
+        self.store = LeafDataStore(self.path)
+        self.assertEqual(self.store.spend([op(ld) for ld in lds[::-1]]), lds[::-1])
+
+    def test_many_spends(self):
+        lds = [leaf(h, i) for h in range(1, 5) for i in range(300)]
+        self.store.add(lds)
+        self.store.flush()
+        self.assertEqual(self.store.spend([op(ld) for ld in lds]), lds)
+
+
+if __name__ == "__main__":
+    unittest.main()
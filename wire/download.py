@@ -0,0 +1,237 @@
+import asyncio
+import struct
+from collections import deque
+from dataclasses import dataclass, field
+from queue import Queue
+from typing import Callable, Deque, Dict, List, Optional, Sequence
+
+from wire.umsgblock import (
+    CachePolicy, UBlock, connect_bridge, read_ublock_frames, reader_thread,
+)
+
+DEFAULT_CHUNK_SIZE = 100
+# Seconds the stream may wait on a bridge that's sending nothing before its
+# chunk goes to another one
+STALL_TIMEOUT = 10.0
+# Seconds a bridge that failed or stalled sits out
+RETRY_DELAY = 1.0
+# Give up once every bridge has failed this many times in a row
+MAX_FAILURES = 5
+
+
+@dataclass
+class _Chunk:
+    """Heights start to end, fetched by one bridge at a time"""
+    start: int
+    end: int
+    next_height: int = 0  # next height to request
+    blocks: Deque[UBlock] = field(default_factory=deque)  # fetched, not yet delivered
+    host: Optional[str] = None
+    task: Optional[asyncio.Task] = None
+    last_progress: float = 0.0
+    short: bool = False  # the bridge had no blocks from next_height on
+
+    def __post_init__(self):
+        self.next_height = self.start
+
+    def done(self) -> bool:
+        return self.short or self.next_height > self.end
+
+
+class MultiBridgeReader:
+    """
+    MultiBridgeReader downloads UBlocks from several bridges at once. The
+    heights from cur_height on are split into chunks of chunk_size, which
+    the bridges fetch concurrently, and the blocks are put in the queue
+    strictly in height order. At most max_chunks chunks are being fetched
+    or waiting to be delivered, which bounds the blocks held.
+
+    A bridge that fails, or sends nothing for stall_timeout while the
+    stream waits on its chunk, loses the chunk to another bridge, which
+    carries on from the next height it needs. The stream ends at the first
+    chunk a bridge doesn't have all of, which is the chain tip.
+
+    With a policy, the first chunk is fetched with partial proofs, as
+    long as none of it has arrived yet; a bridge that takes it over part
+    way through can't know what the CSN's pollard holds by then. Later
+    chunks always have full proofs, for the same reason.
+    """
+
+    def __init__(self, hosts: Sequence[str], cur_height: int,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, max_chunks: int = 0,
+                 stall_timeout: float = STALL_TIMEOUT,
+                 decode: Callable[[bytes], UBlock] = UBlock.from_bytes,
+                 policy: Optional[CachePolicy] = None):
+        if not hosts:
+            raise ValueError("no bridge hosts")
+        if chunk_size < 1:
+            raise ValueError(f"chunk size {chunk_size} must be positive")
+
+        self.hosts = list(hosts)
+        self.start_height = cur_height
+        self.next_start = cur_height
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks or 2 * len(self.hosts)
+        self.stall_timeout = stall_timeout
+        self.decode = decode
+        self.policy = policy
+
+        self.chunks: Deque[_Chunk] = deque()
+        self.idle: List[str] = list(self.hosts)
+        self.failures: Dict[str, int] = {host: 0 for host in self.hosts}
+        self.retry_at: Dict[str, float] = {}
+        self.tip: Optional[int] = None
+        self.progress: Optional[asyncio.Event] = None
+
+    async def run(self, queue: asyncio.Queue) -> int:
+        """Put UBlocks in queue until the tip. Returns the height after the last."""
+        loop = asyncio.get_running_loop()
+        self.progress = asyncio.Event()
+        try:
+            while True:
+                # Anything that happens from here on cuts the wait short
+                self.progress.clear()
+                self._collect(loop.time())
+
+                # Hand over what's arrived, in order
+                while self.chunks and self.chunks[0].blocks:
+                    await queue.put(self.chunks[0].blocks.popleft())
+
+                head = self.chunks[0] if self.chunks else None
+                if head is not None and head.done() and head.host is None:
+                    self.chunks.popleft()
+                    if head.short:
+                        return head.next_height
+                    continue
+
+                self._check_head(loop.time())
+                self._assign(loop.time())
+
+                try:
+                    await asyncio.wait_for(self.progress.wait(), self._wait_time(loop.time()))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for chunk in self.chunks:
+                if chunk.task is not None:
+                    chunk.task.cancel()
+
+    async def _fetch(self, chunk: _Chunk) -> None:
+        loop = asyncio.get_running_loop()
+        sock = await connect_bridge(chunk.host)
+        try:
+            request = struct.pack(">ii", chunk.next_height, chunk.end)
+            if self.policy is not None and chunk.next_height == self.start_height:
+                request = self.policy.serialize() + request
+            await loop.sock_sendall(sock, request)
+
+            async def put(ub):
+                chunk.blocks.append(ub)
+                chunk.next_height += 1
+                chunk.last_progress = loop.time()
+                self.progress.set()
+
+            await read_ublock_frames(sock, put, self.decode)
+            if chunk.next_height <= chunk.end:
+                chunk.short = True
+        finally:
+            sock.close()
+
+    def _start(self, chunk: _Chunk, host: str, now: float) -> None:
+        chunk.host = host
+        chunk.last_progress = now
+        chunk.task = asyncio.ensure_future(self._fetch(chunk))
+        chunk.task.add_done_callback(lambda _: self.progress.set())
+
+    def _release(self, chunk: _Chunk) -> str:
+        """Take chunk's bridge off it, cancelling the fetch if it's running"""
+        host, task = chunk.host, chunk.task
+        chunk.host = chunk.task = None
+        if not task.done():
+            task.cancel()
+        self.idle.append(host)
+        return host
+
+    def _failed(self, host: str, now: float) -> None:
+        self.failures[host] += 1
+        self.retry_at[host] = now + RETRY_DELAY
+        if all(n >= MAX_FAILURES for n in self.failures.values()):
+            raise ConnectionError(f"all {len(self.hosts)} bridges failed {MAX_FAILURES} times")
+
+    def _collect(self, now: float) -> None:
+        """Free the bridges whose fetches have finished"""
+        for chunk in self.chunks:
+            if chunk.task is None or not chunk.task.done():
+                continue
+            err = chunk.task.exception()
+            host = self._release(chunk)
+            if err is not None:
+                print(f"Fetching {chunk.start}-{chunk.end} from {host}: {err}")
+                self._failed(host, now)
+                continue
+
+            self.failures[host] = 0
+            if chunk.short:
+                self.tip = chunk.next_height if self.tip is None else min(self.tip, chunk.next_height)
+
+    def _check_head(self, now: float) -> None:
+        """
+        Get the stream moving again if the chunk it's waiting on has stalled
+        or has no bridge, taking a bridge off the latest chunk if none is free
+        """
+        if not self.chunks:
+            return
+        head = self.chunks[0]
+        if head.host is not None:
+            if now - head.last_progress < self.stall_timeout:
+                return
+            print(f"{head.host} stalled at height {head.next_height}")
+            self._failed(self._release(head), now)
+
+        if self._free_hosts(now):
+            return
+        for chunk in reversed(self.chunks):
+            if chunk is not head and chunk.host is not None:
+                self._release(chunk)
+                return
+
+    def _free_hosts(self, now: float) -> List[str]:
+        return [host for host in self.idle if self.retry_at.get(host, 0) <= now]
+
+    def _assign(self, now: float) -> None:
+        for host in self._free_hosts(now):
+            # Chunks that lost their bridge first, then new ones
+            chunk = next((c for c in self.chunks if c.host is None and not c.done()), None)
+            if chunk is None:
+                if len(self.chunks) >= self.max_chunks:
+                    return
+                if self.tip is not None and self.next_start >= self.tip:
+                    return
+                chunk = _Chunk(self.next_start, self.next_start + self.chunk_size - 1)
+                self.next_start += self.chunk_size
+                self.chunks.append(chunk)
+
+            self.idle.remove(host)
+            self._start(chunk, host, now)
+
+    def _wait_time(self, now: float) -> float:
+        """How long until a stall or a bridge's retry needs looking at"""
+        wait = self.stall_timeout
+        if self.chunks and self.chunks[0].host is not None:
+            wait = self.chunks[0].last_progress + self.stall_timeout - now
+        for at in self.retry_at.values():
+            if at > now:
+                wait = min(wait, at - now)
+        return max(wait, 0.01)
+
+
+def multi_bridge_reader(hosts: Sequence[str], cur_height: int, lookahead: int,
+                        chunk_size: int = DEFAULT_CHUNK_SIZE,
+                        policy: Optional[CachePolicy] = None,
+                        decode: Callable[[bytes], UBlock] = UBlock.from_bytes) -> Queue:
+    """
+    Start downloading UBlocks from several bridges on a thread of its own
+    and return the queue they arrive in, in height order (see reader_thread)
+    """
+    reader = MultiBridgeReader(hosts, cur_height, chunk_size, decode=decode, policy=policy)
+    return reader_thread(reader.run, lookahead, ", ".join(hosts))
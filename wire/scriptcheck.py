@@ -0,0 +1,107 @@
+import os
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Optional, Sequence
+
+from btcd.blockchain import UtxoViewpoint
+from btcd.chaincfg import Params
+from btcd.txscript import HashCache, SigCache
+
+# Most transactions handed to a worker at once
+TXS_PER_TASK = 16
+# Signatures remembered across blocks
+SIG_CACHE_SIZE = 100000
+
+# Caches of a worker process, made when it starts
+_worker_caches = None
+
+
+def _init_worker() -> None:
+    global _worker_caches
+    _worker_caches = (SigCache(SIG_CACHE_SIZE), HashCache(SIG_CACHE_SIZE))
+
+
+def check_txs(txs: Sequence, view: UtxoViewpoint, height: int, params: Params,
+              sig_cache: SigCache, hash_cache: HashCache,
+              stop: Optional[threading.Event] = None) -> None:
+    """Check transactions' inputs and scripts, raising on the first failure"""
+    for tx in txs:
+        if stop is not None and stop.is_set():
+            return
+        if not tx.check_transaction_inputs(height, view, params):
+            raise ValueError(f"Tx {tx.hash()} fails CheckTransactionInputs")
+        if not tx.validate_transaction_scripts(view, 0, sig_cache, hash_cache):
+            raise ValueError(f"Tx {tx.hash()} fails ValidateTransactionScripts")
+
+
+def _check_in_worker(txs: Sequence, view: UtxoViewpoint, height: int, params: Params) -> None:
+    check_txs(txs, view, height, params, *_worker_caches)
+
+
+class ScriptChecker:
+    """
+    ScriptChecker validates blocks' transactions on a pool of workers kept
+    for its lifetime, sized to the core count by default. Each block's
+    transactions are split into chunks of up to TXS_PER_TASK, fewer when
+    that's needed to keep every worker busy. The first failure is raised
+    from check: chunks not yet started are cancelled, and chunks running
+    on threads stop at their next transaction.
+
+    Script checks in Python hold the GIL, so with processes set the pool
+    is worker processes instead of threads. Each chunk is then sent with
+    the block's UtxoViewpoint, and each process keeps its own caches.
+    """
+
+    def __init__(self, workers: Optional[int] = None, processes: bool = False):
+        self.workers = workers or os.cpu_count() or 1
+        self.processes = processes
+        if processes:
+            self.pool = ProcessPoolExecutor(self.workers, initializer=_init_worker)
+        else:
+            self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="scriptcheck")
+            self.sig_cache = SigCache(SIG_CACHE_SIZE)
+            self.hash_cache = HashCache(SIG_CACHE_SIZE)
+
+    def check(self, txs: Sequence, view: UtxoViewpoint, height: int, params: Params) -> None:
+        """Check txs spending from view, raising ValueError for the first that fails"""
+        if not txs:
+            return
+
+        per_task = max(1, min(TXS_PER_TASK, -(-len(txs) // self.workers)))
+        stop = threading.Event()
+        futures = []
+        for i in range(0, len(txs), per_task):
+            chunk = txs[i:i + per_task]
+            if self.processes:
+                futures.append(self.pool.submit(_check_in_worker, chunk, view, height, params))
+            else:
+                futures.append(self.pool.submit(check_txs, chunk, view, height, params,
+                                                self.sig_cache, self.hash_cache, stop))
+
+        wait(futures, return_when=FIRST_EXCEPTION)
+        failed = next((f for f in futures if f.done() and f.exception() is not None), None)
+        if failed is None:
+            return
+
+        stop.set()
+        for future in futures:
+            future.cancel()
+        # Let running chunks wind down before the next block starts
+        wait(futures)
+        raise failed.exception()
+
+    def close(self) -> None:
+        self.pool.shutdown(cancel_futures=True)
+
+
+_default_checker: Optional[ScriptChecker] = None
+_default_lock = threading.Lock()
+
+
+def default_script_checker() -> ScriptChecker:
+    """A thread pool ScriptChecker shared by the whole process"""
+    global _default_checker
+    with _default_lock:
+        if _default_checker is None:
+            _default_checker = ScriptChecker()
+        return _default_checker
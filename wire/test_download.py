@@ -0,0 +1,146 @@
+import asyncio
+import struct
+import unittest
+from unittest.mock import patch
+
+from bridge.server import read_request
+from wire.download import MultiBridgeReader
+from wire.umsgblock import END_OF_RANGE, CachePolicy
+
+
+def decode_height(data):
+    return int.from_bytes(data, "big")
+
+
+class BridgeStandIn:
+    """A local bridge serving heights below tip as 4-byte frames"""
+
+    def __init__(self, tip, delay=0.0, stall_after=None, drop_at=None):
+        self.tip = tip
+        self.delay = delay
+        self.stall_after = stall_after  # stop sending after this many blocks, once
+        self.drop_at = drop_at  # close the connection at this height, once
+        self.requests = []
+        self.policy_starts = []  # start heights of requests with a policy
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, "127.0.0.1", 0)
+        return f"127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+
+    async def serve(self, reader, writer):
+        try:
+            policy, start, end = await read_request(reader)
+            self.requests.append((start, end))
+            if policy is not None:
+                self.policy_starts.append(start)
+            for height in range(start, min(end + 1, self.tip)):
+                if height - start == self.stall_after:
+                    self.stall_after = None
+                    await asyncio.sleep(3600)
+                if height == self.drop_at:
+                    self.drop_at = None
+                    return
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                writer.write(struct.pack(">II", 4, height))
+                await writer.drain()
+            writer.write(END_OF_RANGE)
+            await writer.drain()
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.server.close()
+
+
+async def dead_host():
+    """An address nothing listens on"""
+    server = await asyncio.start_server(lambda r, w: None, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    server.close()
+    await server.wait_closed()
+    return f"127.0.0.1:{port}"
+
+
+class TestMultiBridgeReader(unittest.TestCase):
+    def download(self, bridges, start=0, extra_hosts=0, **kwargs):
+        """Run a reader over the stand-ins; returns (end height, heights)"""
+        async def run():
+            hosts = [await bridge.start() for bridge in bridges]
+            hosts += [await dead_host() for _ in range(extra_hosts)]
+            reader = MultiBridgeReader(hosts, start, decode=decode_height, **kwargs)
+            queue = asyncio.Queue(5)
+            got = []
+
+            async def consume():
+                while True:
+                    got.append(await queue.get())
+
+            consumer = asyncio.create_task(consume())
+            try:
+                end = await asyncio.wait_for(reader.run(queue), 20)
+                while not queue.empty():
+                    await asyncio.sleep(0)
+                return end, got
+            finally:
+                consumer.cancel()
+                for bridge in bridges:
+                    bridge.close()
+
+        return asyncio.run(run())
+
+    def test_in_order_from_several_bridges(self):
+        bridges = [BridgeStandIn(250, delay=0.001 * i) for i in range(3)]
+        end, got = self.download(bridges, start=7, chunk_size=20)
+        self.assertEqual(end, 250)
+        self.assertEqual(got, list(range(7, 250)))
+        for bridge in bridges:
+            self.assertTrue(bridge.requests)
+
+    def test_dead_bridge(self):
+        with patch("wire.download.RETRY_DELAY", 0.01):
+            end, got = self.download([BridgeStandIn(90)], extra_hosts=1, chunk_size=10)
+        self.assertEqual(got, list(range(90)))
+
+    def test_stalled_bridge_reassigned(self):
+        slow = BridgeStandIn(60, stall_after=5)
+        fast = BridgeStandIn(60, delay=0.001)
+        with patch("wire.download.RETRY_DELAY", 0.01):
+            end, got = self.download([slow, fast], chunk_size=10, stall_timeout=0.2)
+        self.assertEqual(got, list(range(60)))
+        # the first chunk went to the slow bridge, and the fast one carried
+        # on from where it stalled
+        self.assertEqual(slow.requests[0], (0, 9))
+        self.assertIn((5, 9), fast.requests)
+
+    def test_dropped_connection_resumes(self):
+        bridge = BridgeStandIn(30, drop_at=12)
+        with patch("wire.download.RETRY_DELAY", 0.01):
+            end, got = self.download([bridge], chunk_size=10)
+        self.assertEqual((end, got), (30, list(range(30))))
+        self.assertIn((12, 19), bridge.requests)
+
+    def test_policy_with_first_chunk(self):
+        bridges = [BridgeStandIn(50), BridgeStandIn(50, drop_at=3)]
+        with patch("wire.download.RETRY_DELAY", 0.01):
+            end, got = self.download(bridges, start=2, chunk_size=10,
+                                     policy=CachePolicy(lookahead=5))
+        self.assertEqual(got, list(range(2, 50)))
+        # Not again once part of the chunk has arrived
+        self.assertEqual(bridges[0].policy_starts + bridges[1].policy_starts, [2])
+
+    def test_all_bridges_dead(self):
+        with patch("wire.download.RETRY_DELAY", 0.01):
+            with self.assertRaises(ConnectionError):
+                self.download([], extra_hosts=2)
+
+    def test_no_hosts(self):
+        with self.assertRaises(ValueError):
+            MultiBridgeReader([], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
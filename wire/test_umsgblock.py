@@ -1,15 +1,23 @@
+import asyncio
 import unittest
 from unittest.mock import Mock, patch
 import io
-from queue import Queue
+import socket
+import struct
+import threading
+import time
 
 from btcd.wire import MsgBlock, TxOut, OutPoint
 from btcd.btcutil import Block
 from btcd.chaincfg import MainNetParams
 from btcd.chaincfg.chainhash import Hash
 
-from wire.umsgblock import UBlock, ublock_network_reader
-from btcacc import UData, LeafData
+from wire.scriptcheck import ScriptChecker
+from wire.umsgblock import (
+    END_OF_RANGE, FRAME_BUFFER_SIZE, MAX_FRAME_SIZE, MAX_HEIGHT, CachePolicy, UBlock,
+    read_block_request, read_ublock_frames, ublock_network_reader, ublock_stream_reader,
+)
+from btcacc import FLAG_NO_BLOCK_HASH, FLAG_PARTIAL_PROOF, UData, LeafData
 from accumulator import Leaf
 
 
@@ -17,9 +25,10 @@ class TestUBlock(unittest.TestCase):
     def setUp(self):
         # Create mock block and utreexo data
         self.mock_block = Mock(spec=Block)
+        self.mock_block.hash.return_value = b"\x07" * 32
         self.mock_block.transactions = [Mock(), Mock()]  # Coinbase + 1 transaction
-        self.mock_block.transactions[0].hash.return_value = b"coinbase_tx_hash"
-        self.mock_block.transactions[1].hash.return_value = b"regular_tx_hash"
+        self.mock_block.transactions[0].hash.return_value = b"coinbase_tx_hash".ljust(32, b"\x00")
+        self.mock_block.transactions[1].hash.return_value = b"regular_tx_hash".ljust(32, b"\x00")
 
         # Mock transaction outputs
         mock_txout = Mock(spec=TxOut)
@@ -103,31 +112,299 @@ class TestUBlock(unittest.TestCase):
         # Verify that serialize was called on both components
         self.mock_block.msg_block.serialize.assert_called_once()
 
-    @patch("socket.create_connection")
-    def test_ublock_network_reader(self, mock_create_connection):
-        """Test network reader functionality"""
-        # Setup
-        block_chan = Queue()
-        remote_server = "localhost:8333"
-        cur_height = 100
-        lookahead = 10
+    def test_serialize_into(self):
+        """Test UBlock serializes into a preallocated buffer in one pass"""
+        self.mock_block.msg_block.serialize.side_effect = lambda w: w.write(b"\x01" * 100)
+        self.mock_block.msg_block.serialize_size.return_value = 100
+
+        buf = bytearray(self.ublock.serialize_size())
+        end = self.ublock.serialize_into(buf, 0)
+
+        self.assertEqual(end, len(buf))
+        self.assertEqual(bytes(buf[:100]), b"\x01" * 100)
+        udata_buf = io.BytesIO()
+        self.utreexo_data.serialize(udata_buf)
+        self.assertEqual(bytes(buf[100:]), udata_buf.getvalue())
+
+        out = io.BytesIO()
+        self.ublock.serialize(out)
+        self.assertEqual(out.getvalue(), bytes(buf))
+
+    def test_block_request_with_policy(self):
+        """Test a cache policy preamble is read back before the range"""
+        policy = CachePolicy(lookahead=50, num_leaves=5, roots=[b"\x01" * 32, b"\x02" * 32],
+                             max_nodes=1000, flags=FLAG_NO_BLOCK_HASH)
+        r = io.BytesIO(policy.serialize() + struct.pack(">ii", 100, 200))
+        self.assertEqual(read_block_request(r), (policy, 100, 200))
+
+        r = io.BytesIO(struct.pack(">ii", 7, 9))
+        self.assertEqual(read_block_request(r), (None, 7, 9))
+
+    def test_block_request_bad_policy(self):
+        """Test a policy with the wrong number of roots is rejected"""
+        policy = CachePolicy(lookahead=1, num_leaves=3, roots=[b"\x01" * 32])
+        with self.assertRaises(ValueError):
+            read_block_request(io.BytesIO(policy.serialize() + struct.pack(">ii", 0, 1)))
+
+        # FLAG_PARTIAL_PROOF is the bridge's to set
+        policy = CachePolicy(lookahead=1, num_leaves=1, roots=[b"\x01" * 32],
+                             flags=FLAG_PARTIAL_PROOF)
+        with self.assertRaises(ValueError):
+            read_block_request(io.BytesIO(policy.serialize() + struct.pack(">ii", 0, 1)))
+
+    def test_serialize_frame(self):
+        """Test a frame is the length-prefixed serialized UBlock"""
+        ublock = Mock(spec=UBlock)
+        ublock.serialize_size.return_value = 3
+
+        def serialize_into(buf, offset):
+            buf[offset:offset + 3] = b"abc"
+            return offset + 3
+
+        ublock.serialize_into.side_effect = serialize_into
+        self.assertEqual(UBlock.serialize_frame(ublock), struct.pack(">I", 3) + b"abc")
+
+
+def decode_height(data):
+    return int.from_bytes(data, "big")
+
+
+class TestUBlockReader(unittest.TestCase):
+    def read_frames(self, data, close=True):
+        """Run read_ublock_frames over a socket pair fed data"""
+        ours, theirs = socket.socketpair()
+
+        def send():
+            theirs.sendall(data)
+            if close:
+                theirs.close()
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        got = []
+
+        async def put(ub):
+            got.append(ub)
+
+        async def run():
+            ours.setblocking(False)
+            return await read_ublock_frames(ours, put, decode=bytes)
+
+        try:
+            return asyncio.run(run()), got
+        finally:
+            sender.join()
+            ours.close()
+            if not close:
+                theirs.close()
+
+    def test_reads_frames_until_end_of_range(self):
+        """Test frames are decoded in order and the zero frame ends them"""
+        data = struct.pack(">I", 3) + b"abc" + struct.pack(">I", 2) + b"de" + END_OF_RANGE
+        self.assertEqual(self.read_frames(data, close=False), (2, [b"abc", b"de"]))
+
+    def test_grows_buffer_for_large_frame(self):
+        """Test a frame bigger than the starting buffer is read whole"""
+        payload = bytes(range(256)) * (FRAME_BUFFER_SIZE // 128)
+        count, got = self.read_frames(struct.pack(">I", len(payload)) + payload + END_OF_RANGE)
+        self.assertEqual((count, got), (1, [payload]))
+
+    def test_closed_before_end_of_range(self):
+        """Test a connection closed between frames without ending the range"""
+        with self.assertRaises(ConnectionError):
+            self.read_frames(struct.pack(">I", 3) + b"abc")
+
+    def test_truncated_frame(self):
+        """Test a connection closed inside a frame is a connection error"""
+        with self.assertRaises(ConnectionError):
+            self.read_frames(struct.pack(">I", 10) + b"abc")
+
+    def test_oversized_frame(self):
+        """Test a frame over MAX_FRAME_SIZE is rejected"""
+        with self.assertRaises(ValueError):
+            self.read_frames(struct.pack(">I", MAX_FRAME_SIZE + 1))
+
+    def test_consumer_backpressure(self):
+        """Test a full queue holds back the reader"""
+        server = socket.create_server(("127.0.0.1", 0))
+        port = server.getsockname()[1]
+
+        def serve():
+            conn, _ = server.accept()
+            with conn:
+                request = b""
+                while len(request) < 16:
+                    request += conn.recv(16 - len(request))
+                # two bounded ranges in flight
+                self.assertEqual(request, struct.pack(">iiii", 5, 504, 505, 1004))
+                for i in range(4):
+                    conn.sendall(struct.pack(">I", 1) + bytes([i]))
+                conn.sendall(END_OF_RANGE)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+
+        async def run():
+            queue = asyncio.Queue(1)
+            reader = asyncio.create_task(ublock_stream_reader(
+                queue, f"127.0.0.1:{port}", 5, decode=bytes
+            ))
+            await asyncio.sleep(0.1)
+            # one UBlock queued and the next waiting on it
+            self.assertEqual(queue.qsize(), 1)
+            self.assertFalse(reader.done())
+
+            got = []
+            while len(got) < 4:
+                got.append(await queue.get())
+            return await reader, got
+
+        try:
+            self.assertEqual(asyncio.run(run()), (9, [b"\x00", b"\x01", b"\x02", b"\x03"]))
+        finally:
+            thread.join()
+            server.close()
+
+    def test_ublock_network_reader_connection_error(self):
+        """Test the queue ends with None when the bridge can't be reached"""
+        server = socket.create_server(("127.0.0.1", 0))
+        port = server.getsockname()[1]
+        server.close()
+
+        with patch("wire.umsgblock.RECONNECT_DELAY", 0.01), \
+                patch("wire.umsgblock.MAX_RECONNECTS", 3):
+            block_chan = ublock_network_reader(f"127.0.0.1:{port}", 100, 10)
+            self.assertEqual(block_chan.maxsize, 10)
+            self.assertIsNone(block_chan.get(timeout=5))
+
+    def test_reconnects_from_next_height(self):
+        """Test a dropped connection resumes from the next height"""
+        requests = []
+
+        async def serve(reader, writer):
+            first = not requests
+            sent = 0
+            try:
+                while True:
+                    start, end = struct.unpack(">ii", await reader.readexactly(8))
+                    requests.append((start, end))
+                    for height in range(start, min(end + 1, 30)):
+                        if first and sent == 3:
+                            return
+                        writer.write(struct.pack(">II", 4, height))
+                        sent += 1
+                    writer.write(END_OF_RANGE)
+                    await writer.drain()
+            except asyncio.IncompleteReadError:
+                pass
+            finally:
+                writer.close()
+
+        async def run():
+            server = await asyncio.start_server(serve, "127.0.0.1", 0)
+            host = f"127.0.0.1:{server.sockets[0].getsockname()[1]}"
+            queue = asyncio.Queue()
+            with patch("wire.umsgblock.RECONNECT_DELAY", 0.01):
+                end = await ublock_stream_reader(queue, host, 10, decode=decode_height,
+                                                 range_size=8)
+            server.close()
+            got = [queue.get_nowait() for _ in range(queue.qsize())]
+            return end, got
+
+        end, got = asyncio.run(run())
+        self.assertEqual((end, got), (30, list(range(10, 30))))
+        self.assertEqual(requests[:4], [(10, 17), (13, 20), (21, 28), (29, 36)])
+
+    def test_reconnects_after_truncated_frame(self):
+        """Test a connection dropped part way through a frame resumes too"""
+        requests = []
+
+        async def serve(reader, writer):
+            first = not requests
+            try:
+                while True:
+                    start, end = struct.unpack(">ii", await reader.readexactly(8))
+                    requests.append((start, end))
+                    for height in range(start, min(end + 1, 20)):
+                        if first and height == 14:
+                            # Half a frame, as when the bridge restarts
+                            writer.write(struct.pack(">IH", 4, 0))
+                            await writer.drain()
+                            return
+                        writer.write(struct.pack(">II", 4, height))
+                    writer.write(END_OF_RANGE)
+                    await writer.drain()
+            except asyncio.IncompleteReadError:
+                pass
+            finally:
+                writer.close()
+
+        async def run():
+            server = await asyncio.start_server(serve, "127.0.0.1", 0)
+            host = f"127.0.0.1:{server.sockets[0].getsockname()[1]}"
+            queue = asyncio.Queue()
+            with patch("wire.umsgblock.RECONNECT_DELAY", 0.01):
+                end = await ublock_stream_reader(queue, host, 10, decode=decode_height,
+                                                 range_size=8)
+            server.close()
+            return end, [queue.get_nowait() for _ in range(queue.qsize())]
+
+        end, got = asyncio.run(run())
+        self.assertEqual((end, got), (20, list(range(10, 20))))
+        self.assertIn((14, 21), requests)
+
+
+class StandInTx:
+    """A transaction whose checks pass unless it's bad"""
+
+    def __init__(self, n, bad=False, delay=0.0):
+        self.n = n
+        self.bad = bad
+        self.delay = delay
+
+    def hash(self):
+        return self.n
+
+    def check_transaction_inputs(self, height, view, params):
+        return True
 
-        # Mock socket
-        mock_socket = Mock()
-        mock_create_connection.return_value = mock_socket
+    def validate_transaction_scripts(self, view, flags, sig_cache, hash_cache):
+        time.sleep(self.delay)
+        return not self.bad
 
-        # Mock socket receiving data
-        mock_socket.recv.side_effect = Exception("Test connection closed")
 
-        # Test connection error handling
-        with self.assertRaises(Exception):
-            ublock_network_reader(block_chan, remote_server, cur_height, lookahead)
+class TestScriptChecker(unittest.TestCase):
+    def test_threads(self):
+        checker = ScriptChecker(workers=4)
+        try:
+            checker.check([StandInTx(n) for n in range(100)], None, 1, None)
+            checker.check([], None, 2, None)
+            with self.assertRaisesRegex(ValueError, "Tx 37 fails"):
+                checker.check([StandInTx(n, bad=n == 37) for n in range(100)], None, 3, None)
+            # the pool is still usable after a failure
+            checker.check([StandInTx(n) for n in range(10)], None, 4, None)
+        finally:
+            checker.close()
 
-        # Verify socket was closed
-        mock_socket.close.assert_called_once()
+    def test_failure_stops_remaining_work(self):
+        checker = ScriptChecker(workers=2)
+        txs = [StandInTx(0, bad=True)] + [StandInTx(n, delay=0.01) for n in range(1, 400)]
+        start = time.monotonic()
+        try:
+            with self.assertRaises(ValueError):
+                checker.check(txs, None, 1, None)
+        finally:
+            checker.close()
+        self.assertLess(time.monotonic() - start, 1)
 
-        # Verify None was put in channel to signal end
-        self.assertIsNone(block_chan.get_nowait())
+    def test_processes(self):
+        checker = ScriptChecker(workers=2, processes=True)
+        try:
+            checker.check([StandInTx(n) for n in range(50)], None, 1, None)
+            with self.assertRaisesRegex(ValueError, "Tx 3 fails"):
+                checker.check([StandInTx(n, bad=n == 3) for n in range(50)], None, 2, None)
+        finally:
+            checker.close()
 
 
 if __name__ == "__main__":
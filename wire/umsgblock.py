@@ -1,20 +1,131 @@
+import asyncio
+import io
 import socket
 import struct
-from dataclasses import dataclass
-from typing import List, Tuple, Dict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple, Dict
 import threading
+from collections import deque
 from queue import Queue
 
 from btcd.chaincfg.chainhash import Hash
 from btcd.wire import OutPoint, TxOut, MsgBlock
 from btcd.blockchain import UtxoViewpoint, UtxoEntry
-from btcd.txscript import SigCache, HashCache
 from btcd.btcutil import Block
 from btcd.chaincfg import Params
 
-from accumulator import Leaf, Pollard
-from btcacc import LeafData, UData
-from util import is_unspendable
+from accumulator import Leaf
+from btcacc import (
+    FLAG_NO_BLOCK_HASH, FLAG_TXID_TABLE, UDATA_V1, UDATA_V2, BufferWriter, LeafData, UData,
+    leaf_hashes,
+)
+from util import block_to_del_ops, is_unspendable
+from wire.scriptcheck import ScriptChecker, default_script_checker
+
+# Sent in place of the start height to say a CachePolicy comes first
+POLICY_MARKER = -1
+# A CachePolicy after its marker, then 32 bytes per root
+POLICY_HEADER = struct.Struct(">IIQBB")
+# v2 flags a client may ask partial proofs to be sent with
+POLICY_FLAGS = FLAG_NO_BLOCK_HASH | FLAG_TXID_TABLE
+MAX_HEIGHT = 0x7fffffff  # MaxInt32
+
+# UBlocks are sent as frames: a u32 length, then the serialized UBlock. A
+# zero length ends the requested range.
+FRAME_HEADER = struct.Struct(">I")
+END_OF_RANGE = FRAME_HEADER.pack(0)
+# Largest frame accepted: a 4MB block plus generous proof data
+MAX_FRAME_SIZE = 32 << 20
+# Starting size of the reader's receive buffer; it grows to the largest frame
+FRAME_BUFFER_SIZE = 1 << 20
+
+# UBlocks read ahead of the consumer, at most
+MAX_QUEUED_BLOCKS = 1000
+CONNECT_TIMEOUT = 2
+
+# Heights asked for per request. The next range is requested while one is
+# still arriving, so the bridge never waits on us between ranges.
+RANGE_SIZE = 500
+RANGES_IN_FLIGHT = 2
+# Reconnect backoff: RECONNECT_DELAY seconds, doubling up to
+# MAX_RECONNECT_DELAY, giving up after MAX_RECONNECTS tries in a row
+# without a block
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30.0
+MAX_RECONNECTS = 10
+
+
+@dataclass
+class CachePolicy:
+    """
+    The CSN's Pollard caching rule and its roots when the session starts.
+    A bridge that gets one simulates the CSN's cache from those roots and
+    leaves out proof hashes the CSN already holds (FLAG_PARTIAL_PROOF).
+    The CSN forgets its cached leaves before sending it, so both sides
+    start from just the roots.
+
+    flags are the v2 flags from POLICY_FLAGS the partial proofs may be
+    encoded with as well: FLAG_NO_BLOCK_HASH only if the CSN has the hash
+    of every block before the session's start.
+    """
+    lookahead: int = 0
+    num_leaves: int = 0
+    roots: List[bytes] = field(default_factory=list)
+    max_nodes: int = 0  # Pollard.max_nodes, 0 for no limit
+    flags: int = 0
+
+    def serialize(self) -> bytes:
+        out = bytearray(struct.pack(">i", POLICY_MARKER))
+        out += POLICY_HEADER.pack(self.lookahead, self.max_nodes, self.num_leaves,
+                                  self.flags, len(self.roots))
+        for root in self.roots:
+            out += root
+        return bytes(out)
+
+    @staticmethod
+    def deserialize_body(r) -> "CachePolicy":
+        """Read a policy whose POLICY_MARKER has already been read"""
+        header = r.read(POLICY_HEADER.size)
+        if len(header) != POLICY_HEADER.size:
+            raise ValueError("unexpected end of cache policy")
+        lookahead, max_nodes, num_leaves, flags, num_roots = POLICY_HEADER.unpack(header)
+        if flags & ~POLICY_FLAGS:
+            raise ValueError(f"unknown cache policy flags {flags:#x}")
+        if num_roots != bin(num_leaves).count("1"):
+            raise ValueError(f"{num_leaves} leaves but {num_roots} roots")
+
+        data = r.read(32 * num_roots)
+        if len(data) != 32 * num_roots:
+            raise ValueError("unexpected end of cache policy")
+        roots = [data[i:i + 32] for i in range(0, len(data), 32)]
+        return CachePolicy(lookahead=lookahead, num_leaves=num_leaves, roots=roots,
+                           max_nodes=max_nodes, flags=flags)
+
+
+def read_block_request(r) -> Tuple[Optional[CachePolicy], int, int]:
+    """
+    Read a client's block request: an optional CachePolicy, then the start
+    and end heights
+    """
+    policy = None
+    data = r.read(4)
+    if len(data) != 4:
+        raise ValueError("unexpected end of block request")
+    start = struct.unpack(">i", data)[0]
+    if start == POLICY_MARKER:
+        policy = CachePolicy.deserialize_body(r)
+        data = r.read(4)
+        if len(data) != 4:
+            raise ValueError("unexpected end of block request")
+        start = struct.unpack(">i", data)[0]
+
+    data = r.read(4)
+    if len(data) != 4:
+        raise ValueError("unexpected end of block request")
+    end = struct.unpack(">i", data)[0]
+    if start < 0 or end < start:
+        raise ValueError(f"bad block range {start} to {end}")
+    return policy, start, end
 
 @dataclass
 class UBlock:
@@ -23,30 +134,32 @@ class UBlock:
     block: Block
 
     @staticmethod
-    def block_to_add_leaves(
+    def block_leaf_datas(
         blk: Block,
-        remember: List[bool],
         skiplist: List[int],
-        height: int,
-        out_count: int
-    ) -> List[Leaf]:
+        height: int
+    ) -> Tuple[List[LeafData], List[int]]:
         """
-        Turns all new UTXOs in a block into leaf TXOs.
+        LeafData for all new UTXOs in a block, and the txo number of each
         """
-        # Pre-allocate leaves list with estimated capacity
-        leaves = []
+        leaf_datas = []
+        txonums = []
         txonum = 0
-        
+
+        # Kept in the leaves, so UData can leave it out and have it looked
+        # up by height (FLAG_NO_BLOCK_HASH)
+        block_hash = blk.hash()
+
         for coinbase_if_0, tx in enumerate(blk.transactions):
             # Cache txid
             txid = tx.hash()
-            
+
             for i, out in enumerate(tx.msg_tx.tx_out):
                 # Skip unspendable outputs
                 if is_unspendable(out):
                     txonum += 1
                     continue
-                    
+
                 # Skip txos in skiplist
                 if skiplist and skiplist[0] == txonum:
                     skiplist = skiplist[1:]
@@ -55,27 +168,57 @@ class UBlock:
 
                 # Create leaf data
                 l = LeafData()
+                l.block_hash = block_hash
                 l.tx_hash = txid
                 l.index = i
                 l.height = height
                 l.coinbase = coinbase_if_0 == 0
                 l.amt = out.value
                 l.pk_script = out.pk_script
-
-                # Create leaf
-                uleaf = Leaf(hash=l.leaf_hash())
-                if len(remember) > txonum:
-                    uleaf.remember = remember[txonum]
-                    
-                leaves.append(uleaf)
+                leaf_datas.append(l)
+                txonums.append(txonum)
                 txonum += 1
 
+        return leaf_datas, txonums
+
+    @staticmethod
+    def block_to_add_leaves(
+        blk: Block,
+        remember: List[bool],
+        skiplist: List[int],
+        height: int,
+        out_count: int,
+        ttls: Sequence[int] = ()
+    ) -> List[Leaf]:
+        """
+        Turns all new UTXOs in a block into leaf TXOs. remember and ttls
+        are indexed by txo number.
+        """
+        leaf_datas, txonums = UBlock.block_leaf_datas(blk, skiplist, height)
+        return UBlock.leaves_for(leaf_datas, txonums, remember, ttls)
+
+    @staticmethod
+    def leaves_for(
+        leaf_datas: Sequence[LeafData],
+        txonums: Sequence[int],
+        remember: Sequence[bool] = (),
+        ttls: Sequence[int] = ()
+    ) -> List[Leaf]:
+        """Leaves for a block's new LeafData, hashed in one batch"""
+        leaves = []
+        for leaf_hash, txonum in zip(leaf_hashes(leaf_datas), txonums):
+            leaves.append(Leaf(
+                hash=leaf_hash,
+                remember=remember[txonum] if len(remember) > txonum else False,
+                ttl=ttls[txonum] if len(ttls) > txonum else 0,
+            ))
+
         return leaves
 
     def proof_sanity(self, nl: int, h: int) -> None:
         """Check consistency of UBlock proof"""
         # Get outpoints needing proof
-        prove_ops = self.block_to_del_ops()
+        prove_ops = block_to_del_ops(self.block)
 
         # Check all outpoints are provided
         if len(prove_ops) != len(self.utreexo_data.stxos):
@@ -108,81 +251,318 @@ class UBlock:
             
         return view
 
-    def check_block(self, outskip: List[int], params: Params) -> bool:
-        """Perform internal block checks"""
+    def check_block(self, outskip: List[int], params: Params,
+                    checker: Optional[ScriptChecker] = None) -> bool:
+        """
+        Perform internal block checks. Transactions are checked on
+        checker's workers, the process-wide thread pool by default.
+        """
         view = self.to_utxo_view()
-        view_map = view.entries
-        txonum = 0
-
-        sig_cache = SigCache(0)
-        hash_cache = HashCache(0)
 
         # Skip coinbase tx
         transactions = self.block.transactions[1:]
-        
-        def check_tx(tx):
-            # Check transaction inputs
-            height = self.utreexo_data.height
-            if not tx.check_transaction_inputs(height, view, params):
-                raise Exception(f"Tx {tx.hash()} fails CheckTransactionInputs")
-
-            # Validate transaction scripts
-            if not tx.validate_transaction_scripts(view, 0, sig_cache, hash_cache):
-                raise Exception(f"Tx {tx.hash()} fails ValidateTransactionScripts")
-
-        # Check transactions in parallel
-        threads = []
-        for tx in transactions:
-            t = threading.Thread(target=check_tx, args=(tx,))
-            threads.append(t)
-            t.start()
-
-        for t in threads:
-            t.join()
+        if checker is None:
+            checker = default_script_checker()
+        checker.check(transactions, view, self.utreexo_data.height, params)
 
         return True
 
-    def deserialize(self, r) -> None:
-        """Deserialize UBlock from reader"""
+    def deserialize(self, r, block_hashes=None) -> None:
+        """
+        Deserialize UBlock from reader. The UData version is detected;
+        block_hashes maps height to block hash for UData sent without them.
+        """
         msg_block = MsgBlock()
         msg_block.deserialize(r)
         self.block = Block(msg_block)
         self.utreexo_data = UData()
-        self.utreexo_data.deserialize(r)
+        self.utreexo_data.deserialize(r, block_hashes)
+
+    def serialize(self, w, version: int = UDATA_V1, flags: int = 0) -> None:
+        """Serialize UBlock to writer in a single pre-sized write"""
+        if version == UDATA_V2:
+            buf = bytearray(self.block.msg_block.serialize_size())
+            self.block.msg_block.serialize(BufferWriter(buf))
+            w.write(buf + self.utreexo_data.serialize_v2(flags))
+            return
+
+        buf = bytearray(self.serialize_size())
+        self.serialize_into(buf, 0)
+        w.write(buf)
+
+    def serialize_frame(self, version: int = UDATA_V1, flags: int = 0) -> bytes:
+        """The UBlock as a length-prefixed frame for the network"""
+        if version == UDATA_V2:
+            w = io.BytesIO()
+            self.serialize(w, version, flags)
+            payload = w.getbuffer()
+            return FRAME_HEADER.pack(len(payload)) + payload
+
+        size = self.serialize_size()
+        buf = bytearray(FRAME_HEADER.size + size)
+        FRAME_HEADER.pack_into(buf, 0, size)
+        self.serialize_into(buf, FRAME_HEADER.size)
+        return bytes(buf)
 
-    def serialize(self, w) -> None:
-        """Serialize UBlock to writer"""
-        self.block.msg_block.serialize(w)
-        self.utreexo_data.serialize(w)
+    @staticmethod
+    def from_bytes(data: bytes, block_hashes=None) -> "UBlock":
+        """
+        Decode a UBlock from a frame's payload. The UData is decoded in
+        place (UData.from_buffer), so data must not be modified afterwards.
+        """
+        r = io.BytesIO(data)
+        msg_block = MsgBlock()
+        msg_block.deserialize(r)
+        udata = UData.from_buffer(memoryview(data)[r.tell():], block_hashes)
+        return UBlock(udata, Block(msg_block))
+
+    def serialize_into(self, buf: bytearray, offset: int) -> int:
+        """
+        Serialize UBlock into a preallocated buffer at offset.
+        Returns the offset just past the written bytes.
+        """
+        bw = BufferWriter(buf, offset)
+        self.block.msg_block.serialize(bw)
+        return self.utreexo_data.serialize_into(buf, bw.offset)
 
     def serialize_size(self) -> int:
         """Get serialized size in bytes"""
         return self.block.msg_block.serialize_size() + self.utreexo_data.serialize_size()
 
 
-def ublock_network_reader(block_chan: Queue, remote_server: str, cur_height: int, lookahead: int):
-    """Gets Ublocks from remote host and puts them in channel"""
-    try:
-        sock = socket.create_connection(remote_server.split(':'), timeout=2)
-    except Exception as e:
-        raise Exception(f"Connection error: {str(e)}")
+class StreamBlockHashes:
+    """
+    Block hashes for a reader decoding UData sent without them
+    (FLAG_NO_BLOCK_HASH). The reader runs ahead of the CSN, so the CSN's
+    BlockHashIndex only covers the blocks it has processed; the hashes of
+    blocks decoded since are kept here until the index has them too.
+    Blocks must be decoded in height order, other than ones sent with
+    full block hashes.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.recent: Dict[int, bytes] = {}
+        self.pruned = len(index)
+
+    def __getitem__(self, height: int) -> bytes:
+        block_hash = self.recent.get(height)
+        return self.index[height] if block_hash is None else block_hash
+
+    def decode(self, data: bytes) -> UBlock:
+        """UBlock.from_bytes, noting the block's hash for later UData"""
+        ub = UBlock.from_bytes(data, self)
+        self.recent[ub.utreexo_data.height] = ub.block.hash()
+        # Drop what the index has caught up with
+        while self.pruned < len(self.index):
+            self.recent.pop(self.pruned, None)
+            self.pruned += 1
+        return ub
+
+
+def ublock_queue_size(lookahead: int) -> int:
+    """How many decoded UBlocks a reader may hold for a pollard's lookahead"""
+    return max(1, min(lookahead, MAX_QUEUED_BLOCKS))
+
+
+async def _recv_exactly(loop, sock: socket.socket, view: memoryview) -> bool:
+    """
+    Fill view from sock. Returns False if the connection closed before
+    anything was read; closing part way through raises ConnectionError.
+    """
+    got = 0
+    while got < len(view):
+        n = await loop.sock_recv_into(sock, view[got:])
+        if n == 0:
+            if got == 0:
+                return False
+            raise ConnectionError(f"connection closed {got} bytes into a {len(view)} byte read")
+        got += n
+    return True
+
 
+async def read_ublock_frames(sock: socket.socket, put: Callable[[UBlock], Awaitable],
+                             decode: Callable[[bytes], UBlock] = UBlock.from_bytes) -> int:
+    """
+    Read UBlock frames from a connected non-blocking socket until the
+    bridge ends the range, awaiting put for each decoded UBlock. Frames are
+    received into one reusable buffer. Nothing more is read while put
+    waits, so a consumer that falls behind holds the bridge back through
+    TCP flow control. Returns the number of UBlocks read, which is short of
+    the range if the bridge doesn't have the later blocks; raises
+    ConnectionError if the connection closes first, even part way through
+    a frame, and ValueError for a frame that's too big or doesn't decode.
+    """
+    loop = asyncio.get_running_loop()
+    buf = bytearray(FRAME_BUFFER_SIZE)
+    view = memoryview(buf)
+    count = 0
+    while True:
+        if not await _recv_exactly(loop, sock, view[:FRAME_HEADER.size]):
+            raise ConnectionError(f"connection closed after {count} UBlocks")
+        size = FRAME_HEADER.unpack_from(buf)[0]
+        if size == 0:
+            return count
+        if size > MAX_FRAME_SIZE:
+            raise ValueError(f"frame of {size} bytes is over {MAX_FRAME_SIZE}")
+        if size > len(buf):
+            view.release()
+            buf = bytearray(size)
+            view = memoryview(buf)
+
+        if not await _recv_exactly(loop, sock, view[:size]):
+            raise ConnectionError(f"connection closed before a {size} byte frame")
+        # The decoded UBlock keeps views into its bytes, so it gets a copy
+        await put(decode(bytes(view[:size])))
+        count += 1
+
+
+async def connect_bridge(remote_server: str) -> socket.socket:
+    """Open a non-blocking connection to a bridge at host:port"""
+    loop = asyncio.get_running_loop()
+    host, port = remote_server.rsplit(":", 1)
+    family, type_, proto, _, addr = (
+        await loop.getaddrinfo(host, int(port), type=socket.SOCK_STREAM)
+    )[0]
+    sock = socket.socket(family, type_, proto)
+    sock.setblocking(False)
     try:
-        # Request block range
-        sock.send(struct.pack(">i", cur_height))
-        sock.send(struct.pack(">i", 0x7fffffff))  # MaxInt32
-
-        # Read blocks
-        while True:
-            ub = UBlock(None, None)
-            try:
-                ub.deserialize(sock)
-                block_chan.put(ub)
-                cur_height += 1
-            except Exception as e:
-                print(f"Deserialize error from {remote_server}: {str(e)}")
-                break
-
-    finally:
+        await asyncio.wait_for(loop.sock_connect(sock, addr), CONNECT_TIMEOUT)
+    except BaseException:
         sock.close()
-        block_chan.put(None)  # Signal end 
\ No newline at end of file
+        raise
+    return sock
+
+
+async def ublock_stream_reader(queue: asyncio.Queue, remote_server: str, cur_height: int,
+                               policy: Optional[CachePolicy] = None, end: int = MAX_HEIGHT,
+                               decode: Callable[[bytes], UBlock] = UBlock.from_bytes,
+                               range_size: int = RANGE_SIZE) -> int:
+    """
+    Request heights cur_height to end from the bridge and put the UBlocks
+    in queue, which should be bounded (ublock_queue_size). Heights are
+    requested range_size at a time. If the connection drops, the reader
+    reconnects with exponential backoff and carries on from the next
+    height, raising ConnectionError after MAX_RECONNECTS failed tries in a
+    row. Returns the height after the last UBlock read, which is short of
+    end if the bridge reached its tip.
+
+    With a policy, the bridge sends partial proofs to be filled in from
+    the CSN's pollard. That only holds for the first connection: after a
+    reconnect the bridge can't know what the pollard holds by then, so
+    proofs are full.
+    """
+    loop = asyncio.get_running_loop()
+    height = cur_height
+    failures = 0
+
+    async def put(ub):
+        nonlocal height, failures
+        await queue.put(ub)
+        height += 1
+        failures = 0
+
+    while height <= end:
+        sock = None
+        try:
+            sock = await connect_bridge(remote_server)
+            if await _read_ranges(loop, sock, put, height, end, policy, decode, range_size):
+                return height
+        except (OSError, asyncio.TimeoutError) as e:
+            # ConnectionError included
+            failures += 1
+            if failures >= MAX_RECONNECTS:
+                raise ConnectionError(
+                    f"{remote_server} failed {failures} times at height {height}: {str(e)}"
+                )
+            delay = min(RECONNECT_DELAY * 2 ** (failures - 1), MAX_RECONNECT_DELAY)
+            print(f"Read error from {remote_server} at height {height}: {str(e)}; "
+                  f"reconnecting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        finally:
+            if sock is not None:
+                sock.close()
+        if height != cur_height:
+            policy = None
+
+    return height
+
+
+async def _read_ranges(loop, sock: socket.socket, put, height: int, end: int,
+                       policy: Optional[CachePolicy], decode, range_size: int) -> bool:
+    """
+    Request ranges from height to end over one connection, keeping
+    RANGES_IN_FLIGHT outstanding. Returns True if the bridge ran out of
+    blocks before end.
+    """
+    outstanding = deque()
+    next_start = height
+
+    def request() -> bytes:
+        nonlocal next_start
+        range_end = min(next_start + range_size - 1, end)
+        outstanding.append((next_start, range_end))
+        next_start = range_end + 1
+        return struct.pack(">ii", outstanding[-1][0], range_end)
+
+    first = policy.serialize() if policy is not None else b""
+    while len(outstanding) < RANGES_IN_FLIGHT and next_start <= end:
+        first += request()
+    await loop.sock_sendall(sock, first)
+
+    while outstanding:
+        start, range_end = outstanding.popleft()
+        if await read_ublock_frames(sock, put, decode) < range_end - start + 1:
+            return True
+        if next_start <= end:
+            await loop.sock_sendall(sock, request())
+    return False
+
+
+def reader_thread(read: Callable[[asyncio.Queue], Awaitable], lookahead: int,
+                  source: str) -> Queue:
+    """
+    Run read, an asyncio reader filling the queue it's given, on a thread
+    of its own. Returns the queue UBlocks arrive in for a consumer thread,
+    bounded by ublock_queue_size(lookahead). None is put in the queue once
+    read returns or fails.
+    """
+    block_chan = Queue(ublock_queue_size(lookahead))
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(1)
+
+        async def forward():
+            # The blocking put is what holds the network reader back
+            while True:
+                ub = await queue.get()
+                await loop.run_in_executor(None, block_chan.put, ub)
+                if ub is None:
+                    return
+
+        forwarder = asyncio.create_task(forward())
+        try:
+            await read(queue)
+        except Exception as e:
+            print(f"Read error from {source}: {str(e)}")
+        finally:
+            await queue.put(None)
+            await forwarder
+
+    threading.Thread(target=asyncio.run, args=(run(),), daemon=True).start()
+    return block_chan
+
+
+def ublock_network_reader(remote_server: str, cur_height: int, lookahead: int,
+                          policy: Optional[CachePolicy] = None,
+                          decode: Callable[[bytes], UBlock] = UBlock.from_bytes) -> Queue:
+    """
+    Start reading UBlocks from the remote host on a thread of its own and
+    return the queue they arrive in (see reader_thread)
+    """
+    return reader_thread(
+        lambda queue: ublock_stream_reader(queue, remote_server, cur_height, policy,
+                                           decode=decode),
+        lookahead, remote_server,
+    )